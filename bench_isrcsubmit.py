@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+# This benchmark is free. You can redistribute and/or modify it at will.
+"""Benchmarks for isrcsubmit
+
+Usage: bench_isrcsubmit.py [options] [benchmark ...]
+
+Without arguments all benchmarks are run.
+The results can be saved as JSON with --save
+and compared to the results of an earlier run with --baseline.
+The exit code is 1 if a benchmark is over its budget
+or clearly slower than the baseline.
+Every measurement is the best of a few runs, see --repeat.
+"""
+
+import os
+import gc
+import sys
+import copy
+import json
+import time
+import shutil
+import platform
+import tempfile
+import threading
+from contextlib import contextmanager
+from optparse import OptionParser, Values
+from subprocess import Popen, PIPE
+
+SCRIPT_NAME = "isrcsubmit.py"
+TEST_DATA = "test_data/"
+# seconds for a cold start of an entry point, including the interpreter
+STARTUP_BUDGET = 0.15
+# these should never need a drive or the web service
+ENTRY_POINTS = [["--version"], ["-h"], ["--help"]]
+REPEAT = 5
+# number of tracks for the synthetic discs
+TRACK_COUNTS = [1000, 20000]
+# number of copies of the box set media for the synthetic releases
+MEDIA_COPIES = [1, 10, 100]
+# growth of the run time allowed from the smallest to the largest disc,
+# linear time is the ratio of the track counts
+SCALING_BUDGET = 3.0
+# discs processed for the discs per minute
+PIPELINE_DISCS = 20
+PIPELINE_RECORDINGS = ["TqvKjMu7dMliSfmVEBtrL7sBSno-.pickle",
+                       "hSI7B4G4AkB5.DEBcW.3KCn.D_E-_cdrdao.toc"]
+# requests per second, the local web service has no limit
+PIPELINE_RATE_LIMIT = 1000
+BOX_SET_DISC = "hSI7B4G4AkB5.DEBcW.3KCn.D_E-"
+BOX_SET_ID = "378fcd3a-9e3d-3667-a499-0ec9a2c29f14"
+# slowdown compared to the baseline that counts as a regression
+REGRESSION_BUDGET = 1.5
+# seconds, shorter measurements are too noisy to compare
+NOISE_FLOOR = 0.001
+# seconds a measurement has to be slower than the baseline to count
+REGRESSION_SLACK = 0.002
+# runs of a benchmark that seems slower before it counts as a regression
+RECHECKS = 2
+
+# seconds for each measurement, lower is better
+results = dict()
+
+
+def record(name, seconds):
+    """Keep the best result of a measurement for saving and comparing"""
+    if name not in results or seconds < results[name]:
+        results[name] = seconds
+
+def run_script(args, env=None):
+    """Returns the wall clock time for one run of the script"""
+    start = time.time()
+    proc = Popen([sys.executable, SCRIPT_NAME] + args,
+                 stdout=PIPE, stderr=PIPE, env=env)
+    proc.communicate()
+    return time.time() - start
+
+def import_time(env=None):
+    """Returns the best cumulative import time of isrcsubmit in seconds
+
+    This is the same as shown by python -X importtime.
+    """
+    times = [seconds for seconds in (_import_time(env) for i in range(REPEAT))
+             if seconds is not None]
+    return min(times) if times else None
+
+def _import_time(env):
+    proc = Popen([sys.executable, "-X", "importtime", "-c", "import isrcsubmit"],
+                 stdout=PIPE, stderr=PIPE, env=env)
+    errors = proc.communicate()[1].decode()
+    for line in reversed(errors.splitlines()):
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == "isrcsubmit":
+            return int(fields[1]) / 1000000.0
+    return None
+
+@contextmanager
+def quiet():
+    """Send the output to os.devnull and pause the garbage collector,
+    like timeit does, so neither the terminal nor a collection is measured
+    """
+    with open(os.devnull, "w") as devnull:
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = devnull
+        gc.disable()
+        try:
+            yield
+        finally:
+            gc.enable()
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+
+def best_time(function, *args):
+    """Returns the best time of a few runs, output is discarded"""
+    best = None
+    with quiet():
+        for i in range(REPEAT):
+            start = time.time()
+            function(*args)
+            seconds = time.time() - start
+            if best is None or seconds < best:
+                best = seconds
+    return best
+
+def load_isrcsubmit():
+    """Import isrcsubmit with the options the benchmarks need"""
+    import isrcsubmit
+    isrcsubmit.options = Values({"backend": "synthetic", "headless": True})
+    return isrcsubmit
+
+def print_time(name, seconds, count=None, unit="track"):
+    if count is None:
+        print("%-24s %8.2f ms" % (name, seconds * 1000))
+    else:
+        print("%-24s %8.2f ms  (%.1f us per %s)"
+              % (name, seconds * 1000, seconds * 1000000 / count, unit))
+
+def check_growth(times, counts):
+    """Print and check the growth of the run time, True if about linear"""
+    growth = (times[-1] / times[0]) / (float(counts[-1]) / counts[0])
+    if growth > SCALING_BUDGET:
+        result = "not linear"
+    else:
+        result = "ok"
+    print("%-24s %8.2f     (budget %.1f) %s"
+          % ("growth per item", growth, SCALING_BUDGET, result))
+    return growth <= SCALING_BUDGET
+
+def bench_startup():
+    """cold start of the command line entry points"""
+    config_home = tempfile.mkdtemp()
+    env = dict(os.environ, XDG_CONFIG_HOME=config_home)
+    ok = True
+    try:
+        seconds = import_time(env)
+        if seconds is not None:
+            print("%-24s %8.1f ms" % ("import isrcsubmit", seconds * 1000))
+            record("startup/import", seconds)
+        for args in ENTRY_POINTS:
+            seconds = min(run_script(args, env) for i in range(REPEAT))
+            if seconds > STARTUP_BUDGET:
+                ok = False
+                result = "over budget"
+            else:
+                result = "ok"
+            name = " ".join([SCRIPT_NAME] + args)
+            print("%-24s %8.1f ms  (budget %d ms) %s"
+                  % (name, seconds * 1000, STARTUP_BUDGET * 1000, result))
+            record("startup/%s" % name, seconds)
+    finally:
+        shutil.rmtree(config_home)
+    return ok
+
+def synthetic_disc(track_count):
+    """Returns MusicBrainz tracks and backend output for a huge disc
+
+    Every tenth ISRC is already attached,
+    every hundredth track has the ISRC of the track before.
+    """
+    mb_tracks = []
+    backend_output = []
+    for number in range(1, track_count + 1):
+        isrc = "XXBEN%07d" % number
+        if number % 100 == 0:
+            isrc = "XXBEN%07d" % (number - 1)
+        recording = {"id": "recording-%d" % number,
+                     "title": "Track %d" % number}
+        if number % 10 == 0:
+            recording["isrc-list"] = [isrc]
+        mb_tracks.append({"id": "track-%d" % number,
+                          "position": str(number), "number": str(number),
+                          "recording": recording})
+        backend_output.append((number, isrc))
+    return mb_tracks, backend_output
+
+def time_local_check(track_count):
+    isrcsubmit = load_isrcsubmit()
+    mb_tracks, backend_output = synthetic_disc(track_count)
+    medium = isrcsubmit.Medium({"position": "1", "track-list": mb_tracks})
+    return best_time(isrcsubmit.check_isrcs_local, backend_output, medium)
+
+def bench_duplicates():
+    """local ISRC checks on synthetic discs with many tracks"""
+    times = []
+    for track_count in TRACK_COUNTS:
+        seconds = time_local_check(track_count)
+        times.append(seconds)
+        print_time("%d tracks" % track_count, seconds, track_count)
+        record("duplicates/%d tracks" % track_count, seconds)
+    return check_growth(times, TRACK_COUNTS)
+
+class ReadDisc(object):
+    """A disc with the TOC cdrdao read already"""
+
+    def __init__(self, lines):
+        self.cdrdao_toc = lines
+        self.backend_lines = None
+
+def synthetic_output(backend, track_count):
+    """Returns the lines a backend prints for a disc with many tracks"""
+    lines = []
+    if backend == "cdrdao":
+        lines.append("CD_DA\n\n")
+    for number in range(1, track_count + 1):
+        isrc = "XXBEN%07d" % number
+        if backend == "cdrdao":
+            lines.extend(["// Track %d\n" % number, "TRACK AUDIO\n",
+                          "NO COPY\n", 'ISRC "%s"\n' % isrc,
+                          'FILE "data.wav" 0 03:00:00\n', "\n"])
+        elif backend == "mediatools":
+            lines.append("ISRC %2d %s-%s-%s-%s\n"
+                         % (number, isrc[:2], isrc[2:5], isrc[5:7], isrc[7:]))
+        else:
+            lines.append("Track %2d : %s\n" % (number, isrc))
+    return lines
+
+def bench_parsing():
+    """extraction of the ISRCs from the backend output"""
+    isrcsubmit = load_isrcsubmit()
+    with open("%s%s_cdrdao.toc" % (TEST_DATA, BOX_SET_DISC)) as toc:
+        lines = toc.readlines()
+    seconds = best_time(isrcsubmit.gather_isrcs, ReadDisc(lines), "cdrdao",
+                        None)
+    print_time("cdrdao fixture", seconds)
+    record("parsing/cdrdao fixture", seconds)
+    seconds = best_time(isrcsubmit.parse_toc_disc, lines)
+    print_time("cdrdao fixture disc ID", seconds)
+    record("parsing/cdrdao fixture disc ID", seconds)
+
+    parsers = {"cdrdao": isrcsubmit.parse_cdrdao_toc,
+               "discisrc": isrcsubmit.parse_discisrc,
+               "mediatools": isrcsubmit.parse_mediatools}
+    ok = True
+    for backend in sorted(parsers):
+        times = []
+        for track_count in TRACK_COUNTS:
+            lines = synthetic_output(backend, track_count)
+            if backend == "cdrdao":
+                seconds = best_time(isrcsubmit.gather_isrcs, ReadDisc(lines),
+                                    backend, None)
+            else:
+                seconds = best_time(lambda: list(parsers[backend](lines)))
+            times.append(seconds)
+            name = "%s %d tracks" % (backend, track_count)
+            print_time(name, seconds, track_count)
+            record("parsing/%s" % name, seconds)
+        if not check_growth(times, TRACK_COUNTS):
+            ok = False
+    return ok
+
+def box_set_releases():
+    """Returns the releases of the box set disc as parsed by musicbrainzngs"""
+    with open("%s%s_releases.json" % (TEST_DATA, BOX_SET_DISC)) as data:
+        return json.load(data)["disc"]["release-list"]
+
+def synthetic_box_set(copies):
+    """Returns the box set with all media repeated.
+
+    The recordings of the copies are new, but have the same ISRCs.
+    """
+    box_set = [release for release in box_set_releases()
+               if release["id"] == BOX_SET_ID][0]
+    release = dict(box_set)
+    release["medium-list"] = []
+    for copy_number in range(copies):
+        for medium in box_set["medium-list"]:
+            medium = copy.deepcopy(medium)
+            medium["position"] = str(len(release["medium-list"]) + 1)
+            if copy_number > 0:
+                medium["disc-list"] = []
+            for track in medium["track-list"]:
+                recording = track["recording"]
+                recording["id"] = "%s-%d" % (recording["id"], copy_number)
+            release["medium-list"].append(medium)
+    return release
+
+def track_count(release):
+    return sum(len(medium["track-list"]) for medium in release["medium-list"])
+
+def bench_release():
+    """construction of the release model"""
+    isrcsubmit = load_isrcsubmit()
+    releases = box_set_releases()
+    seconds = best_time(lambda: [isrcsubmit.Release(release)
+                                 for release in releases])
+    print_time("box set disc releases", seconds)
+    record("release/box set disc releases", seconds)
+    times = []
+    counts = []
+    for copies in MEDIA_COPIES:
+        release = synthetic_box_set(copies)
+        counts.append(track_count(release))
+        seconds = best_time(isrcsubmit.Release, release)
+        times.append(seconds)
+        name = "%d media" % len(release["medium-list"])
+        print_time(name, seconds, counts[-1])
+        record("release/%s" % name, seconds)
+    return check_growth(times, counts)
+
+def time_checks(release, backend_output):
+    """Returns the best times of the local and the global duplicate check"""
+    isrcsubmit = load_isrcsubmit()
+    release = isrcsubmit.Release(release)
+    medium = release.media_with_disc_id(BOX_SET_DISC)[0]
+    local_times = []
+    global_times = []
+    with quiet():
+        for i in range(REPEAT):
+            start = time.time()
+            isrcs = isrcsubmit.check_isrcs_local(backend_output, medium)[0]
+            local_times.append(time.time() - start)
+            start = time.time()
+            isrcsubmit.check_global_duplicates(release, isrcs)
+            global_times.append(time.time() - start)
+    return min(local_times), min(global_times)
+
+def bench_checks():
+    """local and release wide duplicate checks on the box set"""
+    isrcsubmit = load_isrcsubmit()
+    with open("%s%s_cdrdao.toc" % (TEST_DATA, BOX_SET_DISC)) as toc:
+        backend_output = list(isrcsubmit.parse_cdrdao_toc(toc.readlines()))
+    times = []
+    counts = []
+    for copies in MEDIA_COPIES:
+        release = synthetic_box_set(copies)
+        counts.append(track_count(release))
+        local_seconds, global_seconds = time_checks(release, backend_output)
+        times.append(global_seconds)
+        name = "%d media" % len(release["medium-list"])
+        print_time("%s local" % name, local_seconds)
+        print_time("%s global" % name, global_seconds, counts[-1])
+        record("checks/%s local" % name, local_seconds)
+        record("checks/%s global" % name, global_seconds)
+    return check_growth(times, counts)
+
+def bench_pipeline():
+    """discs per minute with the virtual backend and the local web service"""
+    import ws2_server
+    server = ws2_server.Server(ws2_server.gather_options(
+            ["ws2_server.py", "--port", "0", "--quiet", "--data", TEST_DATA]))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    work_dir = tempfile.mkdtemp()
+    try:
+        config_dir = os.path.join(work_dir, "isrcsubmit")
+        os.makedirs(config_dir)
+        with open(os.path.join(config_dir, "config"), "w") as config:
+            # the shared limit replaces the one of musicbrainzngs
+            config.write("[musicbrainz]\nrate_limit = %d\n"
+                         % PIPELINE_RATE_LIMIT)
+        manifest = os.path.join(work_dir, "manifest.jsonl")
+        with open(manifest, "w") as manifest_file:
+            for i in range(PIPELINE_DISCS):
+                recording = PIPELINE_RECORDINGS[i % len(PIPELINE_RECORDINGS)]
+                manifest_file.write(json.dumps(
+                        {"device": TEST_DATA + recording, "submit": False})
+                        + "\n")
+        env = dict(os.environ, XDG_CONFIG_HOME=work_dir)
+        seconds = None
+        for i in range(REPEAT):
+            start = time.time()
+            proc = Popen([sys.executable, SCRIPT_NAME, "--backend", "virtual",
+                          "--server",
+                          "localhost:%d" % server.server_address[1],
+                          "--no-cache", "--manifest", manifest],
+                         stdout=PIPE, stderr=PIPE, env=env)
+            output, errors = proc.communicate()
+            run_seconds = time.time() - start
+            done = len(output.splitlines())
+            if proc.returncode != 0 or done != PIPELINE_DISCS:
+                print("%d of %d discs processed:" % (done, PIPELINE_DISCS))
+                print(errors.decode().strip())
+                return False
+            if seconds is None or run_seconds < seconds:
+                seconds = run_seconds
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        shutil.rmtree(work_dir)
+    print("%-24s %8.1f     (%.1f ms per disc)"
+          % ("discs per minute", PIPELINE_DISCS * 60 / seconds,
+             seconds * 1000 / PIPELINE_DISCS))
+    record("pipeline/seconds per disc", seconds / PIPELINE_DISCS)
+    return True
+
+
+BENCHMARKS = {
+    "checks": bench_checks,
+    "duplicates": bench_duplicates,
+    "parsing": bench_parsing,
+    "pipeline": bench_pipeline,
+    "release": bench_release,
+    "startup": bench_startup,
+}
+
+def save_results(file_name):
+    data = {"time": time.time(), "python": platform.python_version(),
+            "machine": platform.machine(), "results": results}
+    with open(file_name, "w") as results_file:
+        json.dump(data, results_file, indent=2, sort_keys=True)
+
+def comparison(name, baseline):
+    """Returns the ratio to the baseline and the verdict for a measurement
+
+    Only a slowdown over both REGRESSION_BUDGET and REGRESSION_SLACK
+    counts, smaller differences are noise.
+    """
+    ratio = results[name] / baseline[name]
+    if max(results[name], baseline[name]) < NOISE_FLOOR:
+        return ratio, "too short"
+    elif (ratio > REGRESSION_BUDGET
+            and results[name] - baseline[name] > REGRESSION_SLACK):
+        return ratio, "slower"
+    else:
+        return ratio, "ok"
+
+def slower_benchmarks(baseline):
+    """Returns the names of the benchmarks with a measurement slower
+    than the baseline"""
+    return sorted(set(name.split("/")[0] for name in results
+                      if baseline.get(name)
+                      and comparison(name, baseline)[1] == "slower"))
+
+def compare_results(file_name):
+    """Compare the results to the baseline, True if nothing got slower
+
+    Benchmarks that seem slower are run again a few times
+    and the best results are compared, so a busy moment doesn't count.
+    """
+    with open(file_name) as baseline_file:
+        baseline = json.load(baseline_file)["results"]
+    for i in range(RECHECKS):
+        names = slower_benchmarks(baseline)
+        if not names:
+            break
+        print("running again: %s" % ", ".join(names))
+        with open(os.devnull, "w") as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                for name in names:
+                    BENCHMARKS[name]()
+            finally:
+                sys.stdout = stdout
+    ok = True
+    print("compared to %s:" % file_name)
+    for name in sorted(results):
+        if not baseline.get(name):
+            continue
+        ratio, result = comparison(name, baseline)
+        if result == "slower":
+            ok = False
+        print("%-40s %6.2f x  %s" % (name, ratio, result))
+    return ok
+
+def main(argv):
+    global REPEAT
+    parser = OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("--save", metavar="FILE",
+            help="Save the results as JSON.")
+    parser.add_option("--baseline", metavar="FILE",
+            help="Compare the results to those saved in FILE.")
+    parser.add_option("--repeat", metavar="N", type="int", default=REPEAT,
+            help="Use the best of N runs for every measurement."
+            " Default: %d" % REPEAT)
+    options, names = parser.parse_args(argv[1:])
+    if options.repeat < 1:
+        parser.error("--repeat needs at least 1 run")
+    REPEAT = options.repeat
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % name)
+    ok = True
+    for name in names or sorted(BENCHMARKS):
+        print("%s: %s" % (name, BENCHMARKS[name].__doc__))
+        if not BENCHMARKS[name]():
+            ok = False
+        print("")
+    if options.save:
+        save_results(options.save)
+    if options.baseline:
+        if not compare_results(options.baseline):
+            ok = False
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
+
+
+# vim:set shiftwidth=4 smarttab expandtab:
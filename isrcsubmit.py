@@ -24,8 +24,42 @@ https://github.com/JonnyJD/musicbrainz-isrcsubmit
 __version__ = "3.0.0-dev"
 AGENT_NAME = "isrcsubmit.py"
 DEFAULT_SERVER = "musicbrainz.org"
+# web service responses are reused for this many seconds
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+# number of web service responses kept in the cache
+DEFAULT_CACHE_SIZE = 1000
+# maximum number of recordings in one ISRC submission
+DEFAULT_BATCH_SIZE = 100
+# requests per second for all processes together
+DEFAULT_RATE_LIMIT = 1.0
+# slowest pace (seconds per request) after rate limiting responses
+MAX_REQUEST_INTERVAL = 30.0
+# additional attempts for requests refused with 503
+RATE_LIMIT_RETRIES = 2
+# attempts and seconds between attempts when flushing the spool
+SPOOL_RETRIES = 3
+SPOOL_RETRY_DELAY = 10
+# bytes, a bigger spool is compacted when an entry is done
+SPOOL_COMPACT_SIZE = 64 * 1024
+# score difference between the best and the second best release
+# needed to choose a release for an ambiguous disc ID automatically
+DEFAULT_MIN_CONFIDENCE = 2.0
+# parallel ISRC lookups, the rate limit still applies
+ISRC_LOOKUP_WORKERS = 4
+# what to do in headless mode with ambiguous and unknown disc IDs
+AMBIGUOUS_POLICIES = ["auto", "best", "skip"]
+UNKNOWN_POLICIES = ["skip", "toc"]
+# maximum average difference per track (seconds) for the "toc" policy
+TOC_MATCH_TOLERANCE = 1.0
+# needed for the lookup by TOC
+MIN_MUSICBRAINZNGS_VERSION = (0, 5)
+# version of the capture file format
+CAPTURE_FORMAT = 1
+# captures loaded ahead of the disc processed
+CAPTURE_PREFETCH = 8
 # starting with highest priority
-BACKENDS = ["mediatools", "media_info", "cdrdao", "libdiscid", "discisrc"]
+BACKENDS = ["mediatools", "media_info", "cdrdao", "libdiscid", "discisrc",
+            "virtual"]
 BROWSERS = ["xdg-open", "x-www-browser",
             "firefox", "chromium", "chrome", "opera"]
 # The webbrowser module is used when nothing is found in this list.
@@ -34,38 +68,104 @@ BROWSERS = ["xdg-open", "x-www-browser",
 import os
 import re
 import sys
+import gzip
+import html
+import json
+import time
+import zlib
+import base64
+import pickle
+import random
+import shutil
 import codecs
+import pstats
+import sqlite3
+import cProfile
 import logging
 import getpass
+import hashlib
+import pathlib
 import tempfile
-import webbrowser
+import importlib
+import threading
+from concurrent import futures
 from datetime import datetime
+from collections import deque
+from contextlib import closing, contextmanager
 from optparse import OptionParser
-from subprocess import Popen, PIPE, call
+from subprocess import Popen, PIPE
 
-try:
-    import discid
-    from discid import DiscError
-except ImportError:
+
+class LazyModule(object):
+    """A module that is only imported when it is first used.
+
+    The loader is called on first attribute access and returns the module.
+    Setting attributes is passed on to the module as well.
+    This keeps the startup fast when a module isn't needed at all.
+    """
+
+    def __init__(self, loader):
+        object.__setattr__(self, "_loader", loader)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        if self._module is None:
+            object.__setattr__(self, "_module", self._loader())
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+def lazy_import(name):
+    return LazyModule(lambda: importlib.import_module(name))
+
+def import_discid():
     try:
-        from libdiscid.compat import discid
-        from libdiscid.compat.discid import DiscError
-    except ImportError:
-        # When both are not available, raise exception for python-discid
         import discid
+    except ImportError:
+        try:
+            from libdiscid.compat import discid
+        except ImportError:
+            # When both are not available, raise exception for python-discid
+            import discid
+    return discid
+
+def musicbrainzngs_version():
+    """Returns the version of musicbrainzngs as a tuple of numbers"""
+    version = musicbrainzngs.musicbrainz._version
+    return tuple(int(part) for part in re.findall(r"\d+", version))
+
+def import_keyring():
+    """Returns the keyring module or None if it isn't available"""
+    try:
+        import keyring
+    except ImportError:
+        keyring = None
+    return keyring
 
-import musicbrainzngs
-from musicbrainzngs import AuthenticationError, ResponseError, WebServiceError
+# these are slow to import and not needed for every run,
+# keyring is only imported when a password is needed
+discid = LazyModule(import_discid)
+musicbrainzngs = lazy_import("musicbrainzngs")
+webbrowser = lazy_import("webbrowser")
 
 try:
-    import keyring
+    from configparser import ConfigParser
 except ImportError:
-    keyring = None
+    from ConfigParser import ConfigParser
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
 
 try:
-    from configparser import ConfigParser
+    import queue
 except ImportError:
-    from ConfigParser import ConfigParser
+    import Queue as queue
 
 if os.name == "nt":
     SHELLNAME = "isrcsubmit.bat"
@@ -78,18 +178,32 @@ else:
 
 # make code run on Python 2 and 3
 try:
-    user_input = raw_input
+    _input = raw_input
 except NameError:
-    user_input = input
+    _input = input
 
 try:
     unicode_string = unicode
 except NameError:
     unicode_string = str
 
+def user_input(prompt=""):
+    """Read a line from the user, the waiting is timed as prompt"""
+    with timed("prompt"):
+        return _input(prompt)
+
 # global variables
 options = None
+session_timings = None
+profiled_discs = []
+thread_profilers = None     # a list while --cprofile is used
+_timing_context = threading.local()
+main_thread = threading.current_thread()
 ws2 = None
+batch = None
+spool = None
+choices = None
+program_resolver = None
 logger = logging.getLogger("isrcsubmit")
 
 def script_version():
@@ -117,16 +231,33 @@ def print_usage(option=None, opt=None, value=None, parser=None):
     parser.print_help()
     sys.exit(0)
 
+class DiscSkipped(Exception):
+    """A disc can't be handled without asking the user (headless mode)"""
+    def __init__(self, reason, url=None):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.url = url
+
+
 class Isrc(object):
     def __init__(self, isrc, track=None):
         self._id = isrc
         self._tracks = []
+        self._track_ids = set()
+        self._own_track_ids = set()
         if track is not None:
-            self._tracks.append(track)
+            self.add_track(track)
 
-    def add_track(self, track):
-        if track not in self._tracks:
+    def add_track(self, track, own=False):
+        """Add a track with this ISRC, own tracks were found on our disc"""
+        if track.id not in self._track_ids:
+            self._track_ids.add(track.id)
             self._tracks.append(track)
+        if own:
+            self._own_track_ids.add(track.id)
+
+    def is_own(self, track):
+        return track.id in self._own_track_ids
 
     def get_tracks(self):
         return self._tracks
@@ -134,41 +265,133 @@ class Isrc(object):
     def get_track_numbers(self):
         numbers = []
         for track in self._tracks:
-            numbers.append(track["position"])
+            numbers.append(str(track.position))
         return ", ".join(numbers)
 
 
-class Track(dict):
-    """track with equality checking
+class Track(object):
+    """A recording at a position on a medium
 
-    This makes it easy to check if this track is already in a collection.
-    Only the element already in the collection needs to be hashable.
+    The ID is the one of the recording, since ISRCs belong to recordings.
     """
-    def __init__(self, track, number=None):
-        self._track = track
-        self._recording = track["recording"]
-        self._number = number
-        # check that we found the track with the correct number
-        assert(int(self._track["position"]) == self._number)
-
-    def __eq__(self, other):
-        return self["id"] == other["id"]
-
-    def __getitem__(self, item):
-        try:
-            return self._recording[item]
-        except KeyError:
-            return self._track[item]
-
-    def get(self, item, default=None):
-        try:
-            return self._recording.get(item, default)
-        except KeyError:
-            return self._track.get(item, default)
-
-class OwnTrack(Track):
-    """A track found on an analyzed (own) disc"""
-    pass
+    __slots__ = ("id", "position", "medium", "title", "artist", "length",
+                 "isrcs")
+
+    def __init__(self, data, medium_position):
+        recording = data.get("recording", {})
+        self.id = recording.get("id")
+        self.position = int(data["position"])
+        self.medium = medium_position
+        self.title = recording.get("title") or data.get("title")
+        self.artist = recording.get("artist-credit-phrase")
+        length = data.get("length") or recording.get("length")
+        self.length = int(length) if length else None
+        self.isrcs = tuple(recording.get("isrc-list", ()))
+
+class Medium(object):
+    __slots__ = ("position", "format", "disc_ids", "tracks", "_by_position")
+
+    def __init__(self, data):
+        self.position = int(data.get("position", 1))
+        self.format = data.get("format")
+        self.disc_ids = frozenset([disc["id"]
+                                   for disc in data.get("disc-list", [])])
+        self.tracks = tuple([Track(track, self.position)
+                             for track in data.get("track-list", [])])
+        self._by_position = dict([(track.position, track)
+                                  for track in self.tracks])
+
+    def track(self, position):
+        """Returns the track at the position or None"""
+        return self._by_position.get(position)
+
+class Release(object):
+    """A release parsed once from a web service response
+
+    The media are indexed by disc ID and the tracks by ISRC.
+    """
+    __slots__ = ("id", "title", "artist", "status", "date", "country",
+                 "barcode", "catalog_numbers", "media",
+                 "_by_disc_id", "_by_isrc", "_by_recording", "_attached")
+
+    def __init__(self, data):
+        self.id = data.get("id")
+        self.title = data.get("title")
+        self.artist = data.get("artist-credit-phrase")
+        self.status = data.get("status")
+        self.date = data.get("date")
+        self.country = data.get("country")
+        self.barcode = data.get("barcode")
+        self.catalog_numbers = tuple([
+                label["catalog-number"]
+                for label in data.get("label-info-list", [])
+                if label.get("catalog-number")])
+        self.media = tuple([Medium(medium)
+                            for medium in data.get("medium-list", [])])
+        self._by_disc_id = dict()
+        self._by_isrc = dict()
+        self._by_recording = dict()
+        self._attached = []
+        for medium in self.media:
+            for disc_id in medium.disc_ids:
+                self._by_disc_id.setdefault(disc_id, []).append(medium)
+            for track in medium.tracks:
+                self._by_recording.setdefault(track.id, []).append(track)
+                for isrc in track.isrcs:
+                    self._by_isrc.setdefault(isrc, []).append(track)
+
+    def media_with_disc_id(self, disc_id):
+        return self._by_disc_id.get(disc_id, [])
+
+    def tracks_with_isrc(self, isrc):
+        return self._by_isrc.get(isrc, [])
+
+    def has_recording(self, recording_id):
+        return recording_id in self._by_recording
+
+    def attached_isrcs(self):
+        """Returns the ISRCs added with attach_isrcs"""
+        return list(self._attached)
+
+    def attach_isrcs(self, tracks2isrcs):
+        """Add ISRCs (by recording ID) that are submitted in this session"""
+        self._attached.append(tracks2isrcs)
+        for recording_id, isrc in tracks2isrcs.items():
+            for track in self._by_recording.get(recording_id, []):
+                if isrc not in track.isrcs:
+                    track.isrcs += (isrc,)
+                    self._by_isrc.setdefault(isrc, []).append(track)
+
+# releases parsed in this session, by release ID, with the includes
+_releases = dict()
+_releases_lock = threading.Lock()
+
+def parse_release(data, includes=()):
+    """Returns the Release for a release from the web service.
+
+    Each release is only parsed once per session and shared by all discs,
+    so ISRCs submitted for one disc are known when checking the others.
+    A release parsed from a response without all the includes
+    is parsed again, the ISRCs submitted meanwhile are kept.
+    """
+    release_id = data.get("id")
+    if release_id is None:
+        # a stub
+        return Release(data)
+    includes = frozenset(includes)
+    with _releases_lock:
+        if release_id in _releases:
+            parsed_includes, release = _releases[release_id]
+            if includes <= parsed_includes:
+                return release
+            attached = release.attached_isrcs()
+        else:
+            attached = []
+        release = Release(data)
+        for tracks2isrcs in attached:
+            release.attach_isrcs(tracks2isrcs)
+        _releases[release_id] = (includes, release)
+        return release
 
 def get_config_home():
     """Returns the base directory for isrcsubmit's configuration files."""
@@ -186,16 +409,43 @@ def config_path():
 
     return os.path.join(get_config_home(), "config")
 
-def gather_options(argv):
-    global options
+def cache_path():
+    """Returns the location of the web service cache."""
+
+    return os.path.join(get_config_home(), "cache.sqlite")
+
+def programs_path():
+    """Returns the location of the saved program locations."""
+
+    return os.path.join(get_config_home(), "programs.json")
+
+def rate_limit_path(server):
+    """Returns the location of the rate limiter state for a server."""
+
+    name = re.sub(r"[^\w.-]", "_", server)
+    return os.path.join(get_config_home(), "ratelimit-%s" % name)
+
+def spool_path():
+    """Returns the location of the submission spool."""
+
+    return os.path.join(get_config_home(), "spool")
+
+def choices_path():
+    """Returns the location of the releases chosen for disc IDs."""
+
+    return os.path.join(get_config_home(), "choices")
 
+def get_default_device():
     if sys.platform == "darwin":
         # That is the device drutil expects and stable
         # /dev/rdisk1 etc. change with multiple hard disks, dmgs mounted etc.
         # libdiscid < 0.6.0 can't handle drive numbers
-        default_device = "1"
+        return "1"
     else:
-        default_device = discid.get_default_device()
+        return discid.get_default_device()
+
+def gather_options(argv):
+    global options
 
     config = ConfigParser()
     config.read(config_path())
@@ -211,9 +461,12 @@ def gather_options(argv):
     parser.add_option("-u", "--user", metavar="USERNAME",
             help="MusicBrainz username, if not given as argument.")
     # note that -d previously stand for debug
-    parser.add_option("-d", "--device", metavar="DEVICE",
+    parser.add_option("-d", "--device", metavar="DEVICE", action="append",
+            dest="devices",
+            # libdiscid isn't loaded just to name the default drive
             help="CD device with a loaded audio cd, if not given as argument."
-            + " The default is %s." % default_device)
+            + " The default is the system's default drive."
+            + " Can be given multiple times to read several drives at once.")
     parser.add_option("--release-id", metavar="RELEASE_ID",
             help="Optional MusicBrainz ID of the release."
             + " This will be gathered if not given.")
@@ -231,20 +484,84 @@ def gather_options(argv):
     parser.add_option("--debug", action="store_true", default=False,
             help="Show debug messages."
             + " Currently shows some backend messages.")
+    parser.add_option("--auto-select", action="store_true",
+            dest="auto_select",
+            help="Choose a release for ambiguous disc IDs automatically"
+            " if the choice is clear.")
+    parser.add_option("--min-confidence", type="float", metavar="SCORE",
+            help="Score difference needed to choose a release"
+            " automatically. Default: %.1f" % DEFAULT_MIN_CONFIDENCE)
+    parser.add_option("--cleanup-report", action="store_true",
+            dest="cleanup_report",
+            help="Show all duplicate ISRCs in one report in the browser"
+            " instead of one at a time.")
+    parser.add_option("--isrc-lookup", action="store_true",
+            dest="isrc_lookup",
+            help="Look up the ISRCs to show other recordings with them.")
+    parser.add_option("--forget-choice", action="store_true", default=False,
+            help="Ask again which release to use"
+            " for disc IDs a release was chosen for before.")
+    parser.add_option("--batch-submit", action="store_true", default=False,
+            help="Submit the ISRCs of all discs together at the end.")
+    parser.add_option("--batch-size", type="int", metavar="NUMBER",
+            help="Maximum number of recordings in one submission"
+            " with --batch-submit. Default: %d" % DEFAULT_BATCH_SIZE)
+    parser.add_option("--flush-spool", action="store_true", default=False,
+            help="Submit ISRCs that couldn't be sent before and exit.")
+    parser.add_option("--no-cache", action="store_false", dest="cache",
+            default=True,
+            help="Don't use or update the cache of web service responses.")
+    parser.add_option("--refresh", action="store_true", default=False,
+            help="Fetch fresh web service responses and update the cache.")
+    parser.add_option("--profile", metavar="FILE",
+            help="Write the time spent in each phase for every disc"
+            " to FILE as JSON.")
+    parser.add_option("--cprofile", metavar="FILE",
+            help="Write the statistics of the Python profiler to FILE,"
+            " including the worker threads.")
+    parser.add_option("--virtual-latency", metavar="SECONDS", type="float",
+            default=0.0,
+            help="Time the virtual backend takes to read the TOC"
+            " and each track. Default: 0")
+    parser.add_option("--virtual-errors", metavar="RATE", type="float",
+            default=0.0,
+            help="Part of the reads of the virtual backend that fail,"
+            " between 0 and 1. Default: 0")
+    parser.add_option("--capture", metavar="DIRECTORY",
+            help="Save the TOC and the backend output of every disc read"
+            " in the directory.")
+    parser.add_option("--ingest", metavar="PATH", action="append",
+            help="Process captured discs instead of reading drives, without"
+            " asking. PATH is a capture or a directory with captures."
+            " Can be given multiple times.")
+    parser.add_option("--manifest", metavar="FILE",
+            help="Process the discs listed in the manifest without asking."
+            " Use - to read it from stdin.")
+    parser.add_option("--submit", action="store_true", dest="auto_submit",
+            default=False,
+            help="Submit new ISRCs with --manifest or --ingest, unless a job"
+            " of the manifest sets submit.")
+    parser.add_option("--results", metavar="FILE", default="-",
+            help="Write the results of --manifest to this file as JSON lines."
+            " Default: stdout")
     parser.add_option("--keyring", action="store_true", dest="keyring",
             help="Use keyring if available.")
     parser.add_option("--no-keyring", action="store_false", dest="keyring",
             help="Disable keyring.")
     (options, args) = parser.parse_args(argv[1:])
 
-    print("%s" % script_version())
+    if options.manifest is None and options.ingest is None:
+        print("%s" % script_version())
+    else:
+        # stdout is used for the results
+        sys.stderr.write("%s\n" % script_version())
 
     # assign positional arguments to options
     if options.user is None and args:
         options.user = args[0]
         args = args[1:]
-    if options.device is None and args:
-        options.device = args[0]
+    if options.devices is None and args:
+        options.devices = [args[0]]
         args = args[1:]
     if args:
         logger.warning("Superfluous arguments: %s", ", ".join(args))
@@ -259,60 +576,95 @@ def gather_options(argv):
             print_error("Backend given in config file is not a valid choice.",
                         "Choose a backend from %s" % ", ".join(BACKENDS))
             sys.exit(-1)
+    if (options.auto_select is None
+            and config.has_option("general", "auto_select")):
+        options.auto_select = config.getboolean("general", "auto_select")
+    if options.min_confidence is None:
+        if config.has_option("general", "min_confidence"):
+            options.min_confidence = config.getfloat("general",
+                                                     "min_confidence")
+        else:
+            options.min_confidence = DEFAULT_MIN_CONFIDENCE
+    if (options.cleanup_report is None
+            and config.has_option("general", "cleanup_report")):
+        options.cleanup_report = config.getboolean("general",
+                                                   "cleanup_report")
     if options.browser is None and config.has_option("general", "browser"):
         options.browser = config.get("general", "browser")
-    if options.device is None and config.has_option("general", "device"):
-        options.device = config.get("general", "device")
+    if options.devices is None and config.has_option("general", "device"):
+        options.devices = [config.get("general", "device")]
     if options.server is None and config.has_option("musicbrainz", "server"):
         options.server = config.get("musicbrainz", "server")
     if options.user is None and config.has_option("musicbrainz", "user"):
         options.user = config.get("musicbrainz", "user")
+    if (options.isrc_lookup is None
+            and config.has_option("musicbrainz", "isrc_lookup")):
+        options.isrc_lookup = config.getboolean("musicbrainz", "isrc_lookup")
+    if options.batch_size is None:
+        if config.has_option("musicbrainz", "batch_size"):
+            options.batch_size = config.getint("musicbrainz", "batch_size")
+        else:
+            options.batch_size = DEFAULT_BATCH_SIZE
+    options.rate_limit = DEFAULT_RATE_LIMIT
+    if config.has_option("musicbrainz", "rate_limit"):
+        options.rate_limit = config.getfloat("musicbrainz", "rate_limit")
+    options.cache_ttl = DEFAULT_CACHE_TTL
+    if config.has_option("cache", "ttl"):
+        options.cache_ttl = config.getint("cache", "ttl")
+    options.cache_size = DEFAULT_CACHE_SIZE
+    if config.has_option("cache", "size"):
+        options.cache_size = config.getint("cache", "size")
 
     # assign remaining options automatically
-    if options.device is None:
-        options.device = default_device
-    options.sane_which = test_which()
+    if options.devices is None and (options.flush_spool or options.ingest):
+        # no drive is used, libdiscid isn't needed
+        options.devices = [None]
+    elif options.devices is None:
+        options.devices = [get_default_device()]
+    else:
+        # the same drive can't be read twice at the same time
+        devices = []
+        for device in options.devices:
+            if device not in devices:
+                devices.append(device)
+        options.devices = devices
+    options.device = options.devices[0]
+    # headless mode, the settings are set for every job of the manifest
+    options.headless = bool(options.manifest or options.ingest)
+    if options.manifest and options.ingest:
+        print_error("A manifest and captures can't be used together.")
+        sys.exit(-1)
+    options.ambiguous = options.unknown = None
+    options.submit = False
+    if options.release_id and len(options.devices) > 1:
+        print_error("A release ID can only be given for a single device.")
+        sys.exit(-1)
     if options.browser is None:
         options.browser = find_browser()
     if options.server is None:
         options.server = DEFAULT_SERVER
     if options.keyring is None:
         options.keyring = True
-    if options.backend and not has_program(options.backend, strict=True):
+    if options.flush_spool or options.ingest:
+        # no disc is read
+        pass
+    elif options.backend and not has_program(options.backend, strict=True):
         print_error("Chosen backend not found. No ISRC extraction possible!",
                     "Make sure that %s is installed." % options.backend)
         sys.exit(-1)
     elif not options.backend:
         options.backend = find_backend()
+    if program_resolver is not None:
+        program_resolver.save()
 
     return options
 
 
-def test_which():
-    """There are some old/buggy "which" versions on Windows.
-    We want to know if the user has a "sane" which we can trust.
-    Unxutils has a broken 2.4 version. Which >= 2.16 should be fine.
-    """
-    with open(os.devnull, "w") as devnull:
-        try:
-            # "which" should at least find itself
-            return_code = call(["which", "which"],
-                               stdout=devnull, stderr=devnull)
-        except OSError:
-            return False        # no which at all
-        else:
-            if (return_code == 0):
-                return True
-            else:
-                print('warning: your version of the tool "which"'
-                      ' is buggy/outdated')
-                if os.name == "nt":
-                    print('         unxutils is old/broken, GnuWin32 is good.')
-                return False
-
 def get_prog_version(prog):
     if prog == "libdiscid":
         version = discid.LIBDISCID_VERSION_STRING
+    elif prog == "virtual":
+        version = "virtual drive"
     elif prog == "cdrdao":
         outdata = Popen([prog], stderr=PIPE).communicate()[1]
         version = b" ".join(outdata.splitlines()[0].split()[::2][0:2])
@@ -321,41 +673,116 @@ def get_prog_version(prog):
 
     return decode(version)
 
+class ProgramResolver(object):
+    """Finds programs in the PATH without starting any processes.
+
+    The results are saved and reused as long as the PATH,
+    the modification times of its directories
+    and of the programs found don't change.
+    """
+
+    def __init__(self, cache_file=None):
+        self._cache_file = cache_file
+        self._search_path = os.environ.get("PATH", os.defpath)
+        self._programs = None   # name -> [path, mtime] or None
+        self._changed = False
+
+    def _signature(self):
+        directories = dict()
+        for directory in self._search_path.split(os.pathsep):
+            try:
+                directories[directory] = os.stat(directory).st_mtime
+            except OSError:
+                directories[directory] = None
+        return {"path": self._search_path,
+                "pathext": os.environ.get("PATHEXT"),
+                "directories": directories}
+
+    def _load(self):
+        self._programs = dict()
+        self._signature_data = self._signature()
+        if self._cache_file is None:
+            return
+        try:
+            with open(self._cache_file, "r") as cache_file:
+                data = json.load(cache_file)
+        except (IOError, ValueError):
+            return
+        if data.get("signature") != self._signature_data:
+            logger.debug("PATH changed, searching programs again")
+            return
+        for name, entry in data.get("programs", {}).items():
+            if entry is not None:
+                try:
+                    if os.stat(entry[0]).st_mtime != entry[1]:
+                        continue
+                except OSError:
+                    continue
+            self._programs[name] = entry
+
+    def find(self, program):
+        """Returns the full path of the program or None"""
+        if self._programs is None:
+            self._load()
+        if program not in self._programs:
+            path = shutil.which(program, path=self._search_path)
+            if path is None:
+                self._programs[program] = None
+            else:
+                self._programs[program] = [path, os.stat(path).st_mtime]
+            self._changed = True
+        entry = self._programs[program]
+        if entry is None:
+            return None
+        return entry[0]
+
+    def save(self):
+        if not self._changed or self._cache_file is None:
+            return
+        try:
+            directory = os.path.dirname(self._cache_file)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self._cache_file, "w") as cache_file:
+                json.dump({"signature": self._signature_data,
+                           "programs": self._programs}, cache_file)
+            self._changed = False
+        except (IOError, OSError) as err:
+            logger.warning("Couldn't save program locations: %s", err)
+
+def find_program(program):
+    """Returns the full path of the program or None"""
+    global program_resolver
+    if program_resolver is None:
+        program_resolver = ProgramResolver(programs_path())
+    return program_resolver.find(program)
+
 def has_program(program, strict=False):
     """When the backend is only a symlink to another backend,
        we will return False, unless we strictly want to use this backend.
     """
     if program == "libdiscid":
         return "isrc" in discid.FEATURES
-
-    with open(os.devnull, "w") as devnull:
-        if options.sane_which:
-            p_which = Popen(["which", program], stdout=PIPE, stderr=devnull)
-            program_path = p_which.communicate()[0].strip()
-            if p_which.returncode == 0:
-                # check if it is only a symlink to another backend
-                real_program = os.path.basename(os.path.realpath(program_path))
-                if program != real_program and (
-                        real_program in BACKENDS or real_program in BROWSERS):
-                    if strict:
-                        print("WARNING: %s is a symlink to %s"
-                              % (program, real_program))
-                        return True
-                    else:
-                        return False # use real program (target) instead
-                return True
-            else:
-                return False
-        elif program in BACKENDS:
-            try:
-                # we just try to start these non-interactive console apps
-                call([program], stdout=devnull, stderr=devnull)
-            except OSError:
-                return False
-            else:
-                return True
+    if program == "virtual":
+        # never found, only used when chosen
+        return strict
+
+    program_path = find_program(program)
+    if program_path is None:
+        return False
+    # check if it is only a symlink to another backend
+    real_program = os.path.basename(os.path.realpath(program_path))
+    if os.name == "nt":
+        real_program = os.path.splitext(real_program)[0]
+    if program != real_program and (
+            real_program in BACKENDS or real_program in BROWSERS):
+        if strict:
+            print("WARNING: %s is a symlink to %s"
+                  % (program, real_program))
+            return True
         else:
-            return False
+            return False # use real program (target) instead
+    return True
 
 def find_backend():
     """search for an available backend
@@ -503,33 +930,26 @@ def print_release(release, position=None):
     If the position is given, this should be an entry
     in a list of releases (choice)
     """
-    country = (release.get("country") or "").ljust(2)
-    date = (release.get("date") or "").ljust(10)
-    barcode = (release.get("barcode") or "").rjust(13)
-    label_list = release["label-info-list"]
-    catnumber_list = []
-    for label in label_list:
-        cat_number = label.get("catalog-number")
-        if cat_number:
-            catnumber_list.append(cat_number)
-    catnumbers = ", ".join(catnumber_list)
+    country = (release.country or "").ljust(2)
+    date = (release.date or "").ljust(10)
+    barcode = (release.barcode or "").rjust(13)
+    catnumbers = ", ".join(release.catalog_numbers)
 
     if position is None:
-        print_encoded("Artist:\t\t%s\n" % release["artist-credit-phrase"])
-        print_encoded("Release:\t%s" % release["title"])
+        print_encoded("Artist:\t\t%s\n" % release.artist)
+        print_encoded("Release:\t%s" % release.title)
     else:
         print_encoded("%#2d:" % position)
-        print_encoded("%s - %s" % (
-                      release["artist-credit-phrase"], release["title"]))
-    if release.get("status"):
-        print("(%s)" % release["status"])
+        print_encoded("%s - %s" % (release.artist, release.title))
+    if release.status:
+        print("(%s)" % release.status)
     else:
         print("")
     if position is None:
         print_encoded("Release Event:\t%s\t%s\n" % (date, country))
-        print_encoded("Barcode:\t%s\n" % release.get("barcode") or "")
+        print_encoded("Barcode:\t%s\n" % (release.barcode or ""))
         print_encoded("Catalog No.:\t%s\n" % catnumbers)
-        print_encoded("MusicBrainz ID:\t%s\n" % release["id"])
+        print_encoded("MusicBrainz ID:\t%s\n" % release.id)
     else:
         print_encoded("\t%s\t%s\t%s\t%s\n" % (
                       country, date, barcode, catnumbers))
@@ -552,125 +972,1055 @@ def ask_for_submission(url, print_url=False):
         submit_requested = user_input(" [y/N] ").lower() == "y"
 
     if submit_requested:
+        if len(options.devices) > 1:
+            # don't replace the process, other drives are still handled
+            open_browser(url, submit=True)
+            sys.exit(1)
         open_browser(url, exit=True, submit=True)
     elif print_url:
         print("Please submit the Disc ID with this url:")
         print(url)
 
+class WebServiceCache(object):
+    """A persistent cache for web service responses.
+
+    Entries are only used for ttl seconds.
+    When there are more than size entries,
+    the least recently used ones are removed.
+    Problems with the cache file are logged and handled as a cache miss.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_CACHE_TTL, size=DEFAULT_CACHE_SIZE):
+        self._path = path
+        self._ttl = ttl
+        self._size = size
+
+    def _connect(self):
+        directory = os.path.dirname(self._path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # a new connection every time makes this usable from every thread
+        connection = sqlite3.connect(self._path, timeout=10)
+        connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                           " key TEXT PRIMARY KEY, releases TEXT,"
+                           " fetched REAL, used REAL, response TEXT)")
+        return connection
+
+    def get(self, key):
+        """Returns the cached response or None"""
+        now = time.time()
+        try:
+            with closing(self._connect()) as connection, connection:
+                row = connection.execute(
+                        "SELECT fetched, response FROM responses"
+                        " WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                if now - row[0] > self._ttl:
+                    connection.execute("DELETE FROM responses WHERE key = ?",
+                                       (key,))
+                    return None
+                connection.execute("UPDATE responses SET used = ?"
+                                   " WHERE key = ?", (now, key))
+                return json.loads(row[1])
+        except (sqlite3.Error, EnvironmentError, ValueError) as err:
+            logger.warning("Couldn't read from cache: %s", err)
+            return None
+
+    def put(self, key, response, release_ids=()):
+        """Store a response.
+
+        The release IDs are used to invalidate the entry
+        when the release is changed.
+        """
+        now = time.time()
+        releases = " ".join(release_ids)
+        try:
+            with closing(self._connect()) as connection, connection:
+                connection.execute(
+                        "INSERT OR REPLACE INTO responses"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (key, releases, now, now, json.dumps(response)))
+                connection.execute(
+                        "DELETE FROM responses WHERE key NOT IN"
+                        " (SELECT key FROM responses"
+                        "  ORDER BY used DESC LIMIT ?)", (self._size,))
+        except (sqlite3.Error, EnvironmentError) as err:
+            logger.warning("Couldn't write to cache: %s", err)
+
+    def invalidate_release(self, release_id):
+        """Remove all responses including the release"""
+        try:
+            with closing(self._connect()) as connection, connection:
+                connection.execute("DELETE FROM responses"
+                                   " WHERE releases LIKE ?",
+                                   ("%" + release_id + "%",))
+        except (sqlite3.Error, EnvironmentError) as err:
+            logger.warning("Couldn't write to cache: %s", err)
+
+
+class SubmissionBatch(object):
+    """Collects the ISRCs of several discs to submit them together.
+
+    The ISRCs of one disc are never split to different submissions,
+    so errors can always be attributed to the discs of one submission.
+    """
+
+    def __init__(self, size=DEFAULT_BATCH_SIZE):
+        self._size = size
+        self._items = []
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item, tracks2isrcs):
+        """Add the ISRCs of a disc, item is handed back with the results"""
+        self._items.append((item, tracks2isrcs))
+
+    def split(self):
+        """Returns lists of (item, tracks2isrcs),
+        each with at most size recordings.
+        """
+        parts = []
+        part = []
+        recordings = dict()
+        for item, tracks2isrcs in self._items:
+            # a recording can only have one new ISRC in a submission
+            conflict = False
+            for recording, isrc in tracks2isrcs.items():
+                if recordings.get(recording, isrc) != isrc:
+                    conflict = True
+                    break
+            if part and (conflict or
+                         len(recordings) + len(tracks2isrcs) > self._size):
+                parts.append(part)
+                part = []
+                recordings = dict()
+            part.append((item, tracks2isrcs))
+            recordings.update(tracks2isrcs)
+        if part:
+            parts.append(part)
+        return parts
+
+
+class JsonLinesFile(object):
+    """An append-only file with one JSON record per line.
+
+    Writers take a lock on a separate file,
+    which stays the same when the file itself is replaced.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    @contextmanager
+    def _locked(self):
+        directory = os.path.dirname(self._path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self._path + ".lock", "a+") as lock:
+            lock_file(lock)
+            try:
+                yield
+            finally:
+                unlock_file(lock)
+
+    def _append(self, record):
+        with self._locked():
+            self._write(record)
+
+    def _write(self, record):
+        """Append a record, the lock has to be held"""
+        with open(self._path, "a") as lines_file:
+            lines_file.write(json.dumps(record, sort_keys=True) + "\n")
+            lines_file.flush()
+            os.fsync(lines_file.fileno())
+
+    def _rewrite(self, records):
+        """Replace the file with the records, the lock has to be held"""
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w") as lines_file:
+            for record in records:
+                lines_file.write(json.dumps(record, sort_keys=True) + "\n")
+            lines_file.flush()
+            os.fsync(lines_file.fileno())
+        os.replace(tmp_path, self._path)
+
+    def _records(self):
+        try:
+            with open(self._path, "r") as lines_file:
+                for line in lines_file:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # an interrupted write, the rest is fine
+                        logger.warning("Ignoring broken line in %s",
+                                       self._path)
+        except IOError:
+            # no file yet
+            return
+
+
+class SubmissionSpool(JsonLinesFile):
+    """An append-only file with all ISRCs accepted for submission.
+
+    The ISRCs are written before they are sent
+    and marked as done afterwards, so nothing is lost on errors.
+    Entries are identified by their content, so duplicates are sent once.
+    """
+
+    def add(self, server, disc_id, release_id, tracks2isrcs):
+        """Record ISRCs to be sent, returns the entry ID"""
+        content = json.dumps([server, sorted(tracks2isrcs.items())])
+        entry_id = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        self._append({"id": entry_id, "time": time.time(), "server": server,
+                      "disc_id": disc_id, "release_id": release_id,
+                      "tracks2isrcs": tracks2isrcs})
+        return entry_id
+
+    def done(self, entry_id):
+        """Mark the entry as sent.
+
+        The spool is emptied when nothing is left to send
+        and compacted when it gets too big, so it doesn't grow forever.
+        """
+        with self._locked():
+            self._write({"done": entry_id})
+            entries = self.pending()
+            if not entries:
+                self._rewrite([])
+            elif os.path.getsize(self._path) > SPOOL_COMPACT_SIZE:
+                self._rewrite(entries)
+
+    def pending(self, server=None):
+        """Returns all entries not sent yet, without duplicates"""
+        entries = dict()
+        order = []
+        for record in self._records():
+            if "done" in record:
+                entries.pop(record["done"], None)
+            elif server is None or record["server"] == server:
+                if record["id"] not in entries:
+                    order.append(record["id"])
+                entries[record["id"]] = record
+        return [entries[entry_id] for entry_id in order
+                if entry_id in entries]
+
+    def compact(self):
+        """Rewrite the spool with only the entries not sent yet"""
+        with self._locked():
+            self._rewrite(self.pending())
+
+
+class ChoiceStore(JsonLinesFile):
+    """The releases chosen by the user for ambiguous disc IDs.
+
+    The file is read once and has one entry per disc ID,
+    it is rewritten when a choice is replaced or removed.
+    """
+
+    def __init__(self, path):
+        JsonLinesFile.__init__(self, path)
+        self._choices = None
+
+    def _read(self):
+        """Returns the entries by server and disc ID"""
+        choices = dict()
+        for record in self._records():
+            key = (record["server"], record["disc_id"])
+            if record["release_id"] is None:
+                # removed by older versions
+                choices.pop(key, None)
+            else:
+                choices[key] = record
+        return choices
+
+    def _update(self, server, disc_id, record):
+        with self._locked():
+            # other processes might have changed the file
+            self._choices = self._read()
+            key = (server, disc_id)
+            if record is not None and key not in self._choices:
+                self._choices[key] = record
+                self._write(record)
+                return
+            if record is None:
+                if key not in self._choices:
+                    return
+                del self._choices[key]
+            else:
+                self._choices[key] = record
+            self._rewrite(sorted(self._choices.values(),
+                                 key=lambda entry: entry["time"]))
+
+    def remember(self, server, disc_id, release_id, user=None):
+        self._update(server, disc_id,
+                     {"server": server, "disc_id": disc_id,
+                      "release_id": release_id, "user": user,
+                      "time": time.time()})
+
+    def forget(self, server, disc_id):
+        self._update(server, disc_id, None)
+
+    def get(self, server, disc_id):
+        """Returns the entry for the disc ID or None"""
+        if self._choices is None:
+            self._choices = self._read()
+        return self._choices.get((server, disc_id))
+
+
+def lock_file(file_object):
+    """Wait for an exclusive lock on an open file"""
+    if os.name == "nt":
+        file_object.seek(0)
+        while True:
+            try:
+                msvcrt.locking(file_object.fileno(), msvcrt.LK_LOCK, 1)
+            except IOError:
+                # LK_LOCK only tries for 10 seconds
+                continue
+            else:
+                break
+    else:
+        fcntl.flock(file_object.fileno(), fcntl.LOCK_EX)
+
+def unlock_file(file_object):
+    if os.name == "nt":
+        file_object.seek(0)
+        msvcrt.locking(file_object.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(file_object.fileno(), fcntl.LOCK_UN)
+
+
+class RateLimiter(object):
+    """A token bucket shared by all isrcsubmit processes on this host.
+
+    The state is kept in a small file and guarded by a lock on that file.
+    Submissions have priority, lookups wait while a submission is waiting.
+    After rate limiting responses the pace is slowed down
+    and recovers slowly with successful requests.
+    """
+
+    def __init__(self, path, rate=DEFAULT_RATE_LIMIT, burst=1):
+        self._path = path
+        self._interval = 1.0 / rate
+        self._burst = burst
+
+    @contextmanager
+    def _state(self):
+        directory = os.path.dirname(self._path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self._path, "a+") as state_file:
+            lock_file(state_file)
+            try:
+                state_file.seek(0)
+                try:
+                    state = json.loads(state_file.read())
+                except ValueError:
+                    state = dict()
+                now = time.time()
+                interval = state.get("interval", self._interval)
+                updated = state.get("updated", now)
+                tokens = state.get("tokens", self._burst)
+                state["tokens"] = min(self._burst,
+                                      tokens + (now - updated) / interval)
+                state["updated"] = now
+                yield state
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+                state_file.flush()
+            finally:
+                unlock_file(state_file)
+
+    def acquire(self, submission=False):
+        """Wait until a request can be sent"""
+        pid = str(os.getpid())
+        while True:
+            with self._state() as state:
+                now = state["updated"]
+                # forget about processes that didn't come back
+                waiting = dict((key, value) for key, value
+                               in state.get("waiting", {}).items()
+                               if now - value < MAX_REQUEST_INTERVAL * 2)
+                if submission:
+                    waiting[pid] = now
+                blocked_until = state.get("blocked_until", 0)
+                if (now >= blocked_until and state["tokens"] >= 1
+                        and (submission or not waiting)):
+                    state["tokens"] -= 1
+                    waiting.pop(pid, None)
+                    state["waiting"] = waiting
+                    return
+                state["waiting"] = waiting
+                interval = state.get("interval", self._interval)
+                delay = max(blocked_until - now,
+                            (1 - state["tokens"]) * interval, 0.05)
+            logger.debug("waiting %.2f seconds for the rate limit", delay)
+            time.sleep(delay)
+
+    def throttled(self, retry_after=None):
+        """Slow down after the server refused a request"""
+        with self._state() as state:
+            interval = state.get("interval", self._interval)
+            interval = min(interval * 2, MAX_REQUEST_INTERVAL)
+            state["interval"] = interval
+            state["tokens"] = 0
+            if retry_after is None:
+                retry_after = interval
+            state["blocked_until"] = state["updated"] + retry_after
+
+    def succeeded(self):
+        """Speed up again to the configured rate"""
+        with self._state() as state:
+            interval = state.get("interval", self._interval)
+            if interval > self._interval:
+                state["interval"] = max(self._interval, interval * 0.9)
+
+
+def get_retry_after(err):
+    """Returns (throttled, seconds) for a web service error.
+
+    seconds is None if the server didn't say how long to wait.
+    """
+    cause = getattr(err, "cause", None)
+    if getattr(cause, "code", None) not in [429, 503]:
+        return False, None
+    headers = getattr(cause, "headers", None)
+    try:
+        return True, float(headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return True, None
+
+
 class WebService2():
     """A web service wrapper that asks for a password when first needed.
 
     This uses musicbrainzngs as a wrapper itself.
+    Lookups are served from the cache, if one is given.
     """
 
-    def __init__(self, username=None):
+    def __init__(self, username=None, cache=None, limiter=None):
         self.auth = False
         self.keyring_failed = False
         self.username = username
+        self.cache = cache
+        self.limiter = limiter
         musicbrainzngs.set_hostname(options.server)
         musicbrainzngs.set_useragent(AGENT_NAME, __version__,
                 "http://github.com/JonnyJD/musicbrainz-isrcsubmit")
+        # the rate limit of musicbrainzngs applies to the whole process
+        if limiter is not None:
+            # the shared limiter replaces the one of this process
+            musicbrainzngs.set_rate_limit(False)
+        else:
+            # restore it, an earlier instance might have disabled it
+            musicbrainzngs.set_rate_limit()
+
+    def _call(self, phase, function, *args, **kwargs):
+        """Call a musicbrainzngs function within the rate limit.
+
+        The time is added to the phase "ws:<phase>".
+        Requests refused by the server are repeated a few times.
+        """
+        submission = kwargs.pop("submission", False)
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                with timed("rate_limit"):
+                    self.limiter.acquire(submission)
+            try:
+                with timed("ws:%s" % phase):
+                    result = function(*args, **kwargs)
+            except musicbrainzngs.WebServiceError as err:
+                throttled, retry_after = get_retry_after(err)
+                if (self.limiter is None or not throttled
+                        or attempt >= RATE_LIMIT_RETRIES):
+                    raise
+                logger.info("rate limited by the server: %s", err)
+                self.limiter.throttled(retry_after)
+                attempt += 1
+            else:
+                if self.limiter is not None:
+                    self.limiter.succeeded()
+                return result
 
     def authenticate(self):
         """Sets the password if not set already
         """
         if not self.auth:
-            print("")
-            if self.username is None:
-                printf("Please input your MusicBrainz username (empty=abort): ")
-                self.username = user_input()
-            if len(self.username) == 0:
-                print("(aborted)")
-                sys.exit(1)
-            password = None
-            if keyring is not None and options.keyring and not self.keyring_failed:
+            with timed("authentication"):
+                self._authenticate()
+
+    def _authenticate(self):
+        """Asks for the user name and the password if needed"""
+        print("")
+        if options.headless and self.username is None:
+            print_error("A username is needed to submit without asking.")
+            sys.exit(1)
+        if self.username is None:
+            printf("Please input your MusicBrainz username (empty=abort): ")
+            self.username = user_input()
+        if len(self.username) == 0:
+            print("(aborted)")
+            sys.exit(1)
+        password = None
+        if options.keyring:
+            with timed("keyring"):
+                keyring = import_keyring()
+        else:
+            keyring = None
+        if keyring is not None and not self.keyring_failed:
+            with timed("keyring"):
                 password = keyring.get_password(options.server, self.username)
-            if password is None:
+        if password is None and options.headless:
+            print_error("The password needs to be in the keyring"
+                        " to submit without asking.")
+            sys.exit(1)
+        if password is None:
+            with timed("prompt"):
                 password = getpass.getpass(
-                                    "Please input your MusicBrainz password: ")
-            print("")
-            musicbrainzngs.auth(self.username, password)
-            self.auth = True
-            self.keyring_failed = False
-            if keyring is not None and options.keyring:
+                        "Please input your MusicBrainz password: ")
+        print("")
+        musicbrainzngs.auth(self.username, password)
+        self.auth = True
+        self.keyring_failed = False
+        if keyring is not None:
+            with timed("keyring"):
                 keyring.set_password(options.server, self.username, password)
 
+    def _cache_key(self, resource, mbid, includes):
+        return " ".join([options.server, resource, mbid]
+                        + sorted(includes))
+
+    def _cached(self, key):
+        if self.cache is None or options.refresh:
+            return None
+        response = self.cache.get(key)
+        if response is not None:
+            logger.debug("using cached response for %s", key)
+        return response
+
     def get_releases_by_discid(self, disc_id, includes=[]):
-        try:
-            response = musicbrainzngs.get_releases_by_discid(disc_id,
-                                                             includes=includes)
-        except ResponseError as err:
-            if err.cause.code == 404:
-                return []
-            else:
+        key = self._cache_key("discid", disc_id, includes)
+        response = self._cached(key)
+        if response is None:
+            try:
+                response = self._call("discid",
+                                      musicbrainzngs.get_releases_by_discid,
+                                      disc_id, includes=includes)
+            except musicbrainzngs.ResponseError as err:
+                if err.cause.code == 404:
+                    # not cached, the disc ID might be submitted soon
+                    return []
+                else:
+                    print_error("Couldn't fetch release: %s" % err)
+                    sys.exit(1)
+            except musicbrainzngs.WebServiceError as err:
                 print_error("Couldn't fetch release: %s" % err)
                 sys.exit(1)
-        except WebServiceError as err:
-            print_error("Couldn't fetch release: %s" % err)
-            sys.exit(1)
+            if self.cache is not None and response.get("disc"):
+                release_ids = [release["id"] for release
+                               in response["disc"]["release-list"]]
+                self.cache.put(key, response, release_ids)
+        if response.get("disc"):
+            return response["disc"]["release-list"]
         else:
-            if response.get("disc"):
-                return response["disc"]["release-list"]
-            else:
-                return []
+            return []
 
-    def get_release_by_id(self, release_id, includes=[]):
-        try:
-            return musicbrainzngs.get_release_by_id(release_id,
-                                                    includes=includes)
-        except WebServiceError as err:
-            print_error("Couldn't fetch release: %s" % err)
-            sys.exit(1)
+    def get_releases_by_toc(self, disc_id, toc, includes=[]):
+        """Fuzzy lookup of releases with a similar TOC"""
+        key = self._cache_key("toc", toc.replace(" ", "+"), includes)
+        response = self._cached(key)
+        if response is None:
+            try:
+                response = self._call("toc",
+                                      musicbrainzngs.get_releases_by_discid,
+                                      disc_id, includes=includes, toc=toc,
+                                      cdstubs=False)
+            except musicbrainzngs.ResponseError as err:
+                if err.cause.code == 404:
+                    return []
+                else:
+                    print_error("Couldn't fetch release: %s" % err)
+                    sys.exit(1)
+            except musicbrainzngs.WebServiceError as err:
+                print_error("Couldn't fetch release: %s" % err)
+                sys.exit(1)
+            if self.cache is not None and response.get("release-list"):
+                release_ids = [release["id"] for release
+                               in response["release-list"]]
+                self.cache.put(key, response, release_ids)
+        if response.get("disc"):
+            # the disc ID was added meanwhile
+            return response["disc"]["release-list"]
+        else:
+            return response.get("release-list", [])
 
-    def submit_isrcs(self, tracks2isrcs):
+    def get_release_by_id(self, release_id, includes=[]):
+        """Returns the release or None if it doesn't exist (anymore)"""
+        key = self._cache_key("release", release_id, includes)
+        response = self._cached(key)
+        if response is None:
+            try:
+                response = self._call("release",
+                                      musicbrainzngs.get_release_by_id,
+                                      release_id, includes=includes)
+            except musicbrainzngs.ResponseError as err:
+                if err.cause.code == 404:
+                    # merged or deleted
+                    return None
+                else:
+                    print_error("Couldn't fetch release: %s" % err)
+                    sys.exit(1)
+            except musicbrainzngs.WebServiceError as err:
+                print_error("Couldn't fetch release: %s" % err)
+                sys.exit(1)
+            if self.cache is not None:
+                self.cache.put(key, response, [release_id])
+        return response
+
+    def get_recordings_by_isrc(self, isrc, includes=[]):
+        """Returns the recordings with the ISRC"""
+        key = self._cache_key("isrc", isrc, includes)
+        response = self._cached(key)
+        if response is None:
+            try:
+                response = self._call("isrc",
+                                      musicbrainzngs.get_recordings_by_isrc,
+                                      isrc, includes=includes)
+            except musicbrainzngs.ResponseError as err:
+                if err.cause.code == 404:
+                    response = {"isrc": {"id": isrc, "recording-list": []}}
+                else:
+                    raise
+            if self.cache is not None:
+                release_ids = [release["id"] for recording
+                               in response["isrc"]["recording-list"]
+                               for release in recording.get("release-list",
+                                                            [])]
+                self.cache.put(key, response, release_ids)
+        return response["isrc"]["recording-list"]
+
+    def forget_release(self, release_id):
+        """Make sure the release is fetched again after changing it"""
+        if self.cache is not None:
+            self.cache.invalidate_release(release_id)
+
+    def _submit(self, tracks2isrcs):
+        """Submit the ISRCs, asking for new credentials when necessary.
+
+        Other web service errors are raised.
+        """
         logger.info("tracks2isrcs: %s", tracks2isrcs)
         while True:
             try:
                 self.authenticate()
-                musicbrainzngs.submit_isrcs(tracks2isrcs)
-            except AuthenticationError as err:
+                self._call("submit", musicbrainzngs.submit_isrcs,
+                           tracks2isrcs, submission=True)
+            except musicbrainzngs.AuthenticationError as err:
                 print_error("Invalid credentials: %s" % err)
                 self.auth = False
                 self.keyring_failed = True
                 self.username = None
                 continue
-            except WebServiceError as err:
-                print_error("Couldn't send ISRCs: %s" % err)
-                sys.exit(1)
             else:
-                print("Successfully submitted %d ISRCS." % len(tracks2isrcs))
                 break
 
+    def submit_isrcs(self, tracks2isrcs):
+        """Returns True when the ISRCs were submitted"""
+        try:
+            self._submit(tracks2isrcs)
+        except musicbrainzngs.WebServiceError as err:
+            print_error("Couldn't send ISRCs: %s" % err)
+            return False
+        else:
+            print("Successfully submitted %d ISRCS." % len(tracks2isrcs))
+            return True
+
+    def submit_batch(self, batch):
+        """Submit all ISRCs collected in a SubmissionBatch.
+
+        When a combined submission fails, the discs in it are submitted
+        one by one, so a single bad disc doesn't fail the others.
+        Returns a list of (item, error) with error None on success.
+        """
+        results = []
+        for part in batch.split():
+            tracks2isrcs = dict()
+            for item, disc_isrcs in part:
+                tracks2isrcs.update(disc_isrcs)
+            try:
+                self._submit(tracks2isrcs)
+            except musicbrainzngs.WebServiceError as err:
+                if len(part) == 1:
+                    results.append((part[0][0], str(err)))
+                    continue
+                logger.info("Batch failed, submitting discs separately: %s",
+                            err)
+                for item, disc_isrcs in part:
+                    try:
+                        self._submit(disc_isrcs)
+                    except musicbrainzngs.WebServiceError as err:
+                        results.append((item, str(err)))
+                    else:
+                        results.append((item, None))
+            else:
+                print("Successfully submitted %d ISRCS for %d discs."
+                      % (len(tracks2isrcs), len(part)))
+                for item, disc_isrcs in part:
+                    results.append((item, None))
+        return results
+
+
+
+def calculate_disc_id(first_track, last_track, offsets):
+    """Returns the MusicBrainz disc ID
+
+    The offsets are in sectors, starting with the lead-out.
+    """
+    data = "%02X%02X" % (first_track, last_track)
+    for i in range(100):
+        if i < len(offsets):
+            data += "%08X" % offsets[i]
+        else:
+            data += "%08X" % 0
+    digest = base64.b64encode(hashlib.sha1(data.encode("ascii")).digest())
+    return decode(digest).replace("+", ".").replace("/", "_").replace("=", "-")
+
+def msf_to_sectors(value):
+    """Returns the sectors for mm:ss:ff or a number of samples"""
+    if ":" in value:
+        minutes, seconds, frames = [int(part) for part in value.split(":")]
+        return (minutes * 60 + seconds) * 75 + frames
+    else:
+        samples = int(value)
+        if samples % 588:
+            raise ValueError("%s samples are no full sectors" % value)
+        return samples // 588
+
+
+class TocTrack(object):
+    """A track of a TocDisc, like the tracks of a discid Disc"""
+
+    def __init__(self, number, offset, sectors, isrc=None):
+        self.number = number
+        self.offset = offset
+        self.sectors = sectors
+        self.isrc = isrc
+
+
+class TocDisc(object):
+    """A disc calculated from a TOC, without reading the drive again.
+
+    This has the attributes of a discid Disc that isrcsubmit uses.
+    The offsets include the 150 sectors of the first pregap.
+    """
+
+    def __init__(self, tracks, sectors, mcn=None):
+        self.tracks = tracks
+        self.sectors = sectors      # lead-out offset
+        self.mcn = mcn
+        self.first_track_num = tracks[0].number
+        self.last_track_num = tracks[-1].number
+        offsets = [sectors] + [track.offset for track in tracks]
+        self.id = calculate_disc_id(self.first_track_num, self.last_track_num,
+                                    offsets)
+        self.toc_string = " ".join(["%d" % value for value in
+                                    [self.first_track_num, self.last_track_num]
+                                    + offsets])
+        self.submission_url = ("http://musicbrainz.org/cdtoc/attach"
+                               "?id=%s&tracks=%d&toc=%s"
+                               % (self.id, len(tracks),
+                                  self.toc_string.replace(" ", "+")))
+
+class RereadDisc(object):
+    """The TOC of a second read with the MCN and ISRCs of the first read"""
+
+    def __init__(self, toc_disc, first_disc):
+        self.id = toc_disc.id
+        self.submission_url = toc_disc.submission_url
+        self.mcn = first_disc.mcn
+        isrcs = dict()
+        for track in first_disc.tracks:
+            isrcs[track.number] = track.isrc
+        self.tracks = []
+        for track in toc_disc.tracks:
+            self.tracks.append(TocTrack(track.number, track.offset,
+                                        track.sectors, isrcs.get(track.number)))
+        self.sectors = toc_disc.sectors
+        self.first_track_num = toc_disc.first_track_num
+        self.last_track_num = toc_disc.last_track_num
+
+def parse_toc_disc(lines):
+    """Create a TocDisc from the lines of a cdrdao TOC file.
+
+    Returns None if the TOC can't be used to calculate the disc ID,
+    for example when there are data tracks.
+    """
+    tracks = []
+    mcn = None
+    position = 0        # sectors from the start of the first track
+    number = None
+    track_start = index_start = None
+    isrc = None
+    cd_text = 0         # depth of CD-TEXT blocks
+
+    def finish_track():
+        if number is not None:
+            start = index_start if index_start is not None else track_start
+            tracks.append(TocTrack(number, start + 150, position - start,
+                                   isrc))
+
+    try:
+        for line in lines:
+            words = line.split()
+            if not words:
+                continue
+            if cd_text:
+                cd_text += line.count("{") - line.count("}")
+                continue
+            keyword = words[0]
+            if keyword == "//":
+                # comments also give the track numbers
+                if len(words) > 2 and words[1] == "Track":
+                    finish_track()
+                    number = int(words[2])
+                    track_start = position
+                    index_start = isrc = None
+            elif keyword == "TRACK":
+                if words[1] != "AUDIO":
+                    logger.info("data track, can't use the TOC for the ID")
+                    return None
+                if number is None or track_start != position:
+                    finish_track()
+                    number = tracks[-1].number + 1 if tracks else 1
+                    track_start = position
+                    index_start = isrc = None
+            elif keyword == "CATALOG":
+                mcn = words[1].strip('"')
+            elif keyword == "ISRC":
+                isrc = "".join(words[1:]).strip('"- ')
+            elif keyword == "CD_TEXT":
+                cd_text += line.count("{") - line.count("}")
+            elif keyword in ["FILE", "AUDIOFILE"]:
+                # FILE "name" start [length]
+                length = words[-1] if len(words) > 3 else None
+                if length is None:
+                    return None
+                position += msf_to_sectors(length)
+            elif keyword in ["SILENCE", "ZERO"]:
+                position += msf_to_sectors(words[-1])
+            elif keyword == "PREGAP":
+                position += msf_to_sectors(words[1])
+                index_start = position
+            elif keyword == "START":
+                if len(words) > 1:
+                    index_start = track_start + msf_to_sectors(words[1])
+                else:
+                    index_start = position
+        finish_track()
+    except (ValueError, IndexError) as err:
+        logger.info("Couldn't parse the TOC: %s", err)
+        return None
+    if not tracks:
+        return None
+    return TocDisc(tracks, position + 150, mcn)
+
+
+def _digits(number):
+    """Compare barcodes, catalog numbers and MCNs by their digits only"""
+    return "".join([char for char in number or "" if char.isdigit()
+                    ]).lstrip("0")
+
+def score_release(release, disc_id, mcn, track_count, isrcs):
+    """Score how well a release fits the disc that was read.
+
+    The isrcs are (track_number, isrc) as read from the disc.
+    Returns the score and a list of the reasons.
+    """
+    score = 0.0
+    reasons = []
+    mcn = _digits(mcn)
+    if mcn:
+        barcode = _digits(release.barcode)
+        if barcode == mcn:
+            score += 3
+            reasons.append("barcode matches MCN")
+        elif barcode:
+            score -= 3
+            reasons.append("barcode differs from MCN")
+        for catalog_number in release.catalog_numbers:
+            if _digits(catalog_number) == mcn:
+                score += 2
+                reasons.append("catalog number matches MCN")
+                break
+
+    media = release.media_with_disc_id(disc_id)
+    if len(media) != 1:
+        # can't be used for the disc anyways
+        return score - 10, reasons + ["%d media with disc ID" % len(media)]
+    medium = media[0]
+    if len(medium.tracks) == track_count:
+        score += 1
+    else:
+        score -= 1
+        reasons.append("%d tracks on medium" % len(medium.tracks))
+
+    if isrcs:
+        matches = conflicts = 0
+        for track_number, isrc in isrcs:
+            track = medium.track(track_number)
+            if track is None:
+                conflicts += 1
+            elif isrc in track.isrcs:
+                matches += 1
+            elif track.isrcs:
+                conflicts += 1
+        score += 3.0 * (matches - conflicts) / len(isrcs)
+        if matches:
+            reasons.append("%d ISRCs attached" % matches)
+        if conflicts:
+            reasons.append("%d tracks with other ISRCs" % conflicts)
+    return score, reasons
+
+def rank_releases(releases, disc_id, mcn, track_count, isrcs):
+    """Rank releases with the same disc ID, best match first.
+
+    Returns a list of (score, release, reasons) and the confidence,
+    which is the score difference between the first two releases.
+    """
+    ranking = []
+    for release in releases:
+        score, reasons = score_release(release, disc_id, mcn, track_count,
+                                       isrcs)
+        ranking.append((score, release, reasons))
+    ranking.sort(key=lambda entry: -entry[0])
+    if len(ranking) > 1:
+        confidence = ranking[0][0] - ranking[1][0]
+    else:
+        confidence = float("inf")
+    return ranking, confidence
+
+def rank_toc_matches(releases, track_lengths):
+    """Rank releases found with a fuzzy TOC lookup.
+
+    Returns a list of (difference, release, medium), best match first.
+    The difference is the sum of all track length differences in seconds,
+    only media with the same number of tracks are used.
+    """
+    matches = []
+    for release in releases:
+        best = None
+        for medium in release.media:
+            if len(medium.tracks) != len(track_lengths):
+                continue
+            difference = 0.0
+            for track, length in zip(medium.tracks, track_lengths):
+                if track.length is None:
+                    # unknown lengths are counted as a big difference
+                    difference += 60
+                else:
+                    difference += abs(track.length - length) / 1000.0
+            if best is None or difference < best[0]:
+                best = (difference, release, medium)
+        if best is not None:
+            matches.append(best)
+    matches.sort(key=lambda match: match[0])
+    return matches
 
 
 class Disc(object):
     def read_disc(self):
         try:
             # calculate disc ID from disc
-            if self._backend == "libdiscid" and not options.force_submit:
-                disc = discid.read(self._device, features=["mcn", "isrc"])
-            else:
-                disc = discid.read(self._device)
+            with self.drive_lock:
+                disc = None
+                if self._backend == "cdrdao" and not options.force_submit:
+                    # the TOC includes everything, so read the disc only once
+                    self.cdrdao_toc = read_cdrdao_toc(self._device)
+                    disc = parse_toc_disc(self.cdrdao_toc)
+                if disc is not None:
+                    logger.info("disc ID calculated from the cdrdao TOC")
+                elif self._backend == "virtual":
+                    self.virtual_drive = open_virtual_drive(self._device)
+                    disc = self.virtual_drive.read_disc()
+                elif self._backend == "libdiscid" and not options.force_submit:
+                    disc = discid.read(self._device, features=["mcn", "isrc"])
+                else:
+                    disc = discid.read(self._device)
             self._disc = disc
-        except DiscError as err:
+        except discid.DiscError as err:
             print_error("DiscID calculation failed: %s" % err)
             sys.exit(1)
 
-    def __init__(self, device, backend, verified=False):
-        if sys.platform == "darwin":
-            self._device = get_real_mac_device(device)
+    def verify_disc(self):
+        """Check the disc ID with a quick read of only the TOC.
+
+        Returns True when the disc ID didn't change.
+        Otherwise the new TOC is used, together with the MCN and ISRCs
+        of the first read.
+        """
+        try:
+            with self.drive_lock, timed("verify_disc"):
+                if self.virtual_drive is not None:
+                    toc_disc = self.virtual_drive.read_disc()
+                else:
+                    toc_disc = discid.read(self._device)
+        except discid.DiscError as err:
+            print_error("DiscID calculation failed: %s" % err)
+            sys.exit(1)
+        if toc_disc.id == self.id:
+            return True
+        logger.info("disc ID changed from %s to %s", self.id, toc_disc.id)
+        self._disc = RereadDisc(toc_disc, self._disc)
+        return False
+
+    def _real_device(self, device):
+        if self._backend == "virtual":
+            return device
+        elif sys.platform == "darwin":
+            real_device = get_real_mac_device(device)
             logger.info("CD drive #%s corresponds to %s internally",
-                        device, self._device)
+                        device, real_device)
+            return real_device
         else:
-            self._device = device
+            return device
+
+    def __init__(self, device, backend, verified=False):
+        self._backend = backend
+        self._device = self._real_device(device)
+        self._option_device = device
         self._disc = None
+        self.cdrdao_toc = None
+        self.backend_lines = None   # raw output of the backend
+        self.virtual_drive = None
         self._release = None
-        self._backend = backend
         self._verified = verified
         self._asked_for_submission = False
         self._common_includes=["artists", "labels", "recordings", "isrcs",
                                "artist-credits"] # the last one only for cleanup
-        self.read_disc()        # sets self._disc
+        self._medium = None
+        self._lookups = dict()
+        self._lookup_lock = threading.Lock()
+        # reading ISRCs and re-reading the disc ID don't go together
+        self.drive_lock = threading.Lock()
+        self.timings = Timings(device)
+        profiled_discs.append(self.timings)
+        with timings_for(self.timings), timed("read_disc"):
+            self.read_disc()        # sets self._disc
+        self.timings.disc_id = self.id
+
+    @property
+    def device(self):
+        """The device as given by the user"""
+        return self._option_device
+
+    @property
+    def backend(self):
+        """The backend the ISRCs are read with"""
+        return self._backend
 
     @property
     def id(self):
@@ -688,6 +2038,26 @@ class Disc(object):
     def tracks(self):
         return self._disc.tracks
 
+    @property
+    def toc_string(self):
+        """The TOC as used by the web service, None if not known"""
+        try:
+            offsets = [self._disc.sectors]
+            offsets += [track.offset for track in self.tracks]
+            first = self.tracks[0].number
+            last = self.tracks[-1].number
+        except (AttributeError, IndexError):
+            return None
+        return " ".join(["%d" % value for value in [first, last] + offsets])
+
+    @property
+    def track_lengths(self):
+        """The lengths of the tracks in milliseconds, None if not known"""
+        try:
+            return [track.sectors * 1000 // 75 for track in self.tracks]
+        except AttributeError:
+            return None
+
     @property
     def submission_url(self):
         url = self._disc.submission_url
@@ -699,6 +2069,17 @@ class Disc(object):
     def asked_for_submission(self):
         return self._asked_for_submission
 
+    @property
+    def medium(self):
+        """The medium of the release that corresponds to this disc"""
+        if self._medium is None and self.release is not None:
+            media = self.release.media_with_disc_id(self.id)
+            if len(media) > 1:
+                raise discid.DiscError("number of discs with id: %d"
+                                       % len(media))
+            self._medium = media[0]
+        return self._medium
+
     @property
     def release(self):
         """The corresponding MusicBrainz release
@@ -710,20 +2091,71 @@ class Disc(object):
             # can still be None
         return self._release
 
+    def lookup_releases(self, release_id=None):
+        """Fetch the releases with this disc ID or the pre-selected release
+
+        This only uses the network and doesn't ask the user,
+        so it can run in the background while the drive is read.
+        The results are kept for the current disc ID.
+        """
+        with self._lookup_lock, timings_for(self.timings):
+            key = (self.id, release_id)
+            if key not in self._lookups:
+                if release_id:
+                    includes = self._common_includes + ["discids"]
+                    result = ws2.get_release_by_id(release_id,
+                                                   includes=includes)
+                    if result is None:
+                        self._lookups[key] = []
+                    else:
+                        self._lookups[key] = [
+                                parse_release(result["release"], includes)]
+                else:
+                    includes = self._common_includes
+                    results = ws2.get_releases_by_discid(self.id,
+                                                         includes=includes)
+                    self._lookups[key] = [parse_release(release, includes)
+                                          for release in results]
+            return self._lookups[key]
+
+    def prefetch_releases(self):
+        """Start looking up the releases in the background.
+
+        Returns the BackgroundTask or None if no lookup is needed.
+        """
+        if options.force_submit:
+            return None
+        release_id = options.release_id or self.stored_choice()
+        return BackgroundTask(self.lookup_releases, (release_id,))
+
+    def stored_choice(self):
+        """Returns the release ID the user chose before for this disc ID"""
+        if choices is None or options.release_id or options.force_submit:
+            return None
+        if options.forget_choice:
+            if choices.get(options.server, self.id):
+                choices.forget(options.server, self.id)
+            return None
+        entry = choices.get(options.server, self.id)
+        if entry is None:
+            return None
+        return entry["release_id"]
+
     def fetch_release(self, release_id):
         """Check if a pre-selected release has the correct TOC attached
+
+        Returns None if it hasn't or if the release doesn't exist.
         """
-        includes = self._common_includes + ["discids"]
-        result = ws2.get_release_by_id(release_id, includes=includes)
-        release = result["release"]
-        for medium in release["medium-list"]:
-            for disc in medium["disc-list"]:
-                if disc["id"] == self.id:
-                    return release
+        releases = self.lookup_releases(release_id)
+        if not releases:
+            return None
+        release = releases[0]
+        if release.media_with_disc_id(self.id):
+            return release
         # disc ID is not attached to the release
         return None
 
-    def select_release(self):
+    def select_release(self, read_isrcs=None):
         """Find the corresponding MusicBrainz release by disc ID
 
         This will ask the user to choose if the discID is ambiguous.
@@ -733,106 +2165,722 @@ class Disc(object):
             # away and skip all other logic, e.g. unneeded WS2 requests.
             print("\nSubmission forced.")
             return None
-        includes = self._common_includes
-        results = ws2.get_releases_by_discid(self.id, includes=includes)
+        release_id = self.stored_choice()
+        if release_id:
+            release = self.fetch_release(release_id)
+            if release is not None:
+                print("\nUsing the release chosen before for this Disc ID.")
+                return release
+            if self.lookup_releases(release_id):
+                print("\nThe release chosen before doesn't have this Disc ID.")
+            else:
+                print("\nThe release chosen before is not in the database"
+                      " anymore.")
+            choices.forget(options.server, self.id)
+        results = self.lookup_releases()
         num_results = len(results)
         if num_results == 0:
             print("\nThis Disc ID is not in the database.")
             selected_release = None
         elif num_results > 1:
             print("\nThis Disc ID is ambiguous:")
-            print(" 0: none of these\n")
-            self._asked_for_submission = True
-            for i in range(num_results):
-                release = results[i]
-                # printed list is 1..n, not 0..n-1 !
-                print_release(release, i + 1)
-            try:
-                num =  user_input("Which one do you want? [0-%d] "
-                                  % num_results)
-                if int(num) not in range(0, num_results + 1):
-                    raise IndexError
-                if int(num) == 0:
-                    ask_for_submission(self.submission_url, print_url=True)
-                    sys.exit(1)
+            selected_release = None
+            notes = None
+            confidence = 0.0
+            if options.headless and options.ambiguous == "skip":
+                raise DiscSkipped("ambiguous disc ID")
+            if options.auto_select or options.headless:
+                isrcs = read_isrcs() if read_isrcs else []
+                ranking, confidence = rank_releases(results, self.id,
+                                                    self.mcn,
+                                                    len(self.tracks), isrcs)
+                results = [release for score, release, reasons in ranking]
+                notes = ["score %.1f%s" % (score, ": " + ", ".join(reasons)
+                                                  if reasons else "")
+                         for score, release, reasons in ranking]
+                if (confidence >= options.min_confidence
+                        or options.ambiguous == "best"):
+                    print("chose release automatically (confidence %.1f)"
+                          % confidence)
+                    selected_release = results[0]
                 else:
-                    selected_release = results[int(num) - 1]
-            except (ValueError, IndexError):
-                print_error("Invalid Choice")
-                sys.exit(1)
-            except KeyboardInterrupt:
-                print("\nexiting..")
-                sys.exit(1)
+                    print("no clear choice (confidence %.1f)" % confidence)
+            if selected_release is None:
+                if options.headless:
+                    raise DiscSkipped("ambiguous disc ID (confidence %.1f)"
+                                      % confidence)
+                selected_release = self.choose_release(results, notes)
+                if choices is not None:
+                    choices.remember(options.server, self.id,
+                                     selected_release.id, options.user)
         else:
             selected_release = results[0]
 
         return selected_release
 
+    def choose_release(self, releases, notes=None):
+        """Ask the user which of the releases is the right one.
 
-    def get_release(self, verified=False):
+        Choosing none of them leads to the submission of the disc ID.
+        """
+        num_results = len(releases)
+        print(" 0: none of these\n")
+        self._asked_for_submission = True
+        for i in range(num_results):
+            release = releases[i]
+            # printed list is 1..n, not 0..n-1 !
+            print_release(release, i + 1)
+            if notes:
+                print("\t%s" % notes[i])
+        try:
+            num =  user_input("Which one do you want? [0-%d] "
+                              % num_results)
+            if int(num) not in range(0, num_results + 1):
+                raise IndexError
+            if int(num) == 0:
+                ask_for_submission(self.submission_url, print_url=True)
+                sys.exit(1)
+            else:
+                return releases[int(num) - 1]
+        except (ValueError, IndexError):
+            print_error("Invalid Choice")
+            sys.exit(1)
+        except KeyboardInterrupt:
+            print("\nexiting..")
+            sys.exit(1)
+
+    def select_toc_match(self):
+        """Find releases with a similar TOC when the disc ID is unknown.
+
+        The disc ID isn't attached to a release chosen here,
+        so the submission URL is shown to attach it.
+        """
+        toc = self.toc_string
+        track_lengths = self.track_lengths
+        if toc is None or track_lengths is None:
+            return None
+        includes = self._common_includes
+        releases = [parse_release(release, includes) for release
+                    in ws2.get_releases_by_toc(self.id, toc, includes=includes)]
+        matches = rank_toc_matches(releases, track_lengths)[:10]
+        if options.headless:
+            # only a very close match is used without asking
+            tolerance = TOC_MATCH_TOLERANCE * len(track_lengths)
+            matches = [match for match in matches[:1]
+                       if match[0] <= tolerance]
+        if not matches:
+            return None
+        if options.headless:
+            difference, release, self._medium = matches[0]
+            print("\nUsing the release with the most similar TOC:")
+            print("\nPlease attach the Disc ID to the release with this url:")
+            print(self.submission_url)
+            return release
+        print("\nThese releases have a similar TOC:")
+        notes = ["medium %d, track lengths differ by %d seconds"
+                 % (medium.position, difference)
+                 for difference, release, medium in matches]
+        release = self.choose_release([match[1] for match in matches], notes)
+        for difference, match_release, medium in matches:
+            if match_release is release:
+                self._medium = medium
+        print("\nPlease attach the Disc ID to the release with this url:")
+        print(self.submission_url)
+        return release
+
+    def get_release(self, verified=False, read_isrcs=None):
         """This will get a release the ISRCs will be added to.
+
+        read_isrcs can return the ISRCs of the disc as (track_number, isrc),
+        these are used to choose between releases automatically.
         """
 
         # check if a release was pre-selected
         if options.release_id:
+            if not self.lookup_releases(options.release_id):
+                print_error("Release %s is not in the database"
+                            % options.release_id)
+                sys.exit(1)
             chosen_release = self.fetch_release(options.release_id)
         else:
-            chosen_release = self.select_release()
+            chosen_release = self.select_release(read_isrcs)
 
-        if chosen_release and chosen_release["id"] is None:
+        if chosen_release and chosen_release.id is None:
             # a "release" that is only a stub has no musicbrainz id
             print("\nThere is only a stub in the database:")
             print_encoded("%s - %s\n\n"
-                          % (chosen_release["artist-credit-phrase"],
-                             chosen_release["title"]))
+                          % (chosen_release.artist, chosen_release.title))
             chosen_release = None       # don't use stub
             verified = True             # the id is verified by the stub
 
+        shown_url = None
         if chosen_release is None or options.force_submit:
-            if verified:
-                url = self.submission_url
-                ask_for_submission(url, print_url=True)
-                sys.exit(1)
-            else:
+            if (not verified and self.drive_lock.locked()
+                    and not options.headless):
+                # don't wait for the ISRCs until the drive can re-check
+                shown_url = self.submission_url
+                print("\nThe Disc ID is re-checked when the ISRCs are read.")
+                print("Meanwhile you can submit it with this url:")
+                print(shown_url)
+            if not verified:
                 print("recalculating to re-check..")
-                self.read_disc()
-                self.get_release(verified=True)
+                verified = self.verify_disc()
+                if not verified:
+                    if shown_url is not None:
+                        print("The Disc ID changed, the url above is wrong.")
+                    # look up the corrected disc ID
+                    return self.get_release(True, read_isrcs)
+            if (not options.force_submit and not options.release_id
+                    and not (options.headless and options.unknown != "toc")):
+                chosen_release = self.select_toc_match()
+        if chosen_release is None or options.force_submit:
+            url = self.submission_url
+            if options.headless:
+                raise DiscSkipped("disc ID not in the database", url)
+            ask_for_submission(url, print_url=url != shown_url)
+            sys.exit(1)
 
         self._release = chosen_release
         return chosen_release
 
 
-def get_disc(device, backend, verified=False):
-    """This creates a Disc object, which also calculates the id of the disc
-    """
-    disc = Disc(device, backend, verified)
+def print_disc(disc):
     print('\nDiscID:\t\t%s' % disc.id)
     if disc.mcn:
         print('MCN/EAN:\t%s' % disc.mcn)
     print('Tracks on disc:\t%d' % len(disc.tracks))
+
+def get_disc(device, backend, verified=False):
+    """This creates a Disc object, which also calculates the id of the disc
+    """
+    disc = Disc(device, backend, verified)
+    print_disc(disc)
     return disc
 
 
-def gather_isrcs(disc, backend, device):
-    """read the disc in the device with the backend and extract the ISRCs
+class Timings(object):
+    """The time spent in each phase while a disc is processed.
+
+    Phases can contain other phases, the authentication includes
+    the keyring and the prompts for the password.
     """
-    backend_output = []
-    devnull = open(os.devnull, "w")
 
-    if backend == "libdiscid":
-        pattern = r'[A-Z]{2}[A-Z0-9]{3}\d{2}\d{5}'
-        for track in disc.tracks:
-            if track.isrc:
-                match = re.match(pattern, track.isrc)
+    def __init__(self, device=None):
+        self.device = device
+        self.disc_id = None
+        self.first_isrc = None      # seconds until the backend found one
+        self._phases = dict()       # name -> [count, seconds]
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            entry = self._phases.setdefault(phase, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def record(self):
+        """Returns the timings as a dict, for JSON"""
+        with self._lock:
+            phases = dict((phase, {"count": count,
+                                   "seconds": round(seconds, 3)})
+                          for phase, (count, seconds) in self._phases.items())
+        first_isrc = self.first_isrc
+        if first_isrc is not None:
+            first_isrc = round(first_isrc, 3)
+        return {"device": self.device, "disc_id": self.disc_id,
+                "first_isrc": first_isrc, "phases": phases}
+
+    def __str__(self):
+        with self._lock:
+            phases = sorted(self._phases.items(),
+                            key=lambda phase: phase[1][1], reverse=True)
+        parts = []
+        for phase, (count, seconds) in phases:
+            part = "%s %.2f s" % (phase, seconds)
+            if count > 1:
+                part += " (%dx)" % count
+            if phase == "gather_isrcs" and self.first_isrc is not None:
+                part += " (first ISRC after %.2f s)" % self.first_isrc
+            parts.append(part)
+        return ", ".join(parts) or "nothing timed"
+
+def current_timings():
+    """Returns the timings of the disc processed in this thread"""
+    timings = getattr(_timing_context, "timings", None)
+    if timings is None:
+        return session_timings
+    return timings
+
+@contextmanager
+def timings_for(timings):
+    """Phases in this thread are added to the timings meanwhile"""
+    previous = getattr(_timing_context, "timings", None)
+    _timing_context.timings = timings
+    try:
+        yield timings
+    finally:
+        _timing_context.timings = previous
+
+@contextmanager
+def timed(phase):
+    """Add the time spent meanwhile to the phase of the current timings"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings = current_timings()
+        if timings is not None:
+            timings.add(phase, time.time() - start)
+
+@contextmanager
+def thread_profile():
+    """Profile this thread meanwhile, if the Python profiler is used"""
+    profilers = thread_profilers
+    if profilers is None or threading.current_thread() is main_thread:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profilers.append(profiler)
+
+def with_timings(function, timings):
+    """Returns the function with the phases added to timings,
+    for functions called in other threads.
+    These threads are also profiled with --cprofile.
+    """
+    def timed_function(*args, **kwargs):
+        with timings_for(timings), thread_profile():
+            return function(*args, **kwargs)
+    return timed_function
+
+def write_python_profile(file_name, profiler):
+    """Write the statistics of the main thread and all other threads"""
+    stats = pstats.Stats(profiler)
+    for thread_profiler in list(thread_profilers):
+        stats.add(thread_profiler)
+    stats.dump_stats(file_name)
+
+def write_profile(file_name):
+    """Write the timings of all discs and of the session as JSON"""
+    profile = {"discs": [timings.record() for timings in profiled_discs],
+               "session": session_timings.record()["phases"]}
+    try:
+        with open(file_name, "w") as profile_file:
+            json.dump(profile, profile_file, indent=2, sort_keys=True)
+    except IOError as err:
+        print_error("Couldn't write the profile: %s" % err)
+
+
+class BackgroundTask(object):
+    """Run a function in a separate thread.
+
+    The result (or the exception, including SystemExit)
+    is handed over to the caller of result().
+    If a queue is given as notify, the task puts itself there when done.
+    The phases are timed for the disc of the thread starting the task.
+    """
+    def __init__(self, function, args=(), notify=None):
+        self._function = with_timings(function, current_timings())
+        self._args = args
+        self._notify = notify
+        self._result = None
+        self._error = None
+        # a daemon thread doesn't keep us alive when the main thread exits
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._result = self._function(*self._args)
+        except BaseException as err:
+            self._error = err
+        if self._notify is not None:
+            self._notify.put(self)
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+class BackgroundStream(BackgroundTask):
+    """Iterate over a generator running in a separate thread.
+
+    The items are handed over as soon as they are produced.
+    Exceptions of the thread are raised at the end of the iteration.
+    """
+    _end = object()
+
+    def __init__(self, function, args=()):
+        self._items = queue.Queue()
+        BackgroundTask.__init__(self, self._produce, (function, args))
+
+    def _produce(self, function, args):
+        try:
+            for item in function(*args):
+                self._items.put(item)
+        finally:
+            self._items.put(self._end)
+
+    def collect(self):
+        """Wait for all items and return them.
+
+        The items are still handed over when iterating afterwards.
+        """
+        items = []
+        while True:
+            item = self._items.get()
+            items.append(item)
+            if item is self._end:
+                break
+        for item in items:
+            self._items.put(item)
+        return items[:-1]
+
+    def __iter__(self):
+        while True:
+            item = self._items.get()
+            if item is self._end:
+                break
+            yield item
+        self.result()
+
+def read_isrcs(disc, backend):
+    """yields the ISRCs, the drive is not used otherwise meanwhile"""
+    items = []
+    start = time.time()
+    try:
+        with disc.drive_lock:
+            for item in iter_isrcs(disc, backend, disc.device):
+                if not items:
+                    disc.timings.first_isrc = time.time() - start
+                items.append(item)
+                yield item
+    finally:
+        disc.timings.add("gather_isrcs", time.time() - start)
+    if options.capture:
+        save_capture(options.capture, disc, backend, items)
+
+def save_capture(directory, disc, backend, backend_output):
+    """Save what was read from the disc to be processed again later.
+
+    The capture has the TOC, the MCN, the ISRCs libdiscid read,
+    the ISRCs found by the backend and its raw output.
+    """
+    try:
+        tracks = [[track.number, track.offset, track.sectors, track.isrc]
+                  for track in disc.tracks]
+        sectors = disc._disc.sectors
+    except AttributeError:
+        logger.warning("Can't capture disc %s without the full TOC", disc.id)
+        return None
+    capture = {"format": CAPTURE_FORMAT, "time": time.time(),
+               "device": disc.device, "backend": backend,
+               "disc_id": disc.id, "mcn": disc.mcn, "sectors": sectors,
+               "tracks": tracks, "isrcs": backend_output,
+               "lines": disc.backend_lines}
+    path = os.path.join(directory, "%s.json.gz" % disc.id)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as capture_file:
+            json.dump(capture, capture_file)
+        os.replace(path + ".tmp", path)
+    except (IOError, OSError) as err:
+        print_error("Couldn't save the capture: %s" % err)
+        return None
+    logger.info("disc captured in %s", path)
+    return path
+
+def load_capture(path):
+    """Read a capture and parse the backend output again.
+
+    This doesn't need anything else of isrcsubmit,
+    so it can run in a separate process.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as capture_file:
+        capture = json.load(capture_file)
+    if capture.get("format") != CAPTURE_FORMAT:
+        raise ValueError("unknown capture format: %s" % capture.get("format"))
+    backend = capture["backend"]
+    lines = capture["lines"]
+    if lines is None:
+        # libdiscid has no output to parse
+        output = capture["isrcs"]
+    elif backend == "cdrdao":
+        output = parse_cdrdao_toc(lines)
+    elif backend == "discisrc":
+        output = parse_discisrc(lines)
+    else:
+        output = parse_mediatools(lines)
+    capture["output"] = [tuple(item) for item in output]
+    return capture
+
+def find_captures(paths):
+    """Returns the capture files, directories are searched"""
+    captures = []
+    for path in paths:
+        if os.path.isdir(path):
+            captures.extend(sorted(
+                    os.path.join(path, name) for name in os.listdir(path)
+                    if name.endswith(".json.gz")))
+        else:
+            captures.append(path)
+    return captures
+
+
+class CapturedDisc(Disc):
+    """A disc read from a capture instead of a drive"""
+
+    def __init__(self, path, capture):
+        self._capture = capture
+        Disc.__init__(self, path, capture["backend"], verified=True)
+        self.backend_lines = capture["lines"]
+
+    def _real_device(self, device):
+        return device
+
+    def read_disc(self):
+        capture = self._capture
+        tracks = [TocTrack(*track) for track in capture["tracks"]]
+        self._disc = TocDisc(tracks, capture["sectors"], capture["mcn"])
+        if self._disc.id != capture["disc_id"]:
+            print_error("The TOC of the capture doesn't match the disc ID %s"
+                        % capture["disc_id"])
+            sys.exit(1)
+
+    def verify_disc(self):
+        # the capture can't change
+        return True
+
+
+class RecordedObject(object):
+    """A disc or track of a pickled disc, with the attributes saved"""
+
+
+def load_recorded_disc(disc_file):
+    """Loads a pickled disc of the tests, but no other objects"""
+    class RecordingUnpickler(pickle.Unpickler):
+        def find_class(self, module, name):
+            if name in ["MockedDisc", "MockedTrack"]:
+                return RecordedObject
+            raise pickle.UnpicklingError(
+                    "%s.%s is not part of a recorded disc" % (module, name))
+
+    return RecordingUnpickler(disc_file).load()
+
+
+class VirtualDrive(object):
+    """A drive replaying a recorded disc, for tests without a real drive.
+
+    The recording is a capture, a pickled disc like in test_data
+    or a cdrdao TOC file.
+    Each read of the TOC or of a track takes the latency
+    and fails with the error rate.
+    """
+
+    def __init__(self, path, latency=0.0, error_rate=0.0):
+        self.path = path
+        self._latency = latency
+        self._error_rate = error_rate
+        # the same errors every time
+        self._random = random.Random(path)
+        if path.endswith(".json.gz"):
+            capture = load_capture(path)
+            tracks = [TocTrack(*track) for track in capture["tracks"]]
+            self._disc = TocDisc(tracks, capture["sectors"], capture["mcn"])
+            self._isrcs = capture["output"]
+        elif path.endswith(".pickle"):
+            with open(path, "rb") as disc_file:
+                self._disc = load_recorded_disc(disc_file)
+            self._isrcs = list(parse_libdiscid(self._disc.tracks))
+        else:
+            with open(path, "r") as toc_file:
+                lines = toc_file.readlines()
+            self._disc = parse_toc_disc(lines)
+            if self._disc is None:
+                raise ValueError("no disc ID for the TOC")
+            self._isrcs = list(parse_cdrdao_toc(lines))
+
+    def _read(self):
+        """Waits for the read, returns False if it fails"""
+        if self._latency:
+            time.sleep(self._latency)
+        return self._random.random() >= self._error_rate
+
+    def read_disc(self):
+        """Returns the disc, like discid.read"""
+        if not self._read():
+            raise discid.DiscError("virtual read error of the TOC")
+        return self._disc
+
+    def read_isrcs(self):
+        """yields (track_number, isrc) while the tracks are read"""
+        isrcs = dict()
+        for number, isrc in self._isrcs:
+            isrcs.setdefault(number, []).append(isrc)
+        for track in self._disc.tracks:
+            if not self._read():
+                print_error("virtual read error on track %d" % track.number)
+                sys.exit(1)
+            for isrc in isrcs.get(track.number, []):
+                yield track.number, isrc
+
+def open_virtual_drive(path):
+    """Returns the VirtualDrive for the recording in path"""
+    try:
+        return VirtualDrive(path, options.virtual_latency,
+                            options.virtual_errors)
+    except (IOError, OSError, ValueError, KeyError,
+            pickle.UnpicklingError) as err:
+        print_error("Couldn't load the recorded disc %s: %s" % (path, err))
+        sys.exit(1)
+
+def read_drive(device, backend):
+    """read the disc ID and the ISRCs from one drive
+
+    The releases are looked up while the ISRCs are read.
+    This doesn't need any user interaction,
+    so it can run for several drives in parallel.
+    """
+    disc = Disc(device, backend)
+    lookup = disc.prefetch_releases()
+    backend_output = list(read_isrcs(disc, backend))
+    if lookup is not None:
+        lookup.result()
+    return disc, backend_output
+
+
+def parse_libdiscid(tracks):
+    """yields (track_number, isrc) for the tracks read by libdiscid"""
+    pattern = r'[A-Z]{2}[A-Z0-9]{3}\d{2}\d{5}'
+    for track in tracks:
+        if track.isrc:
+            match = re.match(pattern, track.isrc)
+            if match is None:
+                print("no valid ISRC: %s" % track.isrc)
+            else:
+                yield track.number, track.isrc
+
+def parse_discisrc(lines):
+    """yields (track_number, isrc) for each line of discisrc output"""
+    pattern = \
+        r'Track\s+([0-9]+)\s+:\s+([A-Z]{2})-?([A-Z0-9]{3})-?(\d{2})-?(\d{5})'
+    for line in lines:
+        if line.startswith("Track") and len(line) > 12:
+            match = re.search(pattern, line)
+            if match is None:
+                print("can't find ISRC in: %s" % line)
+                continue
+            track_number = int(match.group(1))
+            isrc = ("%s%s%s%s" % (match.group(2), match.group(3),
+                                  match.group(4), match.group(5)))
+            yield track_number, isrc
+
+def parse_mediatools(lines):
+    """yields (track_number, isrc) for each line of mediatools output"""
+    pattern = \
+        r'ISRC\s+([0-9]+)\s+([A-Z]{2})-?([A-Z0-9]{3})-?(\d{2})-?(\d{5})'
+    for line in lines:
+        if line.startswith("ISRC") and not line.startswith("ISRCS"):
+            match = re.search(pattern, line)
+            if match is None:
+                print("can't find ISRC in: %s" % line)
+                continue
+            track_number = int(match.group(1))
+            isrc = ("%s%s%s%s" % (match.group(2), match.group(3),
+                                  match.group(4), match.group(5)))
+            yield track_number, isrc
+
+def parse_cdrdao_toc(lines):
+    """yields (track_number, isrc) for each ISRC in a cdrdao TOC file"""
+    # no byte pattern, file is opened as unicode
+    pattern = r'[A-Z]{2}[A-Z0-9]{3}\d{2}\d{5}'
+    track_number = None
+    for line in lines:
+        words = line.split()
+        if words:
+            if words[0] == "//":
+                track_number = int(words[2])
+            elif words[0] == "ISRC" and track_number is not None:
+                isrc = "".join(words[1:]).strip('"- ')
+                match = re.match(pattern, isrc)
                 if match is None:
-                    print("no valid ISRC: %s" % track.isrc)
+                    print("no valid ISRC: %s" % isrc)
                 else:
-                    backend_output.append((track.number, track.isrc))
+                    yield track_number, isrc
+                    # safeguard against missing trackNumber lines
+                    # or duplicated ISRC tags (like in CD-Text)
+                    track_number = None
+
+def read_cdrdao_toc(device):
+    """read the TOC with cdrdao, returns the lines of the TOC file"""
+    # cdrdao will create a temp file and we delete it afterwards
+    # cdrdao is also available for windows
+    # this will also fetch ISRCs from CD-TEXT
+    backend = "cdrdao"
+    tmpname = "cdrdao-%s.toc" % datetime.now()
+    tmpname = tmpname.replace(":", "-")     # : is invalid on windows
+    tmpfile = os.path.join(tempfile.gettempdir(), tmpname)
+    logger.info("Saving toc in %s..", tmpfile)
+    if os.name == "nt":
+        if device != discid.get_default_device():
+            logger.warning("cdrdao uses the default device")
+        args = [backend, "read-toc", "-v", "0", tmpfile]
+    else:
+        args = [backend, "read-toc", "--device", device, "-v", "0", tmpfile]
+    try:
+        with open(os.devnull, "w") as devnull:
+            if options.debug:
+                proc = Popen(args, stdout=devnull)
+            else:
+                proc = Popen(args, stdout=devnull, stderr=devnull)
+            if proc.wait() != 0:
+                print_error("%s returned with %i" % (backend, proc.returncode))
+                sys.exit(1)
+    except OSError as err:
+        backend_error(err)
+    else:
+        # the TOC is only written when cdrdao is done,
+        # so there is nothing to stream before
+        # that file seems to be opened in Unicode mode in Python 3
+        with open(tmpfile, "r") as toc:
+            return list(read_lines(toc, backend))
+    finally:
+        try:
+            os.unlink(tmpfile)
+        except OSError:
+            pass
+
+def read_lines(stream, name, keep=None):
+    """yields decoded lines of the output of a backend as they come in
+
+    The lines are also added to keep, if given.
+    """
+    ext_logger = logging.getLogger(name)
+    for line in stream:
+        line = decode(line) # explicitely decode from pipe
+        ext_logger.debug(line.rstrip())    # rstrip newline
+        if keep is not None:
+            keep.append(line)
+        yield line
+
+def iter_isrcs(disc, backend, device):
+    """read the disc in the device with the backend and extract the ISRCs
+
+    This yields (track_number, isrc) as soon as an ISRC is found.
+    """
+    if backend == "libdiscid":
+        for item in parse_libdiscid(disc.tracks):
+            yield item
 
     # redundant to "libdiscid", but this might be handy for prerelease testing
     elif backend == "discisrc":
-        pattern = \
-            r'Track\s+([0-9]+)\s+:\s+([A-Z]{2})-?([A-Z0-9]{3})-?(\d{2})-?(\d{5})'
         try:
             if sys.platform == "darwin":
                 device = get_real_mac_device(device)
@@ -840,25 +2888,14 @@ def gather_isrcs(disc, backend, device):
             isrcout = proc.stdout
         except OSError as err:
             backend_error(err)
-        for line in isrcout:
-            line = decode(line) # explicitely decode from pipe
-            ext_logger = logging.getLogger("discisrc")
-            ext_logger.debug(line.rstrip())    # rstrip newline
-            if line.startswith("Track") and len(line) > 12:
-                match = re.search(pattern, line)
-                if match is None:
-                    print("can't find ISRC in: %s" % line)
-                    continue
-                track_number = int(match.group(1))
-                isrc = ("%s%s%s%s" % (match.group(2), match.group(3),
-                                      match.group(4), match.group(5)))
-                backend_output.append((track_number, isrc))
+        disc.backend_lines = []
+        for item in parse_discisrc(read_lines(isrcout, backend,
+                                              disc.backend_lines)):
+            yield item
 
     # media_info is a preview version of mediatools, both are for Windows
     # this does some kind of raw read
     elif backend in ["mediatools", "media_info"]:
-        pattern = \
-            r'ISRC\s+([0-9]+)\s+([A-Z]{2})-?([A-Z0-9]{3})-?(\d{2})-?(\d{5})'
         if backend == "mediatools":
             args = [backend, "drive", device, "isrc"]
         else:
@@ -868,142 +2905,248 @@ def gather_isrcs(disc, backend, device):
             isrcout = proc.stdout
         except OSError as err:
             backend_error(err)
-        for line in isrcout:
-            line = decode(line) # explicitely decode from pipe
-            ext_logger = logging.getLogger("mediatools")
-            ext_logger.debug(line.rstrip())    # rstrip newline
-            if line.startswith("ISRC") and not line.startswith("ISRCS"):
-                match = re.search(pattern, line)
-                if match is None:
-                    print("can't find ISRC in: %s" % line)
-                    continue
-                track_number = int(match.group(1))
-                isrc = ("%s%s%s%s" % (match.group(2), match.group(3),
-                                      match.group(4), match.group(5)))
-                backend_output.append((track_number, isrc))
+        disc.backend_lines = []
+        for item in parse_mediatools(read_lines(isrcout, "mediatools",
+                                                disc.backend_lines)):
+            yield item
 
     # cdrdao will create a temp file and we delete it afterwards
     # cdrdao is also available for windows
     # this will also fetch ISRCs from CD-TEXT
     elif backend == "cdrdao":
-        # no byte pattern, file is opened as unicode
-        pattern = r'[A-Z]{2}[A-Z0-9]{3}\d{2}\d{5}'
-        tmpname = "cdrdao-%s.toc" % datetime.now()
-        tmpname = tmpname.replace(":", "-")     # : is invalid on windows
-        tmpfile = os.path.join(tempfile.gettempdir(), tmpname)
-        logger.info("Saving toc in %s..", tmpfile)
-        if os.name == "nt":
-            if device != discid.get_default_device():
-                logger.warning("cdrdao uses the default device")
-            args = [backend, "read-toc", "-v", "0", tmpfile]
-        else:
-            args = [backend, "read-toc", "--device", device, "-v", "0", tmpfile]
-        try:
-            if options.debug:
-                proc = Popen(args, stdout=devnull)
-            else:
-                proc = Popen(args, stdout=devnull, stderr=devnull)
-            if proc.wait() != 0:
-                print_error("%s returned with %i" % (backend, proc.returncode))
-                sys.exit(1)
-        except OSError as err:
-            backend_error(err)
+        if disc.cdrdao_toc is not None:
+            # the TOC was already read for the disc ID
+            lines = disc.cdrdao_toc
         else:
-            # that file seems to be opened in Unicode mode in Python 3
-            with open(tmpfile, "r") as toc:
-                track_number = None
-                for line in toc:
-                    ext_logger = logging.getLogger("cdrdao")
-                    ext_logger.debug(line.rstrip())    # rstrip newline
-                    words = line.split()
-                    if words:
-                        if words[0] == "//":
-                            track_number = int(words[2])
-                        elif words[0] == "ISRC" and track_number is not None:
-                            isrc = "".join(words[1:]).strip('"- ')
-                            match = re.match(pattern, isrc)
-                            if match is None:
-                                print("no valid ISRC: %s" % isrc)
-                            else:
-                                backend_output.append((track_number, isrc))
-                                # safeguard against missing trackNumber lines
-                                # or duplicated ISRC tags (like in CD-Text)
-                                track_number = None
-        finally:
-            try:
-                os.unlink(tmpfile)
-            except OSError:
-                pass
+            lines = read_cdrdao_toc(device)
+        disc.backend_lines = lines
+        for item in parse_cdrdao_toc(lines):
+            yield item
 
-    devnull.close()
-    return backend_output
+    elif backend == "virtual":
+        for item in disc.virtual_drive.read_isrcs():
+            yield item
 
-def check_isrcs_local(backend_output, mb_tracks):
-    """check backend_output for (local) duplicates and inconsistencies
+def gather_isrcs(disc, backend, device):
+    """read the disc in the device with the backend and extract the ISRCs
+
+    Returns a list of (track_number, isrc).
     """
-    isrcs = dict()          # isrcs found on disc
-    tracks2isrcs = dict()   # isrcs to be submitted
-    errors = 0
+    return list(iter_isrcs(disc, backend, device))
 
-    for (track_number, isrc) in backend_output:
-        if isrc not in isrcs:
-            isrcs[isrc] = Isrc(isrc)
-            # check if we found this ISRC for multiple tracks
-            with_isrc = [item for item in backend_output if item[1] == isrc]
-            if len(with_isrc) > 1:
-                track_list = [str(item[0]) for item in with_isrc]
-                print_error("%s gave the same ISRC for multiple tracks!"
-                            % options.backend,
-                            "ISRC: %s\ttracks: %s"
-                            % (isrc, ", ".join(track_list)))
-                errors += 1
-        try:
-            track = mb_tracks[track_number - 1]
-        except IndexError:
+class LocalIsrcCheck(object):
+    """check ISRCs for (local) duplicates and inconsistencies
+
+    The ISRCs are checked one by one, as soon as the backend finds them.
+    Duplicates can only be reported when all ISRCs are known.
+    """
+
+    def __init__(self, medium, backend=None):
+        self._medium = medium
+        self._backend = backend or options.backend
+        self._track_numbers = dict()    # isrc -> track numbers
+        self.isrcs = dict()             # isrcs found on disc
+        self.tracks2isrcs = dict()      # isrcs to be submitted
+        self.found = dict()             # track number -> isrc
+        self.attached = []              # isrcs already in the database
+        self.errors = 0
+
+    def add(self, track_number, isrc):
+        if isrc not in self.isrcs:
+            self.isrcs[isrc] = Isrc(isrc)
+            self._track_numbers[isrc] = []
+        self._track_numbers[isrc].append(track_number)
+        self.found[track_number] = isrc
+        track = self._medium.track(track_number)
+        if track is None:
             print_error("ISRC %s found for unknown track %d"
                         % (isrc, track_number))
-            errors += 1
+            self.errors += 1
         else:
-            own_track = OwnTrack(track, track_number)
-            isrcs[isrc].add_track(own_track)
+            self.isrcs[isrc].add_track(track, own=True)
             # check if the ISRC was already added to the track
-            if isrc not in own_track.get("isrc-list", []):
+            if isrc not in track.isrcs:
                 # single isrcs work in python-musicbrainzngs 0.4, but not 0.3
                 # lists of isrcs don't work in 0.4 though, see pymbngs #113
-                tracks2isrcs[own_track["id"]] = isrc
+                self.tracks2isrcs[track.id] = isrc
                 print("found new ISRC for track %d: %s"
                       % (track_number, isrc))
             else:
+                self.attached.append(isrc)
                 print("%s is already attached to track %d"
                       % (isrc, track_number))
 
-    return isrcs, tracks2isrcs, errors
+    def finish(self):
+        """Report duplicates, returns isrcs, tracks2isrcs, errors"""
+        for isrc in self.isrcs:
+            track_numbers = self._track_numbers[isrc]
+            # check if we found this ISRC for multiple tracks
+            if len(track_numbers) > 1:
+                track_list = [str(number) for number in track_numbers]
+                print_error("%s gave the same ISRC for multiple tracks!"
+                            % self._backend,
+                            "ISRC: %s\ttracks: %s"
+                            % (isrc, ", ".join(track_list)))
+                self.errors += 1
+        return self.isrcs, self.tracks2isrcs, self.errors
 
-def check_global_duplicates(release, mb_tracks, isrcs):
-    """Help cleaning up global duplicates with the information we got
-    from our disc.
+def check_isrcs_local(backend_output, medium, backend=None):
+    """check backend_output for (local) duplicates and inconsistencies
+    """
+    check = LocalIsrcCheck(medium, backend)
+    for (track_number, isrc) in backend_output:
+        check.add(track_number, isrc)
+    return check.finish()
+
+def find_global_duplicates(release, isrcs):
+    """Add the tracks of all media of the release to the ISRCs of our disc.
+
+    Returns the number of ISRCs attached to multiple tracks.
     """
     duplicates = 0
-    # add already attached ISRCs
-    for i in range(0, len(mb_tracks)):
-        track = mb_tracks[i]
-        track_number = i + 1
-        track = Track(track, track_number)
-        for isrc in track.get("isrc-list", []):
-            # only check ISRCS we also found on our disc
-            if isrc in isrcs:
-                isrcs[isrc].add_track(track)
-    # check if we have multiple tracks for one ISRC
+    # add already attached ISRCs, only those we also found on our disc
     for isrc in isrcs:
+        for track in release.tracks_with_isrc(isrc):
+            isrcs[isrc].add_track(track)
+        # check if we have multiple tracks for one ISRC
         if len(isrcs[isrc].get_tracks()) > 1:
             duplicates += 1
+    return duplicates
+
+def check_global_duplicates(release, isrcs, conflicts=None):
+    """Help cleaning up global duplicates with the information we got
+    from our disc.
 
+    The conflicts are recordings outside of the release by ISRC,
+    they are only shown in the cleanup report.
+    Returns the number of ISRCs attached to multiple tracks.
+    """
+    duplicates = find_global_duplicates(release, isrcs)
+    if options.headless:
+        if duplicates > 0:
+            print("There were %d ISRCs that are attached to multiple tracks"
+                  " on this release." % duplicates)
+        return duplicates
     if duplicates > 0:
         printf("\nThere were %d ISRCs ", duplicates)
         print("that are attached to multiple tracks on this release.")
-        choice = user_input("Do you want to help clean those up? [y/N] ")
-        if choice.lower() == "y":
+    elif conflicts and options.cleanup_report:
+        print("\nThere were %d ISRCs " % len(conflicts)
+              + "that are attached to recordings on other releases.")
+    else:
+        return duplicates
+    choice = user_input("Do you want to help clean those up? [y/N] ")
+    if choice.lower() == "y":
+        if options.cleanup_report:
+            show_cleanup_report(release, isrcs, conflicts)
+        else:
             cleanup_isrcs(release, isrcs)
+    return duplicates
+
+def cleanup_report(release, isrcs, conflicts=None):
+    """Returns an HTML page with all duplicate ISRCs and links to edit them
+    """
+    server = "http://%s" % options.server
+    def link(path, text):
+        return '<a href="%s/%s" target="_blank">%s</a>' % (
+                server, path, html.escape(text or ""))
+
+    lines = ["<!DOCTYPE html>", "<html><head>", '<meta charset="utf-8">',
+             "<title>ISRC cleanup: %s</title>"
+             % html.escape(release.title or ""),
+             "</head><body>",
+             "<h1>ISRC cleanup for %s - %s</h1>"
+             % (html.escape(release.artist or ""),
+                link("release/%s" % release.id, release.title)),
+             "<p>The ISRCs marked as our evaluation were read from the disc."
+             " Remove them from the other recordings.</p>"]
+    for isrc in sorted(isrcs):
+        tracks = isrcs[isrc].get_tracks()
+        if len(tracks) < 2:
+            continue
+        lines.append("<h2>%s</h2>" % link("isrc/%s" % isrc, isrc))
+        lines.append("<table>")
+        for track in tracks:
+            if track.artist and track.artist != release.artist:
+                title = "%s - %s" % (track.artist, track.title)
+            else:
+                title = track.title
+            lines.append("<tr><td>disc %d track %d</td><td>%s</td><td>%s</td>"
+                         "</tr>" % (track.medium, track.position,
+                                    link("recording/%s" % track.id, title),
+                                    "[OUR EVALUATION]"
+                                    if isrcs[isrc].is_own(track) else ""))
+        lines.append("</table>")
+    if conflicts:
+        lines.append("<h2>ISRCs also used outside of this release</h2>")
+        for isrc in sorted(conflicts):
+            lines.append("<h3>%s</h3>" % link("isrc/%s" % isrc, isrc))
+            lines.append("<ul>")
+            for recording in conflicts[isrc]:
+                title = "%s - %s" % (recording.get("artist-credit-phrase"),
+                                     recording.get("title"))
+                lines.append("<li>%s</li>"
+                             % link("recording/%s" % recording["id"], title))
+            lines.append("</ul>")
+    lines.append("</body></html>")
+    return "\n".join(lines) + "\n"
+
+def show_cleanup_report(release, isrcs, conflicts=None):
+    """Write the cleanup report to a file and open it in the browser"""
+    report_fd, path = tempfile.mkstemp(prefix="isrcsubmit-cleanup-",
+                                       suffix=".html")
+    with os.fdopen(report_fd, "w", encoding="utf-8") as report_file:
+        report_file.write(cleanup_report(release, isrcs, conflicts))
+    print("The cleanup report is saved in %s" % path)
+    open_browser(pathlib.Path(path).as_uri())
+
+def lookup_isrcs(isrcs):
+    """Fetch the recordings for all ISRCs in parallel.
+
+    Returns a dict ISRC -> recordings, failed lookups are left out.
+    """
+    includes = ["artists", "releases"]
+    recordings = dict()
+    with futures.ThreadPoolExecutor(ISRC_LOOKUP_WORKERS) as executor:
+        lookup = with_timings(ws2.get_recordings_by_isrc, current_timings())
+        lookups = dict([(executor.submit(lookup, isrc, includes), isrc)
+                        for isrc in isrcs])
+        for lookup in futures.as_completed(lookups):
+            isrc = lookups[lookup]
+            try:
+                recordings[isrc] = lookup.result()
+            except musicbrainzngs.WebServiceError as err:
+                print_error("Couldn't look up ISRC %s: %s" % (isrc, err))
+    return recordings
+
+def find_isrc_conflicts(release, recordings):
+    """Returns a dict ISRC -> recordings outside of the release"""
+    conflicts = dict()
+    for isrc in recordings:
+        others = [recording for recording in recordings[isrc]
+                  if not release.has_recording(recording["id"])]
+        if others:
+            conflicts[isrc] = others
+    return conflicts
+
+def check_isrc_conflicts(release, isrcs):
+    """Show recordings on other releases that have the ISRCs of our disc
+    """
+    print("\nLooking up %d ISRCs.." % len(isrcs))
+    conflicts = find_isrc_conflicts(release, lookup_isrcs(isrcs))
+    if not conflicts:
+        print("The ISRCs are not attached to other recordings.")
+    for isrc in sorted(conflicts):
+        print("\nISRC %s is also attached to:" % isrc)
+        for recording in conflicts[isrc]:
+            releases = [other["title"] for other
+                        in recording.get("release-list", [])]
+            string = "\t%s - %s" % (recording.get("artist-credit-phrase"),
+                                    recording.get("title"))
+            if releases:
+                string += " (%s)" % ", ".join(sorted(set(releases)))
+            print_encoded(string + "\n")
+    return conflicts
 
 def cleanup_isrcs(release, isrcs):
     """Show information about duplicate ISRCs
@@ -1016,11 +3159,10 @@ def cleanup_isrcs(release, isrcs):
             print("\nISRC %s attached to:" % isrc)
             for track in tracks:
                 printf("\t")
-                artist = track.get("artist-credit-phrase")
-                if artist and artist != release["artist-credit-phrase"]:
-                    string = "%s - %s" % (artist, track["title"])
+                if track.artist and track.artist != release.artist:
+                    string = "%s - %s" % (track.artist, track.title)
                 else:
-                    string = "%s" % track["title"]
+                    string = "%s" % track.title
                 print_encoded(string)
                 # tab alignment
                 if len(string) >= 32:
@@ -1035,8 +3177,11 @@ def cleanup_isrcs(release, isrcs):
                     if len(string) < 31:
                         printf("\t")
 
-                printf("\t track %s", track["position"])
-                if isinstance(track, OwnTrack):
+                if len(release.media) > 1:
+                    printf("\t disc %d track %d", track.medium, track.position)
+                else:
+                    printf("\t track %d", track.position)
+                if isrcs[isrc].is_own(track):
                     print("   [OUR EVALUATION]")
                 else:
                     print("")
@@ -1047,9 +3192,444 @@ def cleanup_isrcs(release, isrcs):
                 user_input("(press <return> when done with this ISRC) ")
 
 
+def process_disc(disc, backend_output=None):
+    """Find the release for a disc, check the ISRCs and submit new ones.
+
+    If no backend_output is given, the ISRCs are read from the drive
+    while the release is looked up.
+    Returns a summary of the results for this disc.
+    """
+    with timings_for(disc.timings):
+        try:
+            return _process_disc(disc, backend_output)
+        finally:
+            logger.debug("timings of disc %s: %s", disc.id, disc.timings)
+
+def _process_disc(disc, backend_output):
+    summary = {"device": disc.device, "disc_id": disc.id, "release_id": None,
+               "isrcs": 0, "new": 0, "errors": 0, "submitted": False}
+    timings = summary["timings"] = dict()
+    start = time.time()
+    if backend_output is None:
+        # the drive is read while the release is looked up and chosen
+        backend_output = BackgroundStream(read_isrcs, (disc, options.backend))
+    if isinstance(backend_output, BackgroundStream):
+        read_all = backend_output.collect
+    else:
+        read_all = lambda: backend_output
+    try:
+        disc.get_release(read_isrcs=read_all)
+    except (DiscSkipped, SystemExit) as err:
+        if not options.headless:
+            raise
+        # the drive is still needed for the next disc
+        summary["found"] = dict(read_all())
+        if isinstance(err, SystemExit):
+            raise
+        summary["status"] = "skipped"
+        summary["reason"] = err.reason
+        summary["submission_url"] = err.url
+        timings["total"] = time.time() - start
+        return summary
+    timings["release"] = time.time() - start
+    print("")
+    print_release(disc.release)
+    summary["release_id"] = disc.release.id
+    if not disc.asked_for_submission and not options.headless:
+        print("")
+        print("Is this information different for your release?")
+        ask_for_submission(disc.submission_url)
+
+    medium = disc.medium
+
+    print("")
+    # the ISRCs are checked as they come in from the backend
+    check = LocalIsrcCheck(medium, disc.backend)
+    try:
+        for (track_number, isrc) in backend_output:
+            check.add(track_number, isrc)
+    except SystemExit:
+        # the error was printed, the ISRCs found so far can still be used
+        check.errors += 1
+    # list, dict
+    isrcs, tracks2isrcs, errors = check.finish()
+    timings["isrcs"] = time.time() - start
+    summary["isrcs"] = len(isrcs)
+    summary["new"] = len(tracks2isrcs)
+    summary["errors"] = errors
+    summary["found"] = check.found
+    summary["new_isrcs"] = sorted(tracks2isrcs.values())
+    summary["attached"] = sorted(check.attached)
+
+    if isrcs:
+        print("")
+    # try to submit the ISRCs
+    update_intention = True
+    if not tracks2isrcs:
+        print("No new ISRCs could be found.")
+    else:
+        if errors > 0:
+            print_error("%d problems detected" % errors)
+        if options.headless:
+            submit = options.submit
+        else:
+            submit = user_input("Do you want to submit? [y/N] ").lower() == "y"
+        if submit:
+            # the other discs of the release are checked against these
+            disc.release.attach_isrcs(tracks2isrcs)
+            summary["spool_entry"] = spool.add(options.server, disc.id,
+                                               disc.release.id,
+                                               tracks2isrcs)
+            if batch is not None:
+                batch.add(summary, tracks2isrcs)
+                print("The ISRCs will be submitted with all other discs.")
+            elif ws2.submit_isrcs(tracks2isrcs):
+                spool.done(summary["spool_entry"])
+                ws2.forget_release(disc.release.id)
+                summary["submitted"] = True
+            else:
+                summary["error"] = "kept in spool"
+                print("The ISRCs were saved. Submit them later with:")
+                print("%s --flush-spool" % SCRIPTNAME)
+        else:
+            update_intention = False
+            print("Nothing was submitted to the server.")
+
+    # check for overall duplicate ISRCs, including server provided
+    if update_intention:
+        # the ISRCs are deemed correct, so we can use them to check others
+        conflicts = None
+        if options.isrc_lookup and isrcs:
+            conflicts = check_isrc_conflicts(disc.release, isrcs)
+            summary["conflicts"] = len(conflicts)
+        summary["duplicates"] = check_global_duplicates(disc.release, isrcs,
+                                                        conflicts)
+
+    timings["total"] = time.time() - start
+    return summary
+
+def process_devices(devices, backend):
+    """Read all drives in parallel and handle the discs one after another.
+
+    Only reading the drives runs in parallel.
+    Choosing releases and submitting is done in the order
+    the drives finish, so the questions for the user don't overlap.
+    """
+    finished = queue.Queue()
+    task_devices = dict()
+    for device in devices:
+        task = BackgroundTask(read_drive, (device, backend), notify=finished)
+        task_devices[task] = device
+
+    summaries = []
+    for i in range(len(devices)):
+        task = finished.get()
+        device = task_devices[task]
+        try:
+            disc, backend_output = task.result()
+        except SystemExit:
+            # the details were already printed in the drive thread
+            print_error("Couldn't read the disc in %s" % device)
+            summaries.append({"device": device, "disc_id": None})
+            continue
+        print("\nDevice:\t\t%s" % disc.device)
+        print_disc(disc)
+        try:
+            summaries.append(process_disc(disc, backend_output))
+        except SystemExit:
+            summaries.append({"device": disc.device, "disc_id": disc.id})
+    return summaries
+
+def submit_batch():
+    """submit all ISRCs collected with --batch-submit"""
+    if not batch:
+        return
+    print("\nSubmitting the ISRCs of %d discs.." % len(batch))
+    for summary, error in ws2.submit_batch(batch):
+        if error is None:
+            summary["submitted"] = True
+            spool.done(summary["spool_entry"])
+            ws2.forget_release(summary["release_id"])
+        else:
+            summary["error"] = error
+            print_error("Couldn't send ISRCs for disc %s: %s"
+                        % (summary["disc_id"], error))
+
+class ErrorRecorder(logging.Handler):
+    """Keeps the errors logged while a disc is processed"""
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.errors = []
+
+    def emit(self, record):
+        self.errors.append(record.getMessage())
+
+def read_manifest(manifest_file):
+    """Returns the jobs of a manifest with one JSON object per line.
+
+    A job has a device, an optional release_id, the ambiguous and unknown
+    policies for disc IDs and if new ISRCs should be submitted.
+    """
+    jobs = []
+    for number, line in enumerate(manifest_file, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError("not an object")
+        except ValueError as err:
+            print_error("Invalid job in line %d of the manifest: %s"
+                        % (number, err))
+            sys.exit(-1)
+        for key, value in default_job(options.device).items():
+            job.setdefault(key, value)
+        if job["ambiguous"] not in AMBIGUOUS_POLICIES:
+            print_error("Invalid policy for ambiguous disc IDs in line %d: %s"
+                        % (number, job["ambiguous"]),
+                        "Choose from %s" % ", ".join(AMBIGUOUS_POLICIES))
+            sys.exit(-1)
+        if job["unknown"] not in UNKNOWN_POLICIES:
+            print_error("Invalid policy for unknown disc IDs in line %d: %s"
+                        % (number, job["unknown"]),
+                        "Choose from %s" % ", ".join(UNKNOWN_POLICIES))
+            sys.exit(-1)
+        jobs.append(job)
+    return jobs
+
+def default_job(device):
+    """Returns the settings of a headless job without manifest entry
+
+    New ISRCs are only submitted with --submit.
+    """
+    return {"device": device, "release_id": None,
+            "ambiguous": AMBIGUOUS_POLICIES[0],
+            "unknown": UNKNOWN_POLICIES[0], "submit": options.auto_submit}
+
+def run_job(job, backend, capture=None):
+    """Process the disc of a headless job, returns the summary
+
+    The disc is read from the capture, if given.
+    """
+    options.device = job["device"]
+    options.release_id = job["release_id"]
+    options.ambiguous = job["ambiguous"]
+    options.unknown = job["unknown"]
+    options.submit = job["submit"]
+    recorder = ErrorRecorder()
+    logging.getLogger().addHandler(recorder)
+    summary = {"device": job["device"], "disc_id": None, "release_id": None}
+    start = time.time()
+    try:
+        if capture is None:
+            disc = get_disc(job["device"], backend)
+            backend_output = None
+        else:
+            disc = CapturedDisc(job["device"], capture)
+            print_disc(disc)
+            backend_output = capture["output"]
+        summary["disc_id"] = disc.id
+        read_time = time.time() - start
+        summary = process_disc(disc, backend_output)
+        summary["timings"]["disc"] = read_time
+    except SystemExit:
+        # the error was logged
+        summary["status"] = "error"
+    finally:
+        logging.getLogger().removeHandler(recorder)
+    summary["messages"] = recorder.errors
+    summary.setdefault("timings", dict())["job"] = time.time() - start
+    return summary
+
+def result_record(summary):
+    """The machine readable result of a disc in headless mode"""
+    if summary.get("status"):
+        status = summary["status"]
+    elif summary.get("submitted"):
+        status = "submitted"
+    elif summary.get("error"):
+        status = "error"
+    elif summary.get("new"):
+        status = "not submitted"
+    else:
+        status = "no new ISRCs"
+    record = {"device": summary["device"], "disc_id": summary["disc_id"],
+              "release_id": summary["release_id"], "status": status,
+              "isrcs": dict([(str(number), isrc) for number, isrc
+                             in summary.get("found", {}).items()]),
+              "new": summary.get("new_isrcs", []),
+              "attached": summary.get("attached", []),
+              "duplicates": summary.get("duplicates", 0),
+              "conflicts": summary.get("conflicts"),
+              "errors": summary.get("errors", 0),
+              "messages": summary.get("messages", []),
+              "timings": dict([(name, round(seconds, 3)) for name, seconds
+                               in summary.get("timings", {}).items()])}
+    for key in ["reason", "error", "submission_url"]:
+        if summary.get(key):
+            record[key] = summary[key]
+    return record
+
+def run_manifest(manifest, results):
+    """Process all jobs of the manifest without asking the user.
+
+    Returns the number of discs that failed.
+    """
+    if manifest == "-":
+        jobs = read_manifest(sys.stdin)
+    else:
+        try:
+            with open(manifest, "r") as manifest_file:
+                jobs = read_manifest(manifest_file)
+        except IOError as err:
+            print_error("Couldn't read the manifest: %s" % err)
+            sys.exit(-1)
+    return run_headless((run_job(job, options.backend) for job in jobs),
+                        results)
+
+def load_captures(paths):
+    """Yields (path, capture or error) in order.
+
+    The captures are loaded and parsed in worker processes
+    while the discs before are processed.
+    Only a few captures are loaded ahead, so memory stays bounded.
+    """
+    paths = iter(paths)
+    with futures.ProcessPoolExecutor() as executor:
+        loads = deque()
+        while True:
+            while len(loads) < CAPTURE_PREFETCH:
+                path = next(paths, None)
+                if path is None:
+                    break
+                loads.append((path, executor.submit(load_capture, path)))
+            if not loads:
+                break
+            path, load = loads.popleft()
+            try:
+                capture = load.result()
+            except (IOError, OSError, EOFError, zlib.error,
+                    ValueError, KeyError, TypeError) as err:
+                yield path, err
+            else:
+                yield path, capture
+
+def ingest_captures(paths, results):
+    """Process captured discs without asking the user.
+
+    Web service lookups and submissions are done in this process,
+    so they share the rate limit and the authentication.
+    Returns the number of discs that failed.
+    """
+    def summaries():
+        for path, capture in load_captures(find_captures(paths)):
+            if isinstance(capture, Exception):
+                print_error("Couldn't load %s: %s" % (path, capture))
+                yield {"device": path, "disc_id": None, "release_id": None,
+                       "status": "error", "messages": [str(capture)]}
+            else:
+                yield run_job(default_job(path), capture["backend"], capture)
+    return run_headless(summaries(), results)
+
+def run_headless(summaries, results):
+    """Write the summaries of headless jobs as they are produced.
+
+    The results are written as JSON lines, all other output goes to stderr.
+    Returns the number of discs that failed.
+    """
+    if results == "-":
+        results_file = sys.stdout
+    else:
+        results_file = open(results, "a")
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+
+    def write(summary):
+        results_file.write(json.dumps(result_record(summary), sort_keys=True)
+                           + "\n")
+        results_file.flush()
+
+    failed = 0
+    try:
+        done = []
+        for summary in summaries:
+            if batch is None:
+                # the results are final
+                write(summary)
+            done.append(summary)
+        submit_batch()
+        for summary in done:
+            if batch is not None:
+                write(summary)
+            if result_record(summary)["status"] == "error":
+                failed += 1
+    finally:
+        sys.stdout = stdout
+        if results_file is not stdout:
+            results_file.close()
+    return failed
+
+def flush_spool():
+    """submit all spooled ISRCs for the server, retrying failed discs"""
+    entries = spool.pending(options.server)
+    if not entries:
+        print("There are no spooled ISRCs for %s." % options.server)
+        return
+    print("Submitting spooled ISRCs of %d discs.." % len(entries))
+    for attempt in range(SPOOL_RETRIES):
+        if attempt:
+            logger.info("retrying %d discs in %d seconds",
+                        len(entries), SPOOL_RETRY_DELAY * attempt)
+            time.sleep(SPOOL_RETRY_DELAY * attempt)
+        spooled = SubmissionBatch(options.batch_size)
+        for entry in entries:
+            spooled.add(entry, entry["tracks2isrcs"])
+        entries = []
+        for entry, error in ws2.submit_batch(spooled):
+            if error is None:
+                spool.done(entry["id"])
+                ws2.forget_release(entry["release_id"])
+            else:
+                logger.info("Couldn't send ISRCs for disc %s: %s",
+                            entry["disc_id"], error)
+                entries.append(entry)
+        if not entries:
+            break
+    spool.compact()
+    if entries:
+        print_error("%d discs couldn't be submitted, they stay in the spool."
+                    % len(entries))
+        sys.exit(1)
+
+def print_summary(summaries):
+    print("\nSummary:")
+    for summary in summaries:
+        if summary.get("release_id") is None:
+            print("%s\t%s\tnot processed"
+                  % (summary["device"] or "(unknown device)",
+                     summary["disc_id"] or "(no disc ID)"))
+        else:
+            if summary["submitted"]:
+                result = "%d new ISRCs submitted" % summary["new"]
+            elif summary.get("error"):
+                result = "submission failed: %s" % summary["error"]
+            elif summary["new"]:
+                result = "%d new ISRCs not submitted" % summary["new"]
+            else:
+                result = "no new ISRCs"
+            print("%s\t%s\t%s\t%s" % (summary["device"], summary["disc_id"],
+                                      summary["release_id"], result))
+
 def main(argv):
     global options
     global ws2
+    global batch
+    global spool
+    global choices
+    global session_timings
+    global thread_profilers
 
     # preset logger
     stream_handler = logging.StreamHandler()
@@ -1058,7 +3638,26 @@ def main(argv):
 
     # global variables
     options = gather_options(argv)
-    ws2 = WebService2(options.user)
+    if options.batch_submit:
+        batch = SubmissionBatch(options.batch_size)
+    else:
+        batch = None
+    if options.cache:
+        cache = WebServiceCache(cache_path(),
+                                options.cache_ttl, options.cache_size)
+    else:
+        cache = None
+    if options.rate_limit > 0:
+        limiter = RateLimiter(rate_limit_path(options.server),
+                              options.rate_limit)
+    else:
+        limiter = None
+    if musicbrainzngs_version() < MIN_MUSICBRAINZNGS_VERSION:
+        print_error("python-musicbrainzngs %s is too old, %s is needed"
+                    % (musicbrainzngs.musicbrainz._version,
+                       ".".join(map(str, MIN_MUSICBRAINZNGS_VERSION))))
+        sys.exit(-1)
+    ws2 = WebService2(options.user, cache, limiter)
 
     if options.debug:
         logging.getLogger().setLevel(logging.DEBUG)
@@ -1077,53 +3676,54 @@ def main(argv):
         # add context to log file (DEBUG only added there)
         logger.debug(script_version())
 
+    spool = SubmissionSpool(spool_path())
+    choices = ChoiceStore(choices_path())
+    # a new session
+    _releases.clear()
+    session_timings = Timings()
+    del profiled_discs[:]
+    if options.cprofile:
+        thread_profilers = []
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run_session()
+    finally:
+        if options.cprofile:
+            profiler.disable()
+            write_python_profile(options.cprofile, profiler)
+            thread_profilers = None
+        logger.debug("timings outside of discs: %s", session_timings)
+        if options.profile:
+            write_profile(options.profile)
+
+def run_session():
+    """Process the discs as given by the options"""
+    if options.flush_spool:
+        flush_spool()
+        return
+
+    if options.ingest:
+        # no drive is used, libdiscid isn't needed
+        if ingest_captures(options.ingest, options.results):
+            sys.exit(1)
+        return
     logger.info("using discid version %s", discid.__version__)
+    if options.headless:
+        sys.stderr.write("using %s\n" % get_prog_version(options.backend))
+        if run_manifest(options.manifest, options.results):
+            sys.exit(1)
+        return
     print("using %s" % get_prog_version(options.backend))
 
-    disc = get_disc(options.device, options.backend)
-    disc.get_release()
-    print("")
-    print_release(disc.release)
-    if not disc.asked_for_submission:
-        print("")
-        print("Is this information different for your release?")
-        ask_for_submission(disc.submission_url)
-
-    media = []
-    for medium in disc.release["medium-list"]:
-        for disc_entry in medium["disc-list"]:
-            if disc_entry["id"] == disc.id:
-                media.append(medium)
-                break
-    if len(media) > 1:
-        raise DiscError("number of discs with id: %d" % len(media))
-    mb_tracks = media[0]["track-list"]
-
-    print("")
-    # (track, isrc)
-    backend_output = gather_isrcs(disc, options.backend, options.device)
-    # list, dict
-    isrcs, tracks2isrcs, errors = check_isrcs_local(backend_output, mb_tracks)
-
-    if isrcs:
-        print("")
-    # try to submit the ISRCs
-    update_intention = True
-    if not tracks2isrcs:
-        print("No new ISRCs could be found.")
+    if len(options.devices) > 1:
+        summaries = process_devices(options.devices, options.backend)
+        submit_batch()
+        print_summary(summaries)
     else:
-        if errors > 0:
-            print_error("%d problems detected" % errors)
-        if user_input("Do you want to submit? [y/N] ").lower() == "y":
-            ws2.submit_isrcs(tracks2isrcs)
-        else:
-            update_intention = False
-            print("Nothing was submitted to the server.")
-
-    # check for overall duplicate ISRCs, including server provided
-    if update_intention:
-        # the ISRCs are deemed correct, so we can use them to check others
-        check_global_duplicates(disc.release, mb_tracks, isrcs)
+        disc = get_disc(options.device, options.backend)
+        process_disc(disc)
+        submit_batch()
 
 if __name__ == "__main__":
     main(sys.argv)
@@ -48,7 +48,7 @@ else:
 
 args = {}
 if have_setuptools:
-    args["install_requires"] = ["discid >=1.0.0", "musicbrainzngs >=0.4"],
+    args["install_requires"] = ["discid >=1.0.0", "musicbrainzngs >=0.5"],
     # we load isrcsubmit on setup
     args["setup_requires"] = args["install_requires"],
 
@@ -100,7 +100,7 @@ setup(name="isrcsubmit",
         author="Johannes Dewender",
         author_email="brainz@JonnyJD.net",
         url="https://github.com/JonnyJD/musicbrainz-isrcsubmit",
-        requires=["discid(>=1.0.0)", "musicbrainzngs(>=0.4)"],
+        requires=["discid(>=1.0.0)", "musicbrainzngs(>=0.5)"],
         python_requires='>=3.7',
         py_modules=["isrcsubmit"],
         entry_points={
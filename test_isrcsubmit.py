@@ -7,10 +7,14 @@ import re
 import sys
 import math
 import json
+import time
 import pickle
+import shutil
+import tempfile
 import unittest
 from io import TextIOWrapper, BytesIO
 from subprocess import Popen
+from urllib.error import HTTPError
 
 import musicbrainzngs
 import isrcsubmit
@@ -27,6 +31,21 @@ SCRIPT_NAME = "isrcsubmit.py"
 TEST_DATA = "test_data/"
 SAVE_RUN = False
 
+_old_config_home = None
+
+def setUpModule():
+    # don't use or change the configuration (and cache) of the user
+    global _old_config_home
+    _old_config_home = os.environ.get("XDG_CONFIG_HOME")
+    os.environ["XDG_CONFIG_HOME"] = tempfile.mkdtemp(prefix="isrcsubmit-test-")
+
+def tearDownModule():
+    shutil.rmtree(os.environ["XDG_CONFIG_HOME"])
+    if _old_config_home is None:
+        del os.environ["XDG_CONFIG_HOME"]
+    else:
+        os.environ["XDG_CONFIG_HOME"] = _old_config_home
+
 
 class TestInternal(unittest.TestCase):
     def setUp(self):
@@ -49,6 +68,12 @@ class TestInternal(unittest.TestCase):
         self.assertEqual(isrcsubmit.encode(isrcsubmit.decode(bytestring)),
                          bytestring)
 
+    def test_musicbrainzngs_version(self):
+        version = isrcsubmit.musicbrainzngs_version()
+        self.assertTrue(version >= isrcsubmit.MIN_MUSICBRAINZNGS_VERSION)
+        self.assertEqual(".".join(map(str, version)),
+                         musicbrainzngs.musicbrainz._version)
+
     def test_gather_options(self):
         # make sure most important options always work
         options = isrcsubmit.gather_options([SCRIPT_NAME])
@@ -71,6 +96,593 @@ class TestInternal(unittest.TestCase):
                                              "--device", device])
         self.assertEqual(options.user, user)
         self.assertEqual(options.device, device)
+        other_device = "/yet/another/device"
+        options = isrcsubmit.gather_options([SCRIPT_NAME, "--device", device,
+                                             "--device", other_device])
+        self.assertEqual(options.device, device)
+        self.assertEqual(options.devices, [device, other_device])
+
+    def test_read_manifest(self):
+        manifest = ['{"device": "/dev/sr0"}\n',
+                    '{"device": "/dev/sr1", "submit": true}\n']
+        old_options = getattr(isrcsubmit, "options", None)
+        try:
+            # nothing is submitted unless asked for
+            isrcsubmit.options = isrcsubmit.gather_options(
+                    [SCRIPT_NAME, "--manifest", "-"])
+            jobs = isrcsubmit.read_manifest(manifest)
+            self.assertEqual([job["submit"] for job in jobs], [False, True])
+            isrcsubmit.options = isrcsubmit.gather_options(
+                    [SCRIPT_NAME, "--manifest", "-", "--submit"])
+            jobs = isrcsubmit.read_manifest(manifest
+                                            + ['{"submit": false}\n'])
+            self.assertEqual([job["submit"] for job in jobs],
+                             [True, True, False])
+        finally:
+            isrcsubmit.options = old_options
+
+    def test_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(cache_dir, "cache.sqlite")
+            cache = isrcsubmit.WebServiceCache(path, ttl=60, size=2)
+            self.assertTrue(cache.get("a") is None)
+            cache.put("a", {"release": {"id": "1"}}, ["1"])
+            self.assertEqual(cache.get("a"), {"release": {"id": "1"}})
+            cache.put("b", {}, ["2"])
+            cache.get("a")              # "b" is now least recently used
+            cache.put("c", {}, ["3"])
+            self.assertTrue(cache.get("b") is None)
+            self.assertTrue(cache.get("a") is not None)
+            cache.invalidate_release("1")
+            self.assertTrue(cache.get("a") is None)
+
+            expired = isrcsubmit.WebServiceCache(path, ttl=-1)
+            self.assertTrue(expired.get("c") is None)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_submission_batch(self):
+        batch = isrcsubmit.SubmissionBatch(size=3)
+        batch.add("disc1", {"rec1": "DEC680000220", "rec2": "DEC680000221"})
+        batch.add("disc2", {"rec3": "DEC680000222"})
+        # doesn't fit in the first submission anymore
+        batch.add("disc3", {"rec4": "DEC680000223"})
+        # conflicting ISRC for a recording needs another submission
+        batch.add("disc4", {"rec4": "DEC680000224"})
+        parts = batch.split()
+        self.assertEqual(len(batch), 4)
+        self.assertEqual([[item for item, isrcs in part] for part in parts],
+                         [["disc1", "disc2"], ["disc3"], ["disc4"]])
+
+    def test_spool(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            spool = isrcsubmit.SubmissionSpool(os.path.join(spool_dir, "spool"))
+            self.assertEqual(spool.pending(), [])
+            tracks2isrcs = {"rec1": "DEC680000220"}
+            first = spool.add("musicbrainz.org", "disc", "rel", tracks2isrcs)
+            # the same ISRCs are only sent once
+            again = spool.add("musicbrainz.org", "disc", "rel", tracks2isrcs)
+            self.assertEqual(first, again)
+            other = spool.add("test.musicbrainz.org", "disc", "rel",
+                              tracks2isrcs)
+            self.assertEqual(len(spool.pending()), 2)
+            self.assertEqual(len(spool.pending("musicbrainz.org")), 1)
+            spool.done(first)
+            spool.compact()
+            pending = spool.pending()
+            self.assertEqual([entry["id"] for entry in pending], [other])
+            self.assertEqual(pending[0]["tracks2isrcs"], tracks2isrcs)
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_spool_bounded(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(spool_dir, "spool")
+            spool = isrcsubmit.SubmissionSpool(path)
+            for i in range(100):
+                entry = spool.add("musicbrainz.org", "disc", "rel",
+                                  {"rec%d" % i: "DEC680000220"})
+                spool.done(entry)
+            # nothing is pending, nothing is kept
+            self.assertEqual(os.path.getsize(path), 0)
+
+            # an entry that wasn't sent stays
+            failed = spool.add("test.musicbrainz.org", "disc", "rel",
+                               {"rec": "DEC680000220"})
+            for i in range(400):
+                entry = spool.add("musicbrainz.org", "disc", "rel",
+                                  {"rec%d" % i: "DEC680000220"})
+                spool.done(entry)
+            self.assertTrue(os.path.getsize(path)
+                            <= isrcsubmit.SPOOL_COMPACT_SIZE + 1000)
+            self.assertEqual([entry["id"] for entry in spool.pending()],
+                             [failed])
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_spool_compact_locked(self):
+        import threading
+        spool_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(spool_dir, "spool")
+            spool = isrcsubmit.SubmissionSpool(path)
+            # another process appending while the spool is compacted
+            other = isrcsubmit.SubmissionSpool(path)
+            first = spool.add("musicbrainz.org", "disc1", "rel1",
+                              {"rec1": "DEC680000220"})
+            spool.done(first)
+            pending = spool.pending
+            appender = threading.Thread(target=other.add,
+                    args=("musicbrainz.org", "disc2", "rel2",
+                          {"rec2": "DEC680000221"}))
+
+            def read_and_append(server=None):
+                entries = pending(server)
+                appender.start()
+                appender.join(0.2)
+                # waiting for the lock
+                self.assertTrue(appender.is_alive())
+                return entries
+
+            spool.pending = read_and_append
+            spool.compact()
+            appender.join()
+            self.assertEqual([entry["disc_id"] for entry in other.pending()],
+                             ["disc2"])
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_rate_limiter(self):
+        state_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(state_dir, "ratelimit")
+            limiter = isrcsubmit.RateLimiter(path, rate=20)
+            # a second process sees the same bucket
+            other = isrcsubmit.RateLimiter(path, rate=20)
+            start = time.time()
+            limiter.acquire()
+            other.acquire(submission=True)
+            self.assertTrue(time.time() - start >= 0.04)
+            # the wait starts when the server refused the request
+            start = time.time()
+            limiter.throttled(retry_after=0.2)
+            other.acquire()
+            self.assertTrue(time.time() - start >= 0.2)
+        finally:
+            shutil.rmtree(state_dir)
+
+    def test_backend_parsers(self):
+        lines = ["ISRCS found on disc\n", "ISRC  1  DE-C68-00-00220\n",
+                 "ISRC  2  DEC680000221\n"]
+        self.assertEqual(list(isrcsubmit.parse_mediatools(lines)),
+                         [(1, "DEC680000220"), (2, "DEC680000221")])
+        lines = ["Track  1 : DE-C68-00-00220\n", "Track 12 : DEC680000221\n"]
+        self.assertEqual(list(isrcsubmit.parse_discisrc(lines)),
+                         [(1, "DEC680000220"), (12, "DEC680000221")])
+        file_name = "%shSI7B4G4AkB5.DEBcW.3KCn.D_E-_cdrdao.toc" % TEST_DATA
+        with open(file_name, "r") as toc:
+            isrcs = isrcsubmit.parse_cdrdao_toc(toc)
+            # the parser yields ISRCs as soon as they are found
+            self.assertEqual(next(isrcs), (1, "GBBBN7902002"))
+            self.assertEqual(next(isrcs), (2, "GBBBN7900013"))
+
+    def test_toc_disc(self):
+        disc_id = "hSI7B4G4AkB5.DEBcW.3KCn.D_E-"
+        with open("%s%s_cdrdao.toc" % (TEST_DATA, disc_id), "r") as toc:
+            disc = isrcsubmit.parse_toc_disc(toc)
+        # compare with what libdiscid read from the same disc
+        with open("%s%s.pickle" % (TEST_DATA, disc_id), "rb") as disc_file:
+            read_disc = pickle.load(disc_file)
+        self.assertEqual(disc.id, read_disc.id)
+        self.assertEqual(disc.mcn, read_disc.mcn)
+        self.assertEqual(disc.submission_url, read_disc.submission_url)
+        self.assertEqual([track.isrc for track in disc.tracks],
+                         [track.isrc for track in read_disc.tracks])
+
+        # enhanced CDs need the multisession information of libdiscid
+        toc = ["CD_ROM_XA\n", "// Track 1\n", "TRACK AUDIO\n",
+               'FILE "data.wav" 0 03:19:62\n', "// Track 2\n",
+               "TRACK MODE2_FORM1\n", 'DATAFILE "data_2.bin" 10:00:00\n']
+        self.assertTrue(isrcsubmit.parse_toc_disc(toc) is None)
+
+    def test_local_duplicates(self):
+        tracks = [{"id": "track %d" % number, "position": str(number),
+                   "recording": {"id": "recording %d" % number}}
+                  for number in range(1, 4)]
+        medium = isrcsubmit.Medium({"position": "1", "track-list": tracks})
+        isrcsubmit.options = isrcsubmit.gather_options([SCRIPT_NAME])
+        backend_output = [(1, "DEC680000220"), (2, "DEC680000220"),
+                          (3, "GBBBN7902023"), (3, "GBBBN7902023")]
+        with self.assertLogs(level="ERROR") as logs:
+            isrcs, tracks2isrcs, errors = isrcsubmit.check_isrcs_local(
+                    backend_output, medium, "cdrdao")
+        self.assertEqual(errors, 2)
+        # the backend of a capture, not the one of the options
+        self.assertTrue("cdrdao gave the same ISRC" in logs.output[0])
+        self.assertEqual(isrcs["DEC680000220"].get_track_numbers(), "1, 2")
+        # the same track is only listed once
+        self.assertEqual(isrcs["GBBBN7902023"].get_track_numbers(), "3")
+        self.assertEqual(tracks2isrcs, {"recording 1": "DEC680000220",
+                                        "recording 2": "DEC680000220",
+                                        "recording 3": "GBBBN7902023"})
+
+    def test_global_duplicates(self):
+        def medium(position, *isrcs):
+            tracks = [{"position": number + 1,
+                       "recording": {"id": "%d-%d" % (position, number + 1),
+                                     "isrc-list": [isrc] if isrc else []}}
+                      for number, isrc in enumerate(isrcs)]
+            return {"position": position, "disc-list": [{"id": "disc"}],
+                    "track-list": tracks}
+
+        isrcsubmit.options = isrcsubmit.gather_options([SCRIPT_NAME])
+        release = isrcsubmit.Release({"id": "release", "medium-list": [
+                medium(1, None, "DEC680000220"),
+                medium(2, "GBBBN7902023", "DEC680000221")]})
+        # the ISRC of our disc is attached on another disc of the release
+        isrcs, tracks2isrcs, errors = isrcsubmit.check_isrcs_local(
+                [(1, "GBBBN7902023"), (2, "DEC680000220")],
+                release.media[0])
+        self.assertEqual(isrcsubmit.find_global_duplicates(release, isrcs), 1)
+        # ISRCs submitted for one disc are used for the others
+        release.attach_isrcs({"1-1": "DEC680000221"})
+        self.assertEqual(len(release.tracks_with_isrc("DEC680000221")), 2)
+
+        # all duplicates in one report
+        conflicts = {"DEC680000220": [{"id": "other", "title": "Rock & Roll",
+                                       "artist-credit-phrase": "Somebody"}]}
+        report = isrcsubmit.cleanup_report(release, isrcs, conflicts)
+        self.assertEqual(report.count("[OUR EVALUATION]"), 1)
+        self.assertTrue("disc 2 track 1" in report)
+        self.assertTrue("/isrc/GBBBN7902023" in report)
+        self.assertTrue("/recording/2-1" in report)
+        self.assertTrue("Somebody - Rock &amp; Roll" in report)
+
+    def test_rank_releases(self):
+        def release(release_id, barcode, isrc):
+            track = {"position": "1", "recording": {"isrc-list": [isrc]}}
+            medium = {"disc-list": [{"id": "disc"}], "track-list": [track]}
+            return isrcsubmit.Release({"id": release_id, "barcode": barcode,
+                                       "medium-list": [medium]})
+
+        releases = [release("other", "0123", "DEC680000220"),
+                    release("match", "00123", "GBBBN7902023")]
+        ranking, confidence = isrcsubmit.rank_releases(
+                releases, "disc", "123", 1, [(1, "GBBBN7902023")])
+        self.assertEqual([release.id for s, release, r in ranking],
+                         ["match", "other"])
+        self.assertEqual(confidence, 6.0)
+        # the same ISRCs, but only one barcode fits the MCN
+        releases = [release("other", "4006381333931", "GBBBN7902023"),
+                    release("match", "00123", "GBBBN7902023")]
+        ranking, confidence = isrcsubmit.rank_releases(
+                releases, "disc", "123", 1, [(1, "GBBBN7902023")])
+        self.assertEqual([release.id for s, release, r in ranking],
+                         ["match", "other"])
+        self.assertTrue("barcode differs from MCN" in ranking[1][2])
+        self.assertEqual(confidence, 6.0)
+        # without the MCN only the ISRCs decide
+        ranking, confidence = isrcsubmit.rank_releases(
+                releases, "disc", None, 1, [])
+        self.assertEqual(confidence, 0.0)
+
+    def _reread_disc(self, first_lines, reread_lines):
+        """Returns the disc read from the first TOC, the reads of the
+        drive and the release found, when the second read gets the other TOC
+        """
+        first = isrcsubmit.parse_toc_disc(first_lines)
+        toc = isrcsubmit.parse_toc_disc(reread_lines)
+        # a TOC only read has no MCN and no ISRCs
+        toc_only = isrcsubmit.TocDisc(
+                [isrcsubmit.TocTrack(track.number, track.offset, track.sectors)
+                 for track in toc.tracks], toc.sectors)
+        discs = [first, toc_only]
+        reads = []
+
+        def read(device=None, features=[]):
+            reads.append(features)
+            return discs.pop(0)
+
+        isrcsubmit.options = isrcsubmit.gather_options(
+                [SCRIPT_NAME, "--backend", "libdiscid", "--no-cache"])
+        isrcsubmit.options.headless = True
+        isrcsubmit.options.ambiguous = "auto"
+        isrcsubmit.options.unknown = "skip"
+        isrcsubmit.ws2 = isrcsubmit.WebService2()
+        isrcsubmit.choices = None
+        isrcsubmit.discid.read = read
+        try:
+            disc = isrcsubmit.Disc("/dev/cdrom", "libdiscid")
+            try:
+                release = disc.get_release()
+            except isrcsubmit.DiscSkipped:
+                release = None
+        finally:
+            isrcsubmit.discid.read = _read
+        return disc, reads, release
+
+    def test_reread_disc(self):
+        with open("%shSI7B4G4AkB5.DEBcW.3KCn.D_E-_cdrdao.toc"
+                  % TEST_DATA) as toc_file:
+            known = toc_file.readlines()
+        unknown = [line.replace('"data.wav" 0 03:19:62',
+                                '"data.wav" 0 03:20:62') for line in known]
+        isrcs = dict((number, isrc) for number, isrc
+                     in isrcsubmit.parse_cdrdao_toc(known))
+
+        # an unknown disc ID is checked with a read of only the TOC
+        disc, reads, release = self._reread_disc(unknown, unknown)
+        self.assertEqual(reads, [["mcn", "isrc"], []])
+        self.assertTrue(release is None)
+        self.assertEqual(disc.mcn, "5099749534728")
+        self.assertEqual(disc.tracks[6].isrc, isrcs[7])
+
+        # the changed disc ID is looked up
+        disc, reads, release = self._reread_disc(unknown, known)
+        self.assertEqual(reads, [["mcn", "isrc"], []])
+        self.assertEqual(disc.id, "hSI7B4G4AkB5.DEBcW.3KCn.D_E-")
+        # the MCN and the ISRCs of the first read are still there
+        self.assertEqual(disc.mcn, "5099749534728")
+        self.assertEqual([track.isrc for track in disc.tracks],
+                         [isrcs.get(track.number) for track in disc.tracks])
+        # the release found with the new disc ID is used
+        self.assertEqual(release.id, "174a5513-73d1-3c9d-a316-3c1c179e35f8")
+        self.assertTrue(disc.release is release)
+
+    def test_program_resolver(self):
+        work_dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(work_dir, "bin")
+        other_dir = os.path.join(work_dir, "other")
+        cache = os.path.join(work_dir, "programs.json")
+        os.makedirs(bin_dir)
+        os.makedirs(other_dir)
+
+        def make_program(directory, name):
+            path = os.path.join(directory, name)
+            with open(path, "w") as program:
+                program.write("#!/bin/sh\n")
+            os.chmod(path, 0o755)
+            return path
+
+        def touch(path, seconds):
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + seconds))
+
+        def resolver(path):
+            os.environ["PATH"] = path
+            return isrcsubmit.ProgramResolver(cache)
+
+        searched = []
+        which = shutil.which
+
+        def counting_which(program, *args, **kwargs):
+            searched.append(program)
+            return which(program, *args, **kwargs)
+
+        old_path = os.environ.get("PATH")
+        shutil.which = counting_which
+        try:
+            cdrdao = make_program(bin_dir, "cdrdao")
+            programs = resolver(bin_dir)
+            self.assertEqual(programs.find("cdrdao"), cdrdao)
+            self.assertTrue(programs.find("discisrc") is None)
+            programs.save()
+
+            # the saved locations are used without searching
+            del searched[:]
+            programs = resolver(bin_dir)
+            self.assertEqual(programs.find("cdrdao"), cdrdao)
+            self.assertTrue(programs.find("discisrc") is None)
+            self.assertEqual(searched, [])
+
+            # a different PATH is searched again
+            other_cdrdao = make_program(other_dir, "cdrdao")
+            search_path = os.pathsep.join([other_dir, bin_dir])
+            programs = resolver(search_path)
+            self.assertEqual(programs.find("cdrdao"), other_cdrdao)
+            self.assertEqual(searched, ["cdrdao"])
+            programs.find("discisrc")
+            programs.save()
+
+            # a changed program is searched again
+            touch(other_cdrdao, 10)
+            del searched[:]
+            programs = resolver(search_path)
+            self.assertEqual(programs.find("cdrdao"), other_cdrdao)
+            self.assertTrue(programs.find("discisrc") is None)
+            self.assertEqual(searched, ["cdrdao"])
+            programs.save()
+
+            # a program installed later is found
+            discisrc = make_program(bin_dir, "discisrc")
+            touch(bin_dir, 20)
+            programs = resolver(search_path)
+            self.assertEqual(programs.find("discisrc"), discisrc)
+
+            # a symlink to another backend isn't used as that backend
+            os.symlink(cdrdao, os.path.join(bin_dir, "mediatools"))
+            isrcsubmit.program_resolver = resolver(bin_dir)
+            self.assertFalse(_isrcsubmit_has_program("mediatools"))
+            self.assertTrue(_isrcsubmit_has_program("mediatools", strict=True))
+            self.assertTrue(_isrcsubmit_has_program("cdrdao"))
+        finally:
+            shutil.which = which
+            if old_path is None:
+                del os.environ["PATH"]
+            else:
+                os.environ["PATH"] = old_path
+            isrcsubmit.program_resolver = None
+            shutil.rmtree(work_dir)
+
+    def test_parse_release(self):
+        release_id = "174a5513-73d1-3c9d-a316-3c1c179e35f8"
+        with open("%s%s.json" % (TEST_DATA, release_id)) as release_file:
+            data = json.load(release_file)["release"]
+        disc_id = "hSI7B4G4AkB5.DEBcW.3KCn.D_E-"
+        # like the lookup by TOC, without the disc IDs
+        without_discs = json.loads(json.dumps(data))
+        for medium in without_discs["medium-list"]:
+            medium.pop("disc-list", None)
+        isrcsubmit._releases.clear()
+        try:
+            first = isrcsubmit.parse_release(without_discs, ["recordings"])
+            self.assertEqual(first.media_with_disc_id(disc_id), [])
+            recording_id = first.media[0].tracks[0].id
+            first.attach_isrcs({recording_id: "XXTST0000001"})
+            # the same includes share the release
+            self.assertTrue(isrcsubmit.parse_release(data, ["recordings"])
+                            is first)
+
+            # the disc IDs are needed for the lookup by release ID
+            release = isrcsubmit.parse_release(data,
+                                               ["recordings", "discids"])
+            self.assertNotEqual(release.media_with_disc_id(disc_id), [])
+            # ISRCs submitted before are kept
+            self.assertEqual(release.tracks_with_isrc("XXTST0000001")[0].id,
+                             recording_id)
+            self.assertTrue(isrcsubmit.parse_release(without_discs,
+                                                     ["recordings"])
+                            is release)
+        finally:
+            isrcsubmit._releases.clear()
+
+    def test_choice_store(self):
+        path = os.path.join(tempfile.mkdtemp(), "choices")
+        try:
+            store = isrcsubmit.ChoiceStore(path)
+            self.assertEqual(store.get("mb.org", "disc"), None)
+            store.remember("mb.org", "disc", "release 1", "user")
+            store.remember("mb.org", "disc", "release 2", "user")
+            store.remember("mb.org", "other disc", "release 3")
+            entry = store.get("mb.org", "disc")
+            self.assertEqual(entry["release_id"], "release 2")
+            self.assertEqual(entry["user"], "user")
+            self.assertEqual(store.get("test.mb.org", "disc"), None)
+            store.forget("mb.org", "disc")
+            self.assertEqual(store.get("mb.org", "disc"), None)
+            self.assertEqual(store.get("mb.org", "other disc")["release_id"],
+                             "release 3")
+            # replaced and removed choices aren't kept
+            with open(path) as choices_file:
+                self.assertEqual(len(choices_file.readlines()), 1)
+            # another process sees the changes
+            store.remember("mb.org", "disc", "release 4")
+            other = isrcsubmit.ChoiceStore(path)
+            self.assertEqual(other.get("mb.org", "disc")["release_id"],
+                             "release 4")
+            other.forget("mb.org", "other disc")
+            store.remember("mb.org", "third disc", "release 5")
+            with open(path) as choices_file:
+                self.assertEqual(len(choices_file.readlines()), 2)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_rank_toc_matches(self):
+        def release(release_id, *media):
+            medium_list = []
+            for position, lengths in enumerate(media):
+                tracks = [{"position": number + 1, "length": length}
+                          for number, length in enumerate(lengths)]
+                medium_list.append({"position": position + 1,
+                                    "track-list": tracks})
+            return isrcsubmit.Release({"id": release_id,
+                                       "medium-list": medium_list})
+
+        lengths = [180000, 240000, 200000]
+        releases = [release("far", [170000, 230000, 190000]),
+                    release("other", [180000, 240000]),
+                    release("close", [181000, 240000],
+                            [180000, 241000, 200000]),
+                    release("unknown", [None, None, None])]
+        matches = isrcsubmit.rank_toc_matches(releases, lengths)
+        self.assertEqual([(diff, rel.id, med.position)
+                          for diff, rel, med in matches],
+                         [(1.0, "close", 2), (30.0, "far", 1),
+                          (180.0, "unknown", 1)])
+
+    def test_load_captures(self):
+        import gzip
+        capture_dir = tempfile.mkdtemp()
+        capture = {"format": isrcsubmit.CAPTURE_FORMAT,
+                   "backend": "libdiscid", "lines": None,
+                   "isrcs": [[1, "GBBBN7902023"]]}
+        try:
+            paths = []
+            for i in range(isrcsubmit.CAPTURE_PREFETCH + 2):
+                paths.append(os.path.join(capture_dir, "%d.json.gz" % i))
+                with gzip.open(paths[-1], "wt") as capture_file:
+                    json.dump(capture, capture_file)
+            with open(paths[-1], "rb") as capture_file:
+                data = capture_file.read()
+            truncated = os.path.join(capture_dir, "truncated.json.gz")
+            with open(truncated, "wb") as capture_file:
+                capture_file.write(data[:len(data) // 2])
+            corrupt = os.path.join(capture_dir, "corrupt.json.gz")
+            with open(corrupt, "wb") as capture_file:
+                capture_file.write(data[:10] + b"\xff" * (len(data) - 10))
+            paths[1:1] = [truncated, corrupt]
+            loaded = list(isrcsubmit.load_captures(paths))
+        finally:
+            shutil.rmtree(capture_dir)
+        self.assertEqual([path for path, result in loaded], paths)
+        errors = [path for path, result in loaded
+                  if isinstance(result, Exception)]
+        self.assertEqual(errors, [truncated, corrupt])
+        self.assertEqual(loaded[0][1]["output"], [(1, "GBBBN7902023")])
+
+    def test_ws2_server(self):
+        import threading
+        import ws2_server
+        server = ws2_server.Server(ws2_server.gather_options(
+                ["ws2_server.py", "--port", "0", "--quiet"]))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        musicbrainzngs.set_hostname("localhost:%d" % server.server_address[1])
+        musicbrainzngs.set_useragent(isrcsubmit.AGENT_NAME,
+                                     isrcsubmit.__version__)
+        musicbrainzngs.set_rate_limit(False)
+        try:
+            disc_id = "hSI7B4G4AkB5.DEBcW.3KCn.D_E-"
+            releases = _mbngs_get_releases_by_discid(disc_id, ["recordings"])
+            with open("%s%s_releases.json" % (TEST_DATA, disc_id)) as data:
+                expected = json.load(data)
+            self.assertEqual(
+                    isrcsubmit.Release(releases["disc"]["release-list"][0])
+                    .tracks_with_isrc("GBBBN7902023")[0].id,
+                    isrcsubmit.Release(expected["disc"]["release-list"][0])
+                    .tracks_with_isrc("GBBBN7902023")[0].id)
+            recording_id = releases["disc"]["release-list"][0][
+                    "medium-list"][0]["track-list"][0]["recording"]["id"]
+
+            musicbrainzngs.auth("test", "wrong")
+            self.assertRaises(musicbrainzngs.AuthenticationError,
+                              _mbngs_submit_isrcs,
+                              {recording_id: ["XXTST0000001"]})
+            musicbrainzngs.auth("test", "test")
+            _mbngs_submit_isrcs({recording_id: ["XXTST0000001"]})
+            self.assertEqual(server.fixtures.submitted,
+                             [{recording_id: ["XXTST0000001"]}])
+            isrc = _mbngs_get_recordings_by_isrc("XXTST0000001")["isrc"]
+            self.assertEqual(isrc["recording-list"][0]["id"], recording_id)
+
+            # the nonces of the authentication don't pile up
+            nonce = server.new_nonce()
+            self.assertTrue(server.valid_nonce(nonce))
+            server.nonces[nonce] -= ws2_server.NONCE_TIMEOUT + 1
+            self.assertFalse(server.valid_nonce(nonce))
+            for i in range(ws2_server.MAX_NONCES + 10):
+                server.new_nonce()
+            self.assertEqual(len(server.nonces), ws2_server.MAX_NONCES)
+        finally:
+            musicbrainzngs.auth("", "")
+            musicbrainzngs.set_hostname("musicbrainz.org")
+            musicbrainzngs.set_rate_limit()
+            server.shutdown()
+            thread.join()
+            server.server_close()
 
     def tearDown(self):
         # restore output
@@ -84,14 +696,21 @@ class TestInternal(unittest.TestCase):
 _mbngs_get_releases_by_discid = musicbrainzngs.get_releases_by_discid
 _mbngs_get_release_by_id = musicbrainzngs.get_release_by_id
 _mbngs_submit_isrcs = musicbrainzngs.submit_isrcs
+_mbngs_get_recordings_by_isrc = musicbrainzngs.get_recordings_by_isrc
 
-def _get_releases_by_discid(disc_id, includes=[]):
+def _get_releases_by_discid(disc_id, includes=[], toc=None, cdstubs=True):
     file_name = "%s%s_releases.json" % (TEST_DATA, disc_id)
     if SAVE_RUN:
         releases = _mbngs_get_releases_by_discid(disc_id, includes)
         with open(file_name, "w") as releases_file:
             json.dump(releases, releases_file, indent=2)
         return releases
+    elif not os.path.exists(file_name):
+        # an unknown disc ID, without similar TOCs
+        if toc is not None:
+            return {"release-list": []}
+        raise musicbrainzngs.ResponseError(
+                cause=HTTPError(file_name, 404, "Not Found", None, None))
     else:
         with open(file_name, "r") as releases_file:
             return json.load(releases_file)
@@ -105,12 +724,28 @@ def _get_release_by_id(release_id, includes=[]):
         with open(file_name, "w") as release_file:
             json.dump(release, releases_file, indent=2)
         return releases
+    elif not os.path.exists(file_name):
+        # merged or deleted
+        raise musicbrainzngs.ResponseError(
+                cause=HTTPError(file_name, 404, "Not Found", None, None))
     else:
         with open(file_name, "r") as release_file:
             return json.load(release_file)
 
 musicbrainzngs.get_release_by_id = _get_release_by_id
 
+def _get_recordings_by_isrc(isrc, includes=[]):
+    # one ISRC on a compilation, none of the others are used elsewhere
+    recordings = []
+    if isrc == "DEC680000220":
+        recordings.append({"id": "9e2b8c4e-0000-4000-8000-000000000220",
+                           "title": "Lost", "artist-credit-phrase": "Somebody",
+                           "release-list": [{"id": "compilation",
+                                             "title": "Compilation"}]})
+    return {"isrc": {"id": isrc, "recording-list": recordings}}
+
+musicbrainzngs.get_recordings_by_isrc = _get_recordings_by_isrc
+
 def _submit_isrcs(tracks2isrcs):
     global data_sent
     data_sent.tracks2isrcs = tracks2isrcs
@@ -293,6 +928,9 @@ class TestScript(unittest.TestCase):
         # make sure globals are unset
         answers = data_sent = {}
         mocked_disc_id = last_question = None
+        # releases chosen in other tests
+        if os.path.exists(isrcsubmit.choices_path()):
+            os.remove(isrcsubmit.choices_path())
 
         # gather output
         self._old_stdout = sys.stdout
@@ -321,12 +959,18 @@ class TestScript(unittest.TestCase):
             self.assertTrue(isrcsubmit.__version__ in self._output().strip())
 
     def test_help(self):
+        def no_discid():
+            raise ImportError("libdiscid isn't needed for the help")
+
+        old_discid = isrcsubmit.discid
+        isrcsubmit.discid = isrcsubmit.LazyModule(no_discid)
         try:
             isrcsubmit.main([SCRIPT_NAME, "-h"])
         except SystemExit:
             pass
         finally:
-            self.assertTrue(self._output().strip())
+            isrcsubmit.discid = old_discid
+            self.assert_output("default drive")
 
     def test_libdiscid(self):
         global mocked_disc_id
@@ -345,6 +989,34 @@ class TestScript(unittest.TestCase):
             self.assert_output("DEC680000220 is already attached to track 4")
             self.assert_output("No new ISRCs")
 
+    def test_profile(self):
+        import pstats
+        global mocked_disc_id
+        mocked_disc_id = "TqvKjMu7dMliSfmVEBtrL7sBSno-"
+        work_dir = tempfile.mkdtemp()
+        profile = os.path.join(work_dir, "profile.json")
+        stats = os.path.join(work_dir, "profile.stats")
+        try:
+            isrcsubmit.main([SCRIPT_NAME, "--backend", "libdiscid",
+                             "--no-cache", "--profile", profile,
+                             "--cprofile", stats])
+            with open(profile) as profile_file:
+                data = json.load(profile_file)
+            functions = [name for _, _, name in pstats.Stats(stats).stats]
+        finally:
+            shutil.rmtree(work_dir)
+        # the ISRCs are read in another thread
+        self.assertTrue("read_isrcs" in functions)
+        self.assertEqual(len(data["discs"]), 1)
+        disc = data["discs"][0]
+        self.assertEqual(disc["disc_id"], mocked_disc_id)
+        phases = disc["phases"]
+        for phase in ["read_disc", "gather_isrcs", "prompt",
+                      "ws:discid"]:
+            self.assertTrue(phase in phases, phase)
+        self.assertTrue(phases["prompt"]["count"] >= 1)
+        self.assertTrue(disc["first_isrc"] <= phases["gather_isrcs"]["seconds"])
+
     def test_cdrdao(self):
         global mocked_disc_id
         mocked_disc_id = "hSI7B4G4AkB5.DEBcW.3KCn.D_E-"
@@ -362,6 +1034,254 @@ class TestScript(unittest.TestCase):
             self.assert_output("GBBBN7902023 is already attached to track 7")
             self.assert_output("No new ISRCs")
 
+    def test_auto_select(self):
+        global mocked_disc_id
+        mocked_disc_id = "hSI7B4G4AkB5.DEBcW.3KCn.D_E-"
+        answers["choice"] = 7
+        try:
+            isrcsubmit.main([SCRIPT_NAME, "--backend", "libdiscid",
+                             "--auto-select"])
+        except SystemExit:
+            pass
+        finally:
+            self.assert_output("chose release automatically")
+            self.assertFalse("none of these" in self._output())
+            # the barcode matches the MCN
+            self.assert_output("174a5513-73d1-3c9d-a316-3c1c179e35f8")
+            self.assert_output("No new ISRCs")
+
+    def test_remember_choice(self):
+        global mocked_disc_id
+        mocked_disc_id = "hSI7B4G4AkB5.DEBcW.3KCn.D_E-"
+        answers["choice"] = 1
+        for i in range(2):
+            try:
+                isrcsubmit.main([SCRIPT_NAME, "--backend", "libdiscid"])
+            except SystemExit:
+                pass
+            finally:
+                self.assert_output("GBBBN7902023 is already attached")
+            # the first choice would be invalid
+            answers["choice"] = 100
+        self.assertEqual(self._output().count("none of these"), 1)
+        self.assert_output("Using the release chosen before")
+        # ask again
+        answers["choice"] = 1
+        isrcsubmit.main([SCRIPT_NAME, "--backend", "libdiscid",
+                         "--forget-choice"])
+        self.assertEqual(self._output().count("none of these"), 2)
+
+    def test_stale_choice(self):
+        global mocked_disc_id
+        mocked_disc_id = "hSI7B4G4AkB5.DEBcW.3KCn.D_E-"
+        store = isrcsubmit.ChoiceStore(isrcsubmit.choices_path())
+        store.remember("musicbrainz.org", mocked_disc_id,
+                       "00000000-0000-0000-0000-000000000000")
+        answers["choice"] = 1
+        try:
+            isrcsubmit.main([SCRIPT_NAME, "--backend", "libdiscid",
+                             "--no-cache"])
+        except SystemExit:
+            pass
+        self.assert_output("not in the database anymore")
+        # the normal lookup is used instead
+        self.assert_output("none of these")
+        self.assert_output("GBBBN7902023 is already attached")
+        # the new choice replaces the stale one
+        store = isrcsubmit.ChoiceStore(isrcsubmit.choices_path())
+        entry = store.get("musicbrainz.org", mocked_disc_id)
+        self.assertNotEqual(entry["release_id"],
+                            "00000000-0000-0000-0000-000000000000")
+
+    def test_unknown_disc(self):
+        # a different first track, the disc ID isn't known
+        with open("%shSI7B4G4AkB5.DEBcW.3KCn.D_E-_cdrdao.toc"
+                  % TEST_DATA) as toc_file:
+            toc = toc_file.read().replace('"data.wav" 0 03:19:62',
+                                          '"data.wav" 0 03:20:62')
+        work_dir = tempfile.mkdtemp()
+        toc_path = os.path.join(work_dir, "unknown_cdrdao.toc")
+        with open(toc_path, "w") as toc_file:
+            toc_file.write(toc)
+        try:
+            isrcsubmit.main([SCRIPT_NAME, "--backend", "virtual",
+                             "--no-cache", "--virtual-latency", "0.05",
+                             "-d", toc_path])
+        except SystemExit:
+            pass
+        finally:
+            shutil.rmtree(work_dir)
+        output = self._output()
+        # the url is shown before waiting for the ISRCs
+        self.assertTrue(output.index("/cdtoc/attach?")
+                        < output.index("recalculating"))
+        self.assertEqual(output.count("/cdtoc/attach?"), 1)
+
+    def test_isrc_lookup(self):
+        global mocked_disc_id
+        mocked_disc_id = "TqvKjMu7dMliSfmVEBtrL7sBSno-"
+        # the mocked web service doesn't need a rate limit
+        if not os.path.isdir(isrcsubmit.get_config_home()):
+            os.makedirs(isrcsubmit.get_config_home())
+        with open(isrcsubmit.config_path(), "w") as config_file:
+            config_file.write("[musicbrainz]\nrate_limit = 0\n")
+        try:
+            isrcsubmit.main([SCRIPT_NAME, "--backend", "libdiscid",
+                             "--isrc-lookup"])
+        except SystemExit:
+            pass
+        finally:
+            os.remove(isrcsubmit.config_path())
+            self.assert_output("ISRC DEC680000220 is also attached to:")
+            self.assert_output("Somebody - Lost (Compilation)")
+            self.assertEqual(self._output().count("is also attached to"), 1)
+
+    def test_manifest(self):
+        global mocked_disc_id
+        mocked_disc_id = "hSI7B4G4AkB5.DEBcW.3KCn.D_E-"
+        manifest = tempfile.NamedTemporaryFile("w", suffix=".jsonl",
+                                               delete=False)
+        with manifest:
+            manifest.write('{"device": "/dev/sr0", "ambiguous": "skip"}\n')
+            manifest.write("# the barcode is enough to choose\n")
+            manifest.write('{"device": "/dev/sr1"}\n')
+        old_stderr = sys.stderr
+        sys.stderr = SmartStdout(BytesIO(), "utf-8")
+        try:
+            isrcsubmit.main([SCRIPT_NAME, "--backend", "libdiscid",
+                             "--manifest", manifest.name])
+        finally:
+            sys.stderr.seek(0)
+            messages = sys.stderr.read()
+            sys.stderr = old_stderr
+            os.remove(manifest.name)
+        # only the results are written to stdout
+        results = [json.loads(line) for line in self._output().splitlines()]
+        self.assertTrue("none of these" not in messages)
+        self.assertTrue(isrcsubmit.__version__ in messages)
+        self.assertEqual([result["status"] for result in results],
+                         ["skipped", "no new ISRCs"])
+        self.assertEqual(results[0]["reason"], "ambiguous disc ID")
+        self.assertEqual(results[0]["isrcs"]["7"], "GBBBN7902023")
+        self.assertEqual(results[1]["device"], "/dev/sr1")
+        self.assertEqual(results[1]["release_id"],
+                         "174a5513-73d1-3c9d-a316-3c1c179e35f8")
+        self.assertTrue("GBBBN7902023" in results[1]["attached"])
+        self.assertTrue("total" in results[1]["timings"])
+
+    def test_capture(self):
+        global mocked_disc_id
+        mocked_disc_id = "hSI7B4G4AkB5.DEBcW.3KCn.D_E-"
+        answers["choice"] = 1
+        capture_dir = tempfile.mkdtemp()
+        try:
+            isrcsubmit.main([SCRIPT_NAME, "--backend", "cdrdao",
+                             "--capture", capture_dir])
+            capture_path = os.path.join(capture_dir,
+                                        "%s.json.gz" % mocked_disc_id)
+            capture = isrcsubmit.load_capture(capture_path)
+            self.assertEqual(capture["disc_id"], mocked_disc_id)
+            self.assertTrue((7, "GBBBN7902023") in capture["output"])
+
+            # the drive isn't read again
+            mocked_disc_id = None
+            self._stdout.seek(0)
+            self._stdout.truncate()
+            old_stderr = sys.stderr
+            sys.stderr = SmartStdout(BytesIO(), "utf-8")
+
+            def no_discid():
+                raise ImportError("libdiscid isn't needed for captures")
+
+            old_discid = isrcsubmit.discid
+            isrcsubmit.discid = isrcsubmit.LazyModule(no_discid)
+            try:
+                isrcsubmit.main([SCRIPT_NAME, "--ingest", capture_dir,
+                                 "--ingest", "missing.json.gz"])
+            except SystemExit as err:
+                self.assertEqual(err.code, 1)
+            finally:
+                isrcsubmit.discid = old_discid
+                sys.stderr = old_stderr
+        finally:
+            shutil.rmtree(capture_dir)
+        results = [json.loads(line) for line in self._output().splitlines()]
+        self.assertEqual([result["status"] for result in results],
+                         ["no new ISRCs", "error"])
+        self.assertEqual(results[0]["device"], capture_path)
+        self.assertEqual(results[0]["release_id"],
+                         "174a5513-73d1-3c9d-a316-3c1c179e35f8")
+        self.assertTrue("GBBBN7902023" in results[0]["attached"])
+
+    def test_multiple_devices(self):
+        global mocked_disc_id
+        mocked_disc_id = "TqvKjMu7dMliSfmVEBtrL7sBSno-"
+        try:
+            isrcsubmit.main([SCRIPT_NAME, "--backend", "libdiscid",
+                             "-d", "/dev/sr0", "-d", "/dev/sr1"])
+        except SystemExit:
+            pass
+        finally:
+            self.assert_output("Device:\t\t/dev/sr0")
+            self.assert_output("Device:\t\t/dev/sr1")
+            self.assert_output("Summary:")
+            self.assert_output("DEC680000220 is already attached to track 4")
+            self.assertEqual(self._output().count("no new ISRCs"), 2)
+
+    def test_failed_device(self):
+        global mocked_disc_id
+        mocked_disc_id = "TqvKjMu7dMliSfmVEBtrL7sBSno-"
+
+        def read(device=None, features=[]):
+            if device == "/dev/sr1":
+                raise DiscError("no disc")
+            return _read(device, features)
+
+        isrcsubmit.discid.read = read
+        try:
+            with self.assertLogs(level="ERROR") as logs:
+                isrcsubmit.main([SCRIPT_NAME, "--backend", "libdiscid",
+                                 "-d", "/dev/sr0", "-d", "/dev/sr1"])
+        except SystemExit:
+            pass
+        finally:
+            isrcsubmit.discid.read = _read
+        self.assertTrue("ERROR:isrcsubmit:Couldn't read the disc in /dev/sr1"
+                        in logs.output)
+        self.assert_output("Device:\t\t/dev/sr0")
+        self.assert_output("/dev/sr1\t(no disc ID)\tnot processed")
+
+    def test_virtual_drive(self):
+        # discs recorded in different ways, no drive is used
+        answers["choice"] = 1
+        pickled = "%sTqvKjMu7dMliSfmVEBtrL7sBSno-.pickle" % TEST_DATA
+        toc = "%shSI7B4G4AkB5.DEBcW.3KCn.D_E-_cdrdao.toc" % TEST_DATA
+        try:
+            isrcsubmit.main([SCRIPT_NAME, "--backend", "virtual",
+                             "--virtual-latency", "0.001",
+                             "-d", pickled, "-d", toc])
+        except SystemExit:
+            pass
+        finally:
+            self.assert_output("virtual drive")
+            self.assert_output("DEC680000220 is already attached to track 4")
+            self.assert_output("GBBBN7902023 is already attached to track 7")
+            self.assertEqual(self._output().count("no new ISRCs"), 2)
+
+        # every read fails
+        self._stdout.seek(0)
+        self._stdout.truncate()
+        old_stderr = sys.stderr
+        sys.stderr = self._stdout
+        try:
+            isrcsubmit.main([SCRIPT_NAME, "--backend", "virtual",
+                             "--virtual-errors", "1", "-d", pickled])
+        except SystemExit as err:
+            self.assertEqual(err.code, 1)
+        finally:
+            sys.stderr = old_stderr
+        self.assert_output("virtual read error")
+
     def tearDown(self):
         # restore output
         sys.stdout = self._old_stdout
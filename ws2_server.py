@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# This server is free. You can redistribute and/or modify it at will.
+"""A local stand-in for the MusicBrainz web service
+
+Usage: ws2_server.py [options]
+
+This serves the discs and releases in test_data as ws/2 XML
+and accepts ISRC submissions, so isrcsubmit can be run against it with
+    isrcsubmit.py --server localhost:8000
+Only the lookups and the submission isrcsubmit uses are supported.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from optparse import OptionParser
+from urllib.parse import urlsplit, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+NS = "http://musicbrainz.org/ns/mmd-2.0#"
+# the realm musicbrainzngs authenticates for
+REALM = "musicbrainz.org"
+# keys that are XML attributes, not elements
+ATTRIBUTES = ["id", "type", "type-id", "ext:score"]
+# keys musicbrainzngs adds while parsing
+DERIVED = ["artist-credit-phrase", "track_or_recording_length"]
+# lists of IDs, not of text
+ID_LISTS = ["isrc-list", "puid-list"]
+# seconds a nonce of the digest authentication can be used
+NONCE_TIMEOUT = 300
+# nonces kept at most, the oldest are dropped first
+MAX_NONCES = 1000
+
+
+def add_xml(parent, name, value):
+    """Add the value parsed by musicbrainzngs as XML element name"""
+    if name in DERIVED or name.endswith("-count"):
+        return
+    element = ET.SubElement(parent, name)
+    if name == "artist-credit":
+        for credit in value:
+            if isinstance(credit, dict):
+                name_credit = ET.SubElement(element, "name-credit")
+                for key, item in credit.items():
+                    add_xml(name_credit, key, item)
+            else:
+                name_credit.set("joinphrase", credit)
+    elif name.endswith("-list"):
+        element.set("count", str(len(value)))
+        for item in value:
+            if name in ID_LISTS:
+                ET.SubElement(element, name[:-5]).set("id", item)
+            elif isinstance(item, dict):
+                add_xml(element, name[:-5], item)
+            else:
+                ET.SubElement(element, name[:-5]).text = item
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if key in ATTRIBUTES:
+                element.set(key, item)
+            else:
+                add_xml(element, key, item)
+    else:
+        element.text = value
+
+def to_xml(name, value):
+    """Returns a ws/2 response with the value as root element"""
+    root = ET.Element("metadata", xmlns=NS)
+    add_xml(root, name, value)
+    return b'<?xml version="1.0" encoding="UTF-8"?>' + ET.tostring(root)
+
+def message(text):
+    """Returns a ws/2 response with a message"""
+    return to_xml("message", {"text": text})
+
+
+class Fixtures(object):
+    """The discs, releases and recordings served"""
+
+    def __init__(self, directory):
+        self.discs = dict()
+        self.releases = dict()
+        self.isrcs = dict()         # isrc -> recording ID -> recording
+        self.submitted = []
+        self._lock = threading.Lock()
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(directory, name)) as data_file:
+                data = json.load(data_file)
+            if "disc" in data:
+                self.discs[data["disc"]["id"]] = data["disc"]
+                for release in data["disc"].get("release-list", []):
+                    self.add_release(release)
+            elif "release" in data:
+                self.add_release(data["release"], lookup=True)
+
+    def add_release(self, release, lookup=False):
+        """Add a release, those of release lookups replace those of discs"""
+        if lookup or release["id"] not in self.releases:
+            self.releases[release["id"]] = release
+        summary = dict((key, value) for key, value in release.items()
+                       if key in ["id", "title", "status", "date", "country"])
+        for medium in release.get("medium-list", []):
+            for track in medium.get("track-list", []):
+                recording = track.get("recording")
+                if recording is None:
+                    continue
+                for isrc in recording.get("isrc-list", []):
+                    self.add_isrc(isrc, recording, summary)
+
+    def add_isrc(self, isrc, recording, release):
+        recordings = self.isrcs.setdefault(isrc, dict())
+        if recording["id"] not in recordings:
+            recordings[recording["id"]] = dict(
+                    (key, value) for key, value in recording.items()
+                    if key in ["id", "title", "length", "artist-credit"])
+            recordings[recording["id"]]["release-list"] = []
+        entry = recordings[recording["id"]]
+        if release["id"] not in [rel["id"] for rel in entry["release-list"]]:
+            entry["release-list"].append(release)
+
+    def submit(self, recording_isrcs):
+        """Attach the ISRCs to the recordings, like the real server"""
+        with self._lock:
+            self.submitted.append(recording_isrcs)
+            for recording_id, isrcs in recording_isrcs.items():
+                for release in self.releases.values():
+                    for medium in release.get("medium-list", []):
+                        for track in medium.get("track-list", []):
+                            recording = track.get("recording", {})
+                            if recording.get("id") != recording_id:
+                                continue
+                            attached = recording.setdefault("isrc-list", [])
+                            for isrc in isrcs:
+                                if isrc not in attached:
+                                    attached.append(isrc)
+                                self.add_isrc(isrc, recording,
+                                              {"id": release["id"],
+                                               "title": release["title"]})
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Answers like /ws/2 of the MusicBrainz server"""
+
+    server_version = "ws2_server/1.0"
+
+    def log_message(self, format, *args):
+        if not self.server.options.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _respond(self, code, body, headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _busy(self):
+        """Wait like the real server, True if the request is refused"""
+        options = self.server.options
+        if options.latency:
+            time.sleep(options.latency)
+        with self.server.lock:
+            return self.server.random.random() < options.busy
+
+    def _authenticated(self):
+        """Check the digest authentication, True if it is valid"""
+        options = self.server.options
+        header = self.headers.get("Authorization", "")
+        if not header.startswith("Digest "):
+            return False
+        fields = dict((key, quoted or plain) for key, quoted, plain
+                      in re.findall(r'(\w+)=(?:"([^"]*)"|([^,\s]*))', header))
+        if (fields.get("username") != options.user
+                or not self.server.valid_nonce(fields.get("nonce"))):
+            return False
+
+        def md5(text):
+            return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+        ha1 = md5("%s:%s:%s" % (options.user, REALM, options.password))
+        ha2 = md5("%s:%s" % (self.command, fields.get("uri")))
+        if "qop" in fields:
+            expected = md5(":".join([ha1, fields["nonce"], fields.get("nc", ""),
+                                     fields.get("cnonce", ""), fields["qop"],
+                                     ha2]))
+        else:
+            expected = md5("%s:%s:%s" % (ha1, fields["nonce"], ha2))
+        return fields.get("response") == expected
+
+    def _challenge(self):
+        nonce = self.server.new_nonce()
+        challenge = ('Digest realm="%s", nonce="%s", qop="auth", '
+                     'algorithm=MD5' % (REALM, nonce))
+        self._respond(401, message("Authorization required"),
+                      {"WWW-Authenticate": challenge})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if self._busy():
+            self._respond(503, message("Your requests are exceeding the"
+                                       " allowable rate limit."))
+        elif len(parts) != 4 or parts[:2] != ["ws", "2"]:
+            self._respond(400, message("Invalid request"))
+        else:
+            self._lookup(parts[2], parts[3], parse_qs(url.query))
+
+    def _lookup(self, entity, mbid, query):
+        fixtures = self.server.fixtures
+        if entity == "discid":
+            if mbid in fixtures.discs:
+                self._respond(200, to_xml("disc", fixtures.discs[mbid]))
+            elif "toc" in query:
+                # no fuzzy matching, nothing is similar enough
+                self._respond(200, to_xml("release-list", []))
+            else:
+                self._respond(404, message("Not Found"))
+        elif entity == "release" and mbid in fixtures.releases:
+            self._respond(200, to_xml("release", fixtures.releases[mbid]))
+        elif entity == "isrc" and mbid in fixtures.isrcs:
+            recordings = list(fixtures.isrcs[mbid].values())
+            self._respond(200, to_xml("isrc", {"id": mbid,
+                                               "recording-list": recordings}))
+        else:
+            self._respond(404, message("Not Found"))
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if url.path.rstrip("/") != "/ws/2/recording":
+            self._respond(400, message("Invalid request"))
+        elif not self._authenticated():
+            self._challenge()
+        elif self._busy():
+            self._respond(503, message("Your requests are exceeding the"
+                                       " allowable rate limit."))
+        else:
+            try:
+                recording_isrcs = parse_isrc_submission(body)
+            except ET.ParseError as err:
+                self._respond(400, message("Invalid XML: %s" % err))
+                return
+            self.server.fixtures.submit(recording_isrcs)
+            if self.server.options.submissions:
+                with self.server.lock:
+                    with open(self.server.options.submissions, "a") as log:
+                        log.write(json.dumps(recording_isrcs) + "\n")
+            self._respond(200, message("OK"))
+
+def parse_isrc_submission(body):
+    """Returns {recording_id: [isrc, ...]} of a submission"""
+    root = ET.fromstring(body)
+    recording_isrcs = dict()
+    for recording in root.iter("{%s}recording" % NS):
+        recording_id = (recording.get("{%s}id" % NS)
+                        or recording.get("id"))
+        isrcs = recording_isrcs.setdefault(recording_id, [])
+        for isrc in recording.iter("{%s}isrc" % NS):
+            isrcs.append(isrc.get("{%s}id" % NS) or isrc.get("id"))
+    return recording_isrcs
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    """Handles every request in a thread, like the real server would"""
+
+    daemon_threads = True
+
+    def __init__(self, options):
+        HTTPServer.__init__(self, (options.host, options.port), Handler)
+        self.options = options
+        self.fixtures = Fixtures(options.data)
+        self.nonces = OrderedDict()     # nonce -> time it was issued
+        self.lock = threading.Lock()
+        self.random = random.Random(options.seed)
+
+    def _expire_nonces(self):
+        """Drop the nonces that timed out or are too many, needs the lock"""
+        expired = time.time() - NONCE_TIMEOUT
+        while self.nonces and (len(self.nonces) > MAX_NONCES
+                               or next(iter(self.nonces.values())) < expired):
+            self.nonces.popitem(last=False)
+
+    def new_nonce(self):
+        """Returns a nonce for a challenge of the digest authentication"""
+        nonce = hashlib.md5(os.urandom(16)).hexdigest()
+        with self.lock:
+            self.nonces[nonce] = time.time()
+            self._expire_nonces()
+        return nonce
+
+    def valid_nonce(self, nonce):
+        """True if the nonce was issued and didn't time out"""
+        with self.lock:
+            self._expire_nonces()
+            issued = self.nonces.get(nonce)
+        return issued is not None and issued > time.time() - NONCE_TIMEOUT
+
+def gather_options(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--host", default="localhost",
+            help="Address to listen on. Default: localhost")
+    parser.add_option("-p", "--port", type="int", default=8000,
+            help="Port to listen on, 0 for any free port. Default: 8000")
+    parser.add_option("--data", metavar="DIRECTORY",
+            default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "test_data"),
+            help="Directory with the discs and releases as JSON."
+            " Default: test_data")
+    parser.add_option("--latency", metavar="SECONDS", type="float",
+            default=0.0,
+            help="Time each request takes. Default: 0")
+    parser.add_option("--busy", metavar="RATE", type="float", default=0.0,
+            help="Part of the requests answered with 503, between 0 and 1."
+            " Default: 0")
+    parser.add_option("--seed", default="isrcsubmit",
+            help="Seed for choosing the refused requests.")
+    parser.add_option("-u", "--user", default="test",
+            help="User name for submissions. Default: test")
+    parser.add_option("--password", default="test",
+            help="Password for submissions. Default: test")
+    parser.add_option("--submissions", metavar="FILE",
+            help="Append the submitted ISRCs to this file as JSON lines.")
+    parser.add_option("-q", "--quiet", action="store_true", default=False,
+            help="Don't log the requests.")
+    options, args = parser.parse_args(argv[1:])
+    if args:
+        parser.error("no arguments expected")
+    return options
+
+def main(argv):
+    options = gather_options(argv)
+    server = Server(options)
+    host, port = server.server_address[:2]
+    sys.stderr.write("serving %d discs and %d releases on http://%s:%d/ws/2\n"
+                     % (len(server.fixtures.discs),
+                        len(server.fixtures.releases), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
+
+
+# vim:set shiftwidth=4 smarttab expandtab: